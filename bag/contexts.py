@@ -2,45 +2,156 @@
 
 # use the decimal function since this is a financial transaction and using float is susceptible to rounding errors.
 # in general using decimal is preferred when working with money because it's more accurate.
+import copy
+import zlib
 from decimal import Decimal
 from django.conf import settings
-from django.shortcuts import get_object_or_404
-from products.models import Product
+from products.caching import get_price_version
+from products.snapshots import get_product_snapshots
+from .stores import get_cart, load_bag
 
 # The context processor as bag_contents(request) function
 """
 In order to make this context processor available to the entire application
 we need to add it to the list of context_processors in the TEMPLATES variable in settings.py
-This context concept is the same as the context we use in our views 
-but the difference is that we're returning the context directly 
+This context concept is the same as the context we use in our views
+but the difference is that we're returning the context directly
 and making it available to all templates by putting it in settings.py
 """
-# we'll access the shopping bag stored in the session within the context processor in order 
+# we'll access the shopping bag stored in the cart (see bag/stores.py) within the context processor in order
 # to add all the bag's current items to the context of all templates
 
 # take the request as a parameter
 def bag_contents(request):
+    # Access the shopping bag in the cart
+    bag = load_bag(request)
+
+    # the context processor runs on every template render and the checkout view calls it again,
+    # so reuse the result already calculated for this request as long as the bag hasn't changed since
+    cached = getattr(request, '_bag_contents_cache', None)
+    if cached is not None and cached[0] == bag:
+        return cached[1]
+
+    context = _calculate_bag_contents(bag)
+    request._bag_contents_cache = (copy.deepcopy(bag), context)
+
+    # returns a dictionary available to all templates across the entire application
+    # much like we can use request.user in any template due to the presence of the built-in request context processor
+    return context
+
+
+# The lazy version of the context processor registered in settings.py
+def lazy_bag_contents(request):
+    """
+    Return the bag context with every value wrapped in a callable,
+    so the bag is only calculated once a template actually reads one of them
+    """
+    # the django template engine calls any callable it finds in the context when the variable is resolved,
+    # so pages that never use the bag don't load any products at all
+    # and bag_contents() memoizes the calculation for all the other variables once the first one is read
+    def lazy(key):
+        return lambda: bag_contents(request)[key]
+
+    # the header and the main nav only need the product count and the grand total
+    # so those come from the summary stored in the session without touching the products table
+    def summary(key):
+        return lambda: bag_summary(request)[key]
+
+    return {
+        'bag_items': lazy('bag_items'),
+        'total': lazy('total'),
+        'product_count': summary('product_count'),
+        'delivery': lazy('delivery'),
+        'free_delivery_delta': lazy('free_delivery_delta'),
+        # the threshold is a setting so there's nothing to calculate
+        'free_delivery_threshold': settings.FREE_DELIVERY_THRESHOLD,
+        'grand_total': summary('grand_total'),
+    }
+
+
+def bag_checksum(stored_bag):
+    return zlib.crc32(stored_bag.encode()) if isinstance(stored_bag, str) else None
+
+
+def update_bag_summary(request):
+    """
+    Store the product count and grand total of the bag in the cart,
+    stamped with the price version they were calculated with
+    """
+    cart = get_cart(request)
+    # an empty bag has no summary to keep, bag_summary() knows it's empty
+    if not cart.get('bag'):
+        cart.pop('bag_summary')
+        return
+    # read the version before calculating so a price change happening meanwhile makes the summary stale
+    price_version = get_price_version()
+    current_bag = bag_contents(request)
+    cart.set('bag_summary', {
+        # another request can change the bag before this one stores the summary, see bag/stores.py
+        'bag': bag_checksum(cart.get('bag')),
+        'product_count': current_bag['product_count'],
+        # the cart is serialized to JSON so store the decimal as a string
+        'grand_total': str(current_bag['grand_total']),
+        'price_version': price_version,
+    })
+
+
+def bag_summary(request):
+    """
+    Return the product count and grand total of the bag from the summary stored in the cart,
+    recalculating it only when a product or the bag has been changed since it was stored
+    """
+    cart = get_cart(request)
+    if not cart.get('bag'):
+        return {'product_count': 0, 'grand_total': 0}
+
+    summary = cart.get('bag_summary')
+    stale = (
+        summary is None
+        or summary['price_version'] != get_price_version()
+        or summary.get('bag') != bag_checksum(cart.get('bag'))
+    )
+    if stale:
+        update_bag_summary(request)
+        summary = cart.get('bag_summary')
+
+    return {
+        'product_count': summary['product_count'],
+        'grand_total': Decimal(summary['grand_total']),
+    }
+
+
+def _calculate_bag_contents(bag):
+    """
+    Build the bag items and totals for a bag dictionary
+    """
     # create an empty list for the bag items to live in
     bag_items = []
     total = 0
     product_count = 0
 
-    # Access the shopping bag in the session
-    bag = request.session.get("bag", {})
+    # get all the products in the bag with a single query instead of one query per bag item,
+    # or none at all for the products already in the snapshot cache (see products/snapshots.py).
+    # it returns a dictionary of product snapshots keyed by their integer ids
+    products = get_product_snapshots(bag)
 
     # add the products and their data to the bag items list
     for item_id, item_data in bag.items():
+        product = products.get(int(item_id))
+        # skip products which have been removed from the database since they were added to the bag
+        # rather than raising a 404 from inside a context processor
+        if product is None:
+            continue
+
         # we only want to execute the code below if the item has no sizes means the item_data is an integer.
         # If it's an integer then we know the item_data is just the quantity.
         if isinstance(item_data, int):
-            # get the product
-            product = get_object_or_404(Product, pk=item_id)
             # add product quantity times the price to the total
             total += item_data * product.price
             # increment the product count by the quantity
             product_count += item_data
             # add to the list of bag items a dictionary also containing the product object itself
-            # that will give us access to all the other product fields such as the product image 
+            # that will give us access to all the other product fields such as the product image
             # when iterating through the bag items in our templates
             bag_items.append({
                 'item_id': item_id,
@@ -48,8 +159,7 @@ def bag_contents(request):
                 'product': product,
             })
         else:
-            product = get_object_or_404(Product, pk=item_id)
-            # Otherwise we know item_data is a dictionary and we need to 
+            # Otherwise we know item_data is a dictionary and we need to
             # iterate through the inner dictionary of items_by_size
             for size, quantity in item_data['items_by_size'].items():
                 total += quantity * product.price
@@ -70,10 +180,10 @@ def bag_contents(request):
     else:
         delivery = 0
         free_delivery_delta = 0
-    
+
     grand_total = delivery + total
-    
-    context = {
+
+    return {
         'bag_items': bag_items,
         'total': total,
         'product_count': product_count,
@@ -82,7 +192,3 @@ def bag_contents(request):
         'free_delivery_threshold': settings.FREE_DELIVERY_THRESHOLD,
         'grand_total': grand_total,
     }
-
-    # returns a dictionary available to all templates across the entire application
-    # much like we can use request.user in any template due to the presence of the built-in request context processor
-    return context
\ No newline at end of file
@@ -0,0 +1,72 @@
+"""
+Compare the compact format the bag is stored in, see bag/serialization.py, with the JSON it replaced,
+for made up bags of 10, 100 and 1,000 products where every other product has two sizes:
+how many characters each takes, how many 500 character stripe metadata values it's split over,
+and how long encoding and decoding take. Nothing is read from or written to the database.
+
+    python3 manage.py benchmark_bag_format
+    python3 manage.py benchmark_bag_format --lines 50,500 --repeat 5000
+"""
+
+import json
+import math
+
+from django.core.management.base import BaseCommand, CommandError
+
+from bag.serialization import STRIPE_METADATA_VALUE_LENGTH, bag_metadata, decode_bag, encode_bag
+from boutique_ado.benchmarking import describe, time_calls
+
+
+def make_bag(products):
+    bag = {}
+    for item_id in range(1, products + 1):
+        if item_id % 2:
+            bag[str(item_id)] = item_id % 5 + 1
+        else:
+            bag[str(item_id)] = {'items_by_size': {'m': 1, 'xl': 2}}
+    return bag
+
+
+class Command(BaseCommand):
+    help = 'Compare the size and speed of the compact bag format with JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--lines', default='10,100,1000',
+            help='Comma separated numbers of products in the bag (default: 10,100,1000)',
+        )
+        parser.add_argument(
+            '--repeat', type=int, default=1000,
+            help='How many times each bag is encoded and decoded (default: 1000)',
+        )
+
+    def handle(self, *args, **options):
+        for products in [int(products) for products in options['lines'].split(',')]:
+            bag = make_bag(products)
+            encoded = encode_bag(bag)
+            legacy = json.dumps(bag)
+            if decode_bag(encoded) != bag or decode_bag(legacy) != bag:
+                raise CommandError(f'The bag of {products} products doesn\'t decode to itself')
+
+            self.stdout.write(self.style.MIGRATE_HEADING(f'{products} products'))
+            self.stdout.write(
+                f'  size: compact {len(encoded)} characters, JSON {len(legacy)} characters '
+                f'({len(encoded) / len(legacy):.0%})'
+            )
+            # bag_metadata() raises ValueError when the bag needs more keys than stripe allows
+            try:
+                parts = bag_metadata(bag)['bag_parts']
+            except ValueError:
+                parts = 'too many'
+            self.stdout.write(
+                f'  stripe metadata values: compact {parts}, '
+                f'JSON {math.ceil(len(legacy) / STRIPE_METADATA_VALUE_LENGTH)}'
+            )
+            calls = {
+                'encode compact': lambda: encode_bag(bag),
+                'encode JSON': lambda: json.dumps(bag),
+                'decode compact': lambda: decode_bag(encoded),
+                'decode JSON': lambda: decode_bag(legacy),
+            }
+            for name, call in calls.items():
+                self.stdout.write(f'  {name}: {describe(time_calls(call, options["repeat"]))}')
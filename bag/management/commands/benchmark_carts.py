@@ -0,0 +1,103 @@
+"""
+Measure how many bag requests per second each of the cart stores of the CART_STORES setting serves
+with several shoppers changing their bags at once: adding to the bag, adjusting and removing a line
+with the JSON endpoints, and showing the bag page. Every shopper runs in a thread of its own with a client
+of its own, so the requests go through every middleware like a browser's would and the stores' locks are
+contended like on a busy site. They run against a database of their own loaded with the fixture catalog,
+see boutique_ado/benchmarking.py.
+
+    python3 manage.py benchmark_carts
+    python3 manage.py benchmark_carts --stores session,database --shoppers 16 --repeat 100
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.test import Client, override_settings
+from django.urls import reverse
+
+from boutique_ado.benchmarking import benchmark_database, describe
+
+REQUESTS = ('add', 'adjust', 'remove', 'bag page')
+
+
+class Command(BaseCommand):
+    help = 'Measure the bag requests per second of each cart store with several shoppers at once'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--stores', default=','.join(settings.CART_STORES),
+            help='Comma separated cart stores (default: all of them)',
+        )
+        parser.add_argument(
+            '--shoppers', type=int, default=8,
+            help='How many shoppers change their bags at once (default: 8)',
+        )
+        parser.add_argument(
+            '--repeat', type=int, default=50,
+            help='How many times each shopper makes each request (default: 50)',
+        )
+        parser.add_argument(
+            '--lines', type=int, default=10,
+            help='How many lines the bag of every shopper has (default: 10)',
+        )
+
+    def handle(self, *args, **options):
+        with benchmark_database():
+            for store in options['stores'].split(','):
+                with override_settings(CART_STORE=store):
+                    cache.clear()
+                    self.benchmark_store(store, options['shoppers'], options['repeat'], options['lines'])
+
+    def benchmark_store(self, store, shoppers, repeat, lines):
+        # the shoppers fill their bags first, then all start at once
+        ready = threading.Barrier(shoppers)
+
+        def shopper(number):
+            try:
+                return self.shop(ready, repeat, lines)
+            finally:
+                connections.close_all()
+
+        with ThreadPoolExecutor(shoppers) as executor:
+            results = list(executor.map(shopper, range(shoppers)))
+        elapsed = max(end for _, _, end in results) - min(start for _, start, _ in results)
+
+        self.stdout.write(self.style.MIGRATE_HEADING(f'{store} ({shoppers} shoppers, {lines} lines)'))
+        for name in REQUESTS:
+            durations = [duration for timings, _, _ in results for duration in timings[name]]
+            self.stdout.write(f'  {name}: {describe(durations)}')
+        total = shoppers * repeat * len(REQUESTS)
+        self.stdout.write(f'  all together: {total / elapsed:.0f} requests/s')
+
+    def shop(self, ready, repeat, lines):
+        """
+        Make repeat rounds of the requests as one shopper, returning how long each of them took
+        along with when the first round started and the last one ended
+        """
+        client = Client()
+        # the products after the first one, so adding and removing the first one leaves the rest of the bag alone
+        for item_id in range(2, lines + 2):
+            client.post(reverse('add_to_bag_json', args=[item_id]), {'quantity': 1})
+        requests = {
+            'add': lambda: client.post(reverse('add_to_bag_json', args=[1]), {'quantity': 1}),
+            'adjust': lambda: client.post(reverse('adjust_bag_json', args=[1]), {'quantity': 3}),
+            'remove': lambda: client.post(reverse('remove_from_bag_json', args=[1])),
+            'bag page': lambda: client.get(reverse('view_bag')),
+        }
+        timings = {name: [] for name in REQUESTS}
+        ready.wait()
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for name in REQUESTS:
+                request_start = time.perf_counter()
+                response = requests[name]()
+                timings[name].append(time.perf_counter() - request_start)
+                if response.status_code != 200:
+                    raise RuntimeError(f'{name} answered {response.status_code}')
+        return timings, start, time.perf_counter()
@@ -0,0 +1,24 @@
+"""
+Delete the carts of the 'database' cart store which haven't been changed for longer than the cart cookie lasts,
+as nobody can get back to them, like clearsessions does for the database sessions.
+
+    python3 manage.py clear_carts
+"""
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from bag.models import Cart
+
+
+class Command(BaseCommand):
+    help = 'Delete the expired carts stored in the database'
+
+    def handle(self, *args, **options):
+        expired = timezone.now() - timedelta(seconds=settings.CART_COOKIE_AGE)
+        # updated_at is indexed so this doesn't read the whole table
+        deleted, _ = Cart.objects.filter(updated_at__lt=expired).delete()
+        self.stdout.write(f'Deleted {deleted} expired carts')
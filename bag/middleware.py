@@ -0,0 +1,24 @@
+from django.utils.cache import patch_vary_headers
+from django.utils.deprecation import MiddlewareMixin
+
+from .stores import get_cart
+
+
+class CartMiddleware(MiddlewareMixin):
+    """
+    Attach the cart store to every request as request.cart and save it once the response is ready.
+    It goes after SessionMiddleware, as the session store keeps the cart in the session.
+    Like the django middleware it's built on MiddlewareMixin, so under ASGI the async views run
+    in the event loop rather than in django's single sync thread, which only runs the two hooks below
+    """
+    def process_request(self, request):
+        get_cart(request)
+
+    def process_response(self, request, response):
+        cart = get_cart(request)
+        # a page showing the bag depends on the cart cookie, like SessionMiddleware does for the session cookie
+        if getattr(cart, 'accessed', False):
+            patch_vary_headers(response, ('Cookie',))
+        # a store which hasn't been changed doesn't write anything
+        cart.save(response)
+        return response
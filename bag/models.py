@@ -1,3 +1,16 @@
 from django.db import models
 
-# Create your models here.
+
+# A shopping bag kept in the database, used when the CART_STORE setting is 'database', see bag/stores.py
+class Cart(models.Model):
+    # the random id kept in the shopper's cookie, unique so looking the cart up is a single index lookup
+    key = models.CharField(max_length=32, unique=True)
+    # the bag and its summary as JSON
+    data = models.TextField(default='{}')
+    # raised by every change, so a change is only written if the cart is still the version it was made to
+    version = models.PositiveIntegerField(default=0)
+    # when the cart was last changed, so old carts can be found and deleted
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    def __str__(self):
+        return self.key
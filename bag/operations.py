@@ -0,0 +1,93 @@
+# Changing the quantity of a line in the shopping bag
+
+"""
+A line of the bag is a product, or a size of a product with sizes, along with its quantity.
+The bag views and the JSON bag endpoints all change the bag through the functions below,
+so the rules for adding, adjusting and removing a line live in one place.
+
+A view doesn't change the bag it loaded and store it back, as two requests doing that at the same time
+(a double click, two tabs) would lose one of the changes. It describes the change as a BagOperation instead,
+which the cart store applies to the bag as it is stored at that moment, see update_bag in bag/stores.py.
+Adding to a line gives the same bag whatever order two additions are applied in,
+and setting or removing a line only changes that line, so no other change is lost.
+"""
+
+from collections import namedtuple
+
+
+def line_quantity(bag, item_id, size=None):
+    """
+    Return the quantity of a line in the bag, 0 if it isn't in the bag
+    """
+    item_data = bag.get(item_id)
+    if item_data is None:
+        return 0
+    if size:
+        if isinstance(item_data, int):
+            return 0
+        return item_data['items_by_size'].get(size, 0)
+    return item_data if isinstance(item_data, int) else 0
+
+
+def set_quantity(bag, item_id, size, quantity):
+    """
+    Set the quantity of a line in the bag, removing the line when the quantity is zero or less,
+    and the product when it has no sizes left. Returns the new quantity.
+    """
+    if size:
+        items_by_size = bag.setdefault(item_id, {'items_by_size': {}})['items_by_size']
+        if quantity > 0:
+            items_by_size[size] = quantity
+        else:
+            items_by_size.pop(size, None)
+            if not items_by_size:
+                bag.pop(item_id)
+    elif quantity > 0:
+        bag[item_id] = quantity
+    else:
+        bag.pop(item_id, None)
+    return max(quantity, 0)
+
+
+def add_quantity(bag, item_id, size, quantity):
+    """
+    Add to the quantity of a line in the bag, returning the new quantity
+    """
+    return set_quantity(bag, item_id, size, line_quantity(bag, item_id, size) + quantity)
+
+
+class BagOperation(namedtuple('BagOperation', ['action', 'item_id', 'size', 'quantity'])):
+    """
+    A single change to the bag, see add_to_line, set_line and clear_bag below
+    """
+    def apply(self, bag):
+        """
+        Change the bag dictionary in place, returning the quantity of the line before and after
+        """
+        if self.action == 'clear':
+            bag.clear()
+            return 0, 0
+        previous = line_quantity(bag, self.item_id, self.size)
+        if self.action == 'add':
+            return previous, add_quantity(bag, self.item_id, self.size, self.quantity)
+        if self.action == 'set':
+            # a line which isn't in the bag, because it was removed meanwhile, is left out rather than added back
+            if not previous:
+                return 0, 0
+            return previous, set_quantity(bag, self.item_id, self.size, self.quantity)
+        raise ValueError(f'Unknown bag operation {self.action!r}')
+
+
+def add_to_line(item_id, size, quantity):
+    return BagOperation('add', item_id, size or None, quantity)
+
+
+def set_line(item_id, size, quantity):
+    """
+    Set the quantity of a line which is in the bag, removing it for a quantity of 0
+    """
+    return BagOperation('set', item_id, size or None, quantity)
+
+
+def clear_bag():
+    return BagOperation('clear', None, None, 0)
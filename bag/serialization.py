@@ -0,0 +1,108 @@
+# The compact format the shopping bag is stored in
+
+"""
+In the code the bag is a dictionary of {item_id: quantity} for products without sizes
+and {item_id: {'items_by_size': {size: quantity}}} for products with sizes.
+Storing that dictionary as JSON repeats the 'items_by_size' key and all the quotes and braces for every product,
+and it's stored in the session, in Order.original_bag and in the metadata of the stripe payment intent,
+where a value can't be longer than 500 characters.
+
+So it's stored as a flat list of product id, size and quantity instead, prefixed with the version of the format:
+    {"3": 2, "160": {"items_by_size": {"m": 1, "xl": 2}}}  becomes  2|3:2,160/m:1,160/xl:2
+decode_bag() also reads the JSON dictionaries stored before, so existing sessions and orders keep working.
+The bag is read and changed with load_bag and update_bag in bag/stores.py.
+"""
+
+import json
+from urllib.parse import quote, unquote
+
+BAG_FORMAT_VERSION = 2
+
+# the most characters stripe accepts in a metadata value, and the most metadata keys it accepts
+STRIPE_METADATA_VALUE_LENGTH = 500
+STRIPE_METADATA_BAG_KEYS = 40
+
+
+def encode_bag(bag):
+    """
+    Return the compact string for a bag dictionary
+    """
+    items = []
+    for item_id, item_data in bag.items():
+        if isinstance(item_data, int):
+            items.append(f'{item_id}:{item_data}')
+        else:
+            for size, quantity in item_data['items_by_size'].items():
+                # the sizes come from the form, so quote any characters which would break up the string
+                if not size.isalnum():
+                    size = quote(size, safe='')
+                items.append(f'{item_id}/{size}:{quantity}')
+    return f'{BAG_FORMAT_VERSION}|{",".join(items)}'
+
+
+def decode_bag(value):
+    """
+    Return the bag dictionary for a compact string, or for a bag stored in the older JSON format.
+    Raises ValueError if the value isn't a bag.
+    """
+    if not value:
+        return {}
+    # the older format: the dictionary itself in the session or its JSON in an order or a payment intent
+    if isinstance(value, dict):
+        return value
+    if value.startswith('{'):
+        return json.loads(value)
+
+    version, _, items = value.partition('|')
+    if version != str(BAG_FORMAT_VERSION):
+        raise ValueError(f'Unknown bag format {version!r}')
+    bag = {}
+    if not items:
+        return bag
+    # splitting the strings is several times faster than matching every item with a regular expression
+    for item in items.split(','):
+        key, _, quantity = item.rpartition(':')
+        item_id, _, size = key.partition('/')
+        if not item_id.isdigit():
+            raise ValueError(f'Invalid bag item {item!r}')
+        # int() raises ValueError for a missing or invalid quantity
+        quantity = int(quantity)
+        if '%' in size:
+            size = unquote(size)
+        if not size:
+            bag[item_id] = quantity
+        elif item_id in bag:
+            bag[item_id]['items_by_size'][size] = quantity
+        else:
+            bag[item_id] = {'items_by_size': {size: quantity}}
+    return bag
+
+
+def bag_metadata(bag):
+    """
+    Return the stripe metadata for a bag, the compact string split over as many keys as it needs:
+    bag, bag_1, bag_2... along with bag_parts, the number of them
+    """
+    encoded = encode_bag(bag)
+    chunks = [
+        encoded[start:start + STRIPE_METADATA_VALUE_LENGTH]
+        for start in range(0, len(encoded), STRIPE_METADATA_VALUE_LENGTH)
+    ] or ['']
+    if len(chunks) > STRIPE_METADATA_BAG_KEYS:
+        raise ValueError('The bag is too big for the payment intent metadata')
+    # stripe merges the metadata into what the payment intent already has,
+    # so keys left over from a bigger bag are ignored by counting the ones used now
+    metadata = {'bag': chunks[0], 'bag_parts': str(len(chunks))}
+    for number, chunk in enumerate(chunks[1:], start=1):
+        metadata[f'bag_{number}'] = chunk
+    return metadata
+
+
+def bag_from_metadata(metadata):
+    """
+    Return the bag dictionary from the metadata of a payment intent, joining the keys it's split over
+    """
+    # payment intents from before the bag was split only have the bag key
+    parts = int(metadata.get('bag_parts', 1))
+    encoded = metadata['bag'] + ''.join(metadata[f'bag_{number}'] for number in range(1, parts))
+    return decode_bag(encoded)
@@ -0,0 +1,342 @@
+# Where the shopping bag is kept between requests
+
+"""
+The bag and its summary used to live in the session, so with the database session engine
+every page view read the django_session row and every change to the bag rewrote it.
+Now they go through a cart store, picked with the CART_STORE setting:
+    1. 'session' keeps them in the session, as before.
+    2. 'cookie' keeps them in a signed cookie, so there's nothing stored on the server at all.
+    3. 'cache' keeps them in the cache (locmem, redis...) under a random cart id kept in a cookie.
+    4. 'database' keeps them in a Cart row looked up by the cart id in the cookie.
+CartMiddleware attaches the store to every request as request.cart, and saves it once the response is ready.
+The bag is stored in the compact format of bag/serialization.py, use load_bag to read it
+and update_bag to change it with one of the operations of bag/operations.py.
+
+Two requests from the same shopper can change the bag at the same time, so each store applies an operation
+to the bag as it's stored at that moment instead of writing back the bag the request loaded:
+    the database store with a compare-and-set on the version of the Cart row,
+    the cache store while holding a lock in the cache,
+    the session store while holding a lock around the save of the session, reloading the bag stored meanwhile.
+The cookie store can't, as the browser keeps whichever of the two cookies comes back last.
+Anything else kept in the cart, like the bag summary, is just written by whichever request comes last.
+The locks are taken in the cache, so they only work across processes with a shared cache like redis.
+"""
+
+import json
+import time
+from contextlib import contextmanager
+from functools import partial
+from uuid import uuid4
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .serialization import decode_bag, encode_bag
+
+
+@contextmanager
+def cart_lock(name):
+    """
+    Hold a lock in the cache for the block, waiting for another request holding it to finish.
+    The lock expires after CART_LOCK_TIMEOUT seconds so a request that died doesn't hold it forever
+    """
+    key = f'bag:lock:{name}'
+    token = uuid4().hex
+    deadline = time.monotonic() + settings.CART_LOCK_TIMEOUT * 2
+    # cache.add only sets the key if it isn't there, atomically, so only one request gets it
+    while not cache.add(key, token, settings.CART_LOCK_TIMEOUT):
+        if time.monotonic() > deadline:
+            raise RuntimeError(f'Timed out waiting for the cart lock {name}')
+        time.sleep(0.005)
+    try:
+        yield
+    finally:
+        # don't release a lock which expired and was taken by another request meanwhile
+        if cache.get(key) == token:
+            cache.delete(key)
+
+
+def apply_to_bag(operation, data):
+    """
+    Apply the bag operation to the bag in the cart data, returning its result
+    """
+    bag = decode_bag(data.get('bag'))
+    result = operation.apply(bag)
+    if bag:
+        data['bag'] = encode_bag(bag)
+    else:
+        # an empty bag isn't stored at all
+        data.pop('bag', None)
+    return result
+
+
+class SessionCartStore:
+    """
+    Keep the cart in the session
+    """
+    def __init__(self, request):
+        self.request = request
+        # the bag operations applied during this request, applied again when the session is saved
+        self.operations = []
+
+    def get(self, key, default=None):
+        return self.request.session.get(key, default)
+
+    def set(self, key, value):
+        self.request.session[key] = value
+
+    def pop(self, key):
+        self.request.session.pop(key, None)
+
+    def update_bag(self, operation):
+        self.operations.append(operation)
+        return self.apply_to_session(self.request.session.get('bag'), [operation])
+
+    def apply_to_session(self, bag, operations):
+        data = {'bag': bag}
+        for operation in operations:
+            result = apply_to_bag(operation, data)
+        # an operation which didn't change anything, like removing a line that isn't in the bag,
+        # leaves the session as it is so it isn't saved for nothing
+        if data.get('bag') != self.request.session.get('bag'):
+            if 'bag' in data:
+                self.set('bag', data['bag'])
+            else:
+                self.pop('bag')
+        return result
+
+    def save(self, response):
+        # SessionMiddleware saves the session after this, writing all of it, including the bag as this request
+        # loaded it. So when it's going to be saved, have its save reload the bag first, under a lock
+        session = self.request.session
+        if session.modified and session.session_key:
+            session.save = partial(self.save_session, session.save)
+
+    def save_session(self, save, must_create=False):
+        session = self.request.session
+        with cart_lock(f'session:{session.session_key}'):
+            stored = type(session)(session.session_key).load()
+            if self.operations:
+                self.apply_to_session(stored.get('bag'), self.operations)
+            elif 'bag' in stored:
+                self.set('bag', stored['bag'])
+            else:
+                self.pop('bag')
+            save(must_create=must_create)
+
+
+class CartStore:
+    """
+    Base class of the stores keeping the cart as a dictionary outside the session,
+    which is loaded the first time it's read and saved only when it has been changed
+    """
+    def __init__(self, request):
+        self.request = request
+        self._data = None
+        self.accessed = False
+        # the keys set or popped during this request, None for the popped ones
+        self.changes = {}
+
+    @property
+    def data(self):
+        if self._data is None:
+            self.accessed = True
+            self._data = self.load() or {}
+        return self._data
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def set(self, key, value):
+        self.data[key] = value
+        self.changes[key] = value
+
+    def pop(self, key):
+        self.data.pop(key, None)
+        self.changes[key] = None
+
+    def apply_changes(self, data):
+        for key, value in self.changes.items():
+            if value is None:
+                data.pop(key, None)
+            else:
+                data[key] = value
+
+    def update_bag(self, operation):
+        return apply_to_bag(operation, self.data)
+
+    def load(self):
+        raise NotImplementedError
+
+    def save(self, response):
+        raise NotImplementedError
+
+    def set_cookie(self, response, value):
+        response.set_cookie(
+            settings.CART_COOKIE_NAME, value,
+            max_age=settings.CART_COOKIE_AGE,
+            secure=settings.SESSION_COOKIE_SECURE,
+            httponly=True,
+            samesite='Lax',
+        )
+
+
+class CookieCartStore(CartStore):
+    """
+    Keep the cart in a signed cookie, which the shopper can read but not change
+    """
+    salt = 'bag.stores.cart'
+
+    def update_bag(self, operation):
+        result = super().update_bag(operation)
+        # so the cookie is written
+        self.changes['bag'] = self.data.get('bag')
+        return result
+
+    def load(self):
+        cookie = self.request.COOKIES.get(settings.CART_COOKIE_NAME)
+        if cookie is None:
+            return None
+        try:
+            return signing.loads(cookie, salt=self.salt, max_age=settings.CART_COOKIE_AGE)
+        except signing.BadSignature:
+            return None
+
+    def save(self, response):
+        if not self.changes:
+            return
+        if self.data:
+            # compress=True as the bag repeats the same characters a lot
+            self.set_cookie(response, signing.dumps(self.data, salt=self.salt, compress=True))
+        else:
+            response.delete_cookie(settings.CART_COOKIE_NAME, samesite='Lax')
+
+
+class CartIdStore(CartStore):
+    """
+    Base class of the stores keeping the cart on the server under a random id kept in a cookie.
+    Subclasses implement update_cart(change), which calls change(data) with the cart as it's stored,
+    atomically stores the data it changed and returns it along with what change returned
+    """
+    def __init__(self, request):
+        super().__init__(request)
+        self.cart_id = request.COOKIES.get(settings.CART_COOKIE_NAME)
+        self.new_cart_id = False
+
+    def load(self):
+        if self.cart_id is None:
+            return None
+        return self.load_cart()
+
+    def update_bag(self, operation):
+        if self.cart_id is None:
+            # the id is random so it can't be guessed to get at someone else's cart
+            self.cart_id = uuid4().hex
+            self.new_cart_id = True
+
+        def change(data):
+            # keep what this request changed in the cart too, as the data is reloaded
+            self.apply_changes(data)
+            return apply_to_bag(operation, data)
+
+        self._data, result = self.update_cart(change)
+        self.accessed = True
+        self.changes = {}
+        return result
+
+    def save(self, response):
+        if self.changes and self.cart_id is not None:
+            self._data, _ = self.update_cart(self.apply_changes)
+        if self.new_cart_id:
+            self.set_cookie(response, self.cart_id)
+
+
+class CacheCartStore(CartIdStore):
+    """
+    Keep the cart in the cache, changing it while holding a lock
+    """
+    def cache_key(self):
+        return f'bag:cart:{self.cart_id}'
+
+    def load_cart(self):
+        return cache.get(self.cache_key())
+
+    def update_cart(self, change):
+        with cart_lock(f'cart:{self.cart_id}'):
+            data = self.load_cart() or {}
+            result = change(data)
+            if data:
+                cache.set(self.cache_key(), data, settings.CART_COOKIE_AGE)
+            else:
+                cache.delete(self.cache_key())
+        return data, result
+
+
+class DatabaseCartStore(CartIdStore):
+    """
+    Keep the cart in a Cart row, found by its indexed key
+    """
+    def load_cart(self):
+        # imported here as the models can't be imported before the apps are ready
+        from .models import Cart
+
+        data = Cart.objects.filter(key=self.cart_id).values_list('data', flat=True).first()
+        return json.loads(data) if data else None
+
+    def update_cart(self, change):
+        from .models import Cart
+
+        carts = Cart.objects.filter(key=self.cart_id)
+        while True:
+            row = carts.values_list('data', 'version').first()
+            data = json.loads(row[0]) if row else {}
+            result = change(data)
+            if row is None:
+                if not data:
+                    return data, result
+                try:
+                    # savepoint so a failed insert doesn't break an outer transaction
+                    with transaction.atomic():
+                        Cart.objects.create(key=self.cart_id, data=json.dumps(data))
+                except IntegrityError:
+                    # another request created the cart meanwhile, so start again from it
+                    continue
+                return data, result
+            # only write the row if it's still the version that was read, otherwise read it again and start over
+            version = carts.filter(version=row[1])
+            if data:
+                written = version.update(data=json.dumps(data), version=F('version') + 1, updated_at=timezone.now())
+            else:
+                written, _ = version.delete()
+            if written:
+                return data, result
+
+
+def get_cart(request):
+    """
+    Return the cart store of the request, creating it if the request didn't go through CartMiddleware
+    """
+    cart = getattr(request, 'cart', None)
+    if cart is None:
+        cart = request.cart = import_string(settings.CART_STORES[settings.CART_STORE])(request)
+    return cart
+
+
+def load_bag(request):
+    """
+    Return the bag dictionary from the cart
+    """
+    return decode_bag(get_cart(request).get('bag'))
+
+
+def update_bag(request, operation):
+    """
+    Apply a bag operation (see bag/operations.py) to the bag in the cart,
+    returning the quantity of the changed line before and after
+    """
+    return get_cart(request).update_bag(operation)
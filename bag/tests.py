@@ -1,3 +1,275 @@
-from django.test import TestCase
+import json
+import threading
 
-# Create your tests here.
+from django.core.cache import cache
+from django.db import connections
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+
+from checkout.models import Order
+
+from .models import Cart
+from .serialization import (
+    STRIPE_METADATA_BAG_KEYS,
+    STRIPE_METADATA_VALUE_LENGTH,
+    bag_from_metadata,
+    bag_metadata,
+    decode_bag,
+    encode_bag,
+)
+
+
+class CartStoreTestsMixin:
+    """
+    The bag behaves the same whichever cart store keeps it.
+    Mixed into a TestCase for each of the stores below
+    """
+    fixtures = ['categories', 'products']
+
+    def setUp(self):
+        cache.clear()
+
+    def bag(self, client=None):
+        """
+        Return the lines of the bag as {(item_id, size): quantity}
+        """
+        response = (client or self.client).get(reverse('view_bag'))
+        return {(item['item_id'], item.get('size')): item['quantity'] for item in response.context['bag_items']()}
+
+    def post(self, name, item_id, **data):
+        return self.client.post(reverse(name, args=[item_id]), dict(data, redirect_url='/'))
+
+    def test_add_adjust_and_remove(self):
+        self.post('add_to_bag', 1, quantity=2)
+        self.post('add_to_bag', 1, quantity=1)
+        self.post('add_to_bag', 2, quantity=1, product_size='m')
+        self.assertEqual(self.bag(), {('1', None): 3, ('2', 'm'): 1})
+        self.post('adjust_bag', 1, quantity=5)
+        self.post('remove_from_bag', 2, product_size='m')
+        self.assertEqual(self.bag(), {('1', None): 5})
+
+    def test_header_summary_follows_the_bag(self):
+        self.post('add_to_bag', 1, quantity=2)
+        response = self.client.get(reverse('home'))
+        self.assertEqual(response.context['product_count'](), 2)
+        self.post('adjust_bag', 1, quantity=0)
+        response = self.client.get(reverse('home'))
+        self.assertEqual(response.context['product_count'](), 0)
+
+    def test_shoppers_have_their_own_bags(self):
+        self.post('add_to_bag', 1, quantity=2)
+        other = self.client_class()
+        self.assertEqual(self.bag(other), {})
+        self.assertEqual(self.bag(), {('1', None): 2})
+
+    def test_checkout_success_empties_the_bag(self):
+        self.post('add_to_bag', 1, quantity=2)
+        order = Order.objects.create(full_name='Shopper', email='shopper@example.com', phone_number='1',
+                                     country='IE', town_or_city='Dublin', street_address1='Street')
+        self.client.get(reverse('checkout_success', args=[order.order_number]))
+        self.assertEqual(self.bag(), {})
+
+    def test_browsing_doesnt_store_a_cart(self):
+        self.client.get(reverse('products'))
+        self.client.get(reverse('view_bag'))
+        self.assertNotIn('cart', self.client.cookies)
+        self.assertFalse(Cart.objects.exists())
+
+
+@override_settings(CART_STORE='session')
+class SessionCartStoreTests(CartStoreTestsMixin, TestCase):
+    pass
+
+
+@override_settings(CART_STORE='cookie')
+class CookieCartStoreTests(CartStoreTestsMixin, TestCase):
+    pass
+
+
+@override_settings(CART_STORE='cache')
+class CacheCartStoreTests(CartStoreTestsMixin, TestCase):
+    pass
+
+
+@override_settings(CART_STORE='database')
+class DatabaseCartStoreTests(CartStoreTestsMixin, TestCase):
+
+    def test_emptied_bag_deletes_the_cart(self):
+        self.post('add_to_bag', 1, quantity=2)
+        self.assertEqual(Cart.objects.count(), 1)
+        self.post('remove_from_bag', 1)
+        self.assertFalse(Cart.objects.exists())
+
+
+class ConcurrentBagChangesMixin:
+    """
+    Requests of the same shopper changing the bag at the same time don't lose any quantity.
+    Mixed into a TransactionTestCase for each store that can apply the changes atomically,
+    which leaves out the cookie store
+    """
+    fixtures = ['categories', 'products']
+    threads = 8
+    adds = 10
+
+    def setUp(self):
+        cache.clear()
+
+    def test_no_lost_quantity(self):
+        self.client.post(reverse('add_to_bag_json', args=[1]), {'quantity': 1})
+        errors = []
+
+        def shopper():
+            # another tab of the same shopper
+            client = self.client_class()
+            client.cookies = self.client.cookies
+            try:
+                for n in range(self.adds):
+                    # the redirecting view and the JSON endpoint, along with a change to another line
+                    if n % 2:
+                        client.post(reverse('add_to_bag_json', args=[1]), {'quantity': 1})
+                    else:
+                        client.post(reverse('add_to_bag', args=[1]), {'quantity': 1, 'redirect_url': '/'})
+                    client.post(reverse('add_to_bag_json', args=[2]), {'quantity': 1, 'product_size': 's'})
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connections.close_all()
+
+        workers = [threading.Thread(target=shopper) for _ in range(self.threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(errors, [])
+        response = self.client.get(reverse('view_bag'))
+        bag = {(item['item_id'], item.get('size')): item['quantity'] for item in response.context['bag_items']()}
+        self.assertEqual(bag, {
+            ('1', None): 1 + self.threads * self.adds,
+            ('2', 's'): self.threads * self.adds,
+        })
+
+
+@override_settings(CART_STORE='session')
+class SessionConcurrentBagChangesTests(ConcurrentBagChangesMixin, TransactionTestCase):
+    pass
+
+
+@override_settings(CART_STORE='cache')
+class CacheConcurrentBagChangesTests(ConcurrentBagChangesMixin, TransactionTestCase):
+    pass
+
+
+@override_settings(CART_STORE='database')
+class DatabaseConcurrentBagChangesTests(ConcurrentBagChangesMixin, TransactionTestCase):
+    pass
+
+
+class BagJsonTests(TestCase):
+    """
+    The JSON bag endpoints answer with few queries, and without writing anything when they fail
+    """
+    fixtures = ['categories', 'products']
+
+    def setUp(self):
+        cache.clear()
+
+    def post(self, name, item_id, **data):
+        return self.client.post(reverse(name, args=[item_id]), data)
+
+    def test_add_adjust_and_remove(self):
+        response = self.post('add_to_bag_json', 1, quantity=2)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['line']['quantity'], 2)
+        # the session is loaded, loaded again under the lock and saved, see SessionCartStore
+        with self.assertNumQueries(5):
+            response = self.post('adjust_bag_json', 1, quantity=3)
+        self.assertEqual(response.json()['line']['quantity'], 3)
+        self.assertEqual(response.json()['totals']['product_count'], 3)
+        with self.assertNumQueries(5):
+            response = self.post('remove_from_bag_json', 1)
+        self.assertEqual(response.json()['line']['quantity'], 0)
+        self.assertEqual(response.json()['totals']['grand_total'], '0.00')
+
+    def test_invalid_quantity_is_a_400(self):
+        self.post('add_to_bag_json', 1, quantity=1)
+        # the product comes from the snapshot cache
+        with self.assertNumQueries(0):
+            response = self.post('add_to_bag_json', 1, quantity='two')
+        self.assertEqual(response.status_code, 400)
+        with self.assertNumQueries(0):
+            response = self.post('add_to_bag_json', 1, quantity=0)
+        self.assertEqual(response.status_code, 400)
+        with self.assertNumQueries(0):
+            response = self.post('adjust_bag_json', 1)
+        self.assertEqual(response.status_code, 400)
+
+    def test_unknown_product_is_a_404(self):
+        with self.assertNumQueries(1):
+            response = self.post('add_to_bag_json', 99999, quantity=1)
+        self.assertEqual(response.status_code, 404)
+
+    def test_line_not_in_the_bag_is_a_404_without_saving(self):
+        self.post('add_to_bag_json', 1, quantity=1)
+        self.post('add_to_bag_json', 2, quantity=1)
+        self.post('remove_from_bag_json', 2)
+        # only the session is loaded
+        with self.assertNumQueries(1):
+            response = self.post('adjust_bag_json', 2, quantity=3)
+        self.assertEqual(response.status_code, 404)
+        with self.assertNumQueries(1):
+            response = self.post('remove_from_bag_json', 2, product_size='m')
+        self.assertEqual(response.status_code, 404)
+
+
+class BagFormatTests(SimpleTestCase):
+    """
+    Every bag comes back unchanged from the compact format, and the bags stored as JSON before it can still be read
+    """
+    BAG = {'3': 2, '160': {'items_by_size': {'m': 1, 'xl': 2}}, '7': 1}
+
+    def test_round_trip(self):
+        self.assertEqual(encode_bag(self.BAG), '2|3:2,160/m:1,160/xl:2,7:1')
+        self.assertEqual(decode_bag(encode_bag(self.BAG)), self.BAG)
+        self.assertEqual(decode_bag(encode_bag({})), {})
+        self.assertEqual(decode_bag(''), {})
+        self.assertEqual(decode_bag(None), {})
+
+    def test_legacy_json(self):
+        self.assertEqual(decode_bag(json.dumps(self.BAG)), self.BAG)
+        # the session held the dictionary itself
+        self.assertEqual(decode_bag(self.BAG), self.BAG)
+
+    def test_sizes_with_separators(self):
+        bag = {'5': {'items_by_size': {'a,b': 1, 'c:d': 2, '50%': 3, 'e/f': 4, 'x|y': 5}}}
+        self.assertEqual(decode_bag(encode_bag(bag)), bag)
+
+    def test_invalid_values(self):
+        for value in ('9|1:1', '2|x:1', '2|1:', '2|1:two'):
+            with self.subTest(value=value):
+                with self.assertRaises(ValueError):
+                    decode_bag(value)
+
+    def test_big_bag_is_split_over_the_metadata(self):
+        bag = {str(item_id): {'items_by_size': {'m': 1, 'xl': 2}} for item_id in range(1, 301)}
+        metadata = bag_metadata(bag)
+        parts = int(metadata['bag_parts'])
+        self.assertGreater(parts, 1)
+        self.assertEqual(len([key for key in metadata if key.startswith('bag_') and key != 'bag_parts']), parts - 1)
+        self.assertTrue(all(len(value) <= STRIPE_METADATA_VALUE_LENGTH for value in metadata.values()))
+        self.assertEqual(bag_from_metadata(metadata), bag)
+
+    def test_keys_left_over_from_a_bigger_bag_are_ignored(self):
+        big = {str(item_id): 1 for item_id in range(1, 301)}
+        small = {'1': 2}
+        # stripe merges the new metadata into the old one
+        metadata = dict(bag_metadata(big), **bag_metadata(small))
+        self.assertEqual(bag_from_metadata(metadata), small)
+
+    def test_metadata_of_a_bag_stored_before_it_was_split(self):
+        self.assertEqual(bag_from_metadata({'bag': json.dumps(self.BAG)}), self.BAG)
+
+    def test_too_big_for_the_metadata(self):
+        too_big = STRIPE_METADATA_VALUE_LENGTH * STRIPE_METADATA_BAG_KEYS // 5
+        with self.assertRaises(ValueError):
+            bag_metadata({str(item_id): 1 for item_id in range(10000, 10000 + too_big)})
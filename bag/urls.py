@@ -11,4 +11,8 @@ urlpatterns = [
     path('adjust/<item_id>/', views.adjust_bag, name='adjust_bag'),
     # add a URL for remove_from_bag view
     path('remove/<item_id>/', views.remove_from_bag, name='remove_from_bag'),
+    # the same three answering with JSON instead of a redirect, see the end of views.py
+    path('add/<item_id>/json/', views.add_to_bag_json, name='add_to_bag_json'),
+    path('adjust/<item_id>/json/', views.adjust_bag_json, name='adjust_bag_json'),
+    path('remove/<item_id>/json/', views.remove_from_bag_json, name='remove_from_bag_json'),
 ]
\ No newline at end of file
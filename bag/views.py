@@ -1,10 +1,40 @@
-from django.shortcuts import render, redirect, reverse, HttpResponse, get_object_or_404
+from decimal import Decimal
+
+from django.shortcuts import render, redirect, reverse, HttpResponse
+from django.http import Http404, JsonResponse
+from django.views.decorators.http import require_POST
 
 # import messages and keep users informed of everything that's going on across the entire site
 # by sending messages through the Django messages framework
 from django.contrib import messages
 
-from products.models import Product
+from products.snapshots import get_product_snapshot
+from .contexts import bag_contents, update_bag_summary
+from .operations import add_to_line, set_line
+from .stores import update_bag
+
+
+def get_product_or_404(item_id):
+    """
+    Return the snapshot of the product (see products/snapshots.py) or raise a 404 if it doesn't exist
+    """
+    product = get_product_snapshot(item_id)
+    if product is None:
+        raise Http404('No product matches the given query.')
+    return product
+
+
+def _bag_message(product, size, previous, quantity):
+    """
+    Return the message telling the user how a line of their bag changed
+    """
+    name = f'size {size.upper()} {product.name}' if size else product.name
+    if not quantity:
+        return f'Removed {name} from your bag'
+    if not previous:
+        return f'Added {name} to your bag'
+    return f'Updated {name} quantity to {quantity}'
+
 
 # define a view which will render the bag template
 def view_bag(request):
@@ -20,8 +50,9 @@ def add_to_bag(request, item_id):
 
     # to make messages works we need
     # product = Product.objects.get(pk=item_id)
-    # use get_object_or_404 just in case the product isn't found
-    product = get_object_or_404(Product, pk=item_id)
+    # use get_object_or_404 just in case the product isn't found,
+    # or rather get_product_or_404, which only needs the product's name and price from the snapshot cache
+    product = get_product_or_404(item_id)
 
     # get the quantity from the form
     # convert it to an integer since it'll come from the template as a string
@@ -43,38 +74,17 @@ def add_to_bag(request, item_id):
     # It allows to store the contents of the shopping bag in the HTTP session, while the user browses the site 
     # and adds items to be purchased, by storing the shopping bag in the session. It will persist until the user closes their browser.
     # A session variable bag accesses the requests session and first check if there's a 'bag' key in the session dictionary
-    # and if not we'll create an empty dictionary
-    bag = request.session.get('bag', {})
-
-    # check if a product with sizes is being added to the bag
-    if size:
-        if item_id in list(bag.keys()):
-            if size in bag[item_id]['items_by_size'].keys():
-                bag[item_id]['items_by_size'][size] += quantity
-                messages.success(request, f'Updated size {size.upper()} {product.name} quantity to {bag[item_id]["items_by_size"][size]}')
-            else:
-                bag[item_id]['items_by_size'][size] = quantity
-                messages.success(request, f'Added size {size.upper()} {product.name} to your bag')
-        # If the item's not already in the bag we need to add it as a dictionary with a key of 'items_by_size'
-        # since we may have multiple items with this item_id but different sizes.        
-        else:
-            bag[item_id] = {'items_by_size': {size: quantity}}
-            messages.success(request, f'Added size {size.upper()} {product.name} to your bag')
-    else:
-        # add the item to the bag
-        # if there's already a key in the bag dictionary matching product id, increment its quantity
-        if item_id in list(bag.keys()):
-            bag[item_id] += quantity
-            messages.success(request, f'Updated {product.name} quantity to {bag[item_id]}')
-        else:
-            # create a key of the items id and set it equal to the quantity
-            bag[item_id] = quantity
-            # ref to the toast; add a message to the request object and use string formatting 
-            # to let the user know they've added a product to their bag
-            messages.success(request, f'Added {product.name} to your bag')
-
-    # put the bag variable into the session which itself is a python dictionary
-    request.session['bag'] = bag
+    # and if not we'll create an empty dictionary.
+    # The bag is now kept in a cart store, see bag/stores.py, in a compact format, see bag/serialization.py.
+    # add the quantity to the line of the product, or of its size if a product with sizes is being added,
+    # starting a new line if it isn't in the bag yet. The cart store adds it to the bag as it's stored right now,
+    # so another request changing the bag at the same time doesn't undo it, see bag/operations.py
+    previous, added = update_bag(request, add_to_line(item_id, size, quantity))
+    # let the user know with a message (see the toasts)
+    messages.success(request, _bag_message(product, size, previous, added))
+
+    # keep the summary used by the header in step with the bag
+    update_bag_summary(request)
 
     # ! Because bag is a session variable we can access it anywhere we can access the request object
     # like in our views or the custom context processor we made in context.py
@@ -91,7 +101,7 @@ def add_to_bag(request, item_id):
 def adjust_bag(request, item_id):
     """Adjust the quantity of the specified product to the specified amount"""
 
-    product = get_object_or_404(Product, pk=item_id)
+    product = get_product_or_404(item_id)
 
     # coming from a form on the shopping bag page which will contain the new quantity the user wants in the bag
     quantity = int(request.POST.get('quantity'))
@@ -100,32 +110,16 @@ def adjust_bag(request, item_id):
     if 'product_size' in request.POST:
         size = request.POST['product_size']
 
-    bag = request.session.get('bag', {})
-
-    # If there's a size find that specific size and either set its quantity to the updated one
-    if size:
-        if quantity > 0:
-            bag[item_id]['items_by_size'][size] = quantity
-            messages.success(request, f'Updated size {size.upper()} {product.name} quantity to {bag[item_id]["items_by_size"][size]}')
-        
-        else:
-            # remove the size if the quantity submitted is zero
-            del bag[item_id]['items_by_size'][size]
-            # remove the item entirely if there is no size
-            if not bag[item_id]['items_by_size']:
-                bag.pop(item_id)
-            messages.success(request, f'Removed size {size.upper()} {product.name} from your bag')
+    # set the quantity of the line, of the specific size if there's one,
+    # which removes it when the quantity submitted is zero
+    previous, adjusted = update_bag(request, set_line(item_id, size, quantity))
+    if previous:
+        messages.success(request, _bag_message(product, size, previous, adjusted))
     else:
-        # if quantity is greater than zero set the items quantity accordingly
-        if quantity > 0:
-            bag[item_id] = quantity
-            messages.success(request, f'Updated {product.name} quantity to {bag[item_id]}')
-        # otherwise remove the item
-        else:
-            bag.pop(item_id)
-            messages.success(request, f'Removed {product.name} from your bag')
+        # it was removed in another tab meanwhile
+        messages.error(request, f'{product.name} is not in your bag')
 
-    request.session['bag'] = bag
+    update_bag_summary(request)
 
     # use the reverse function to redirect back to the view_bag URL 
     return redirect(reverse('view_bag'))
@@ -137,25 +131,17 @@ def remove_from_bag(request, item_id):
 
     # wrap the block of code in a try block to catch any exceptions that happen in order to return a 500 server error
     try:
-        product = get_object_or_404(Product, pk=item_id)
+        product = get_product_or_404(item_id)
         size = None
         if 'product_size' in request.POST:
             size = request.POST['product_size']
-        bag = request.session.get('bag', {})
-
-        if size:
-            # We want to remove only the specific size the user requested
-            # delete that size key in the items_by_size dictionary
-            del bag[item_id]['items_by_size'][size]
-            if not bag[item_id]['items_by_size']:
-                bag.pop(item_id)
-            messages.success(request, f'Removed size {size.upper()} {product.name} from your bag')
-        else:
-            # remove the item popping it out of the bag
-            bag.pop(item_id)
-            messages.success(request, f'Removed {product.name} from your bag')
-
-        request.session['bag'] = bag
+        # We want to remove only the specific size the user requested, or the whole item if it has no sizes
+        previous, _ = update_bag(request, set_line(item_id, size, 0))
+        if not previous:
+            raise KeyError(item_id)
+        messages.success(request, _bag_message(product, size, previous, 0))
+
+        update_bag_summary(request)
 
         # Because this view will be posted to from a JavaScript function 
         # instead of returning a redirect return an actual 200 HTTP response implying that the item was successfully removed
@@ -165,4 +151,95 @@ def remove_from_bag(request, item_id):
     except Exception as e:
         # if any error occurs in the removal process the user will get a notification about it 
         messages.error(request, f'Error removing item: {e}')
-        return HttpResponse(status=500)
\ No newline at end of file
+        return HttpResponse(status=500)
+
+# The JSON versions of the views above
+"""
+The views above answer with a redirect, so every change to the bag renders a whole page again
+along with the bag context processor. These ones answer with just the line that changed and the new bag totals
+for the front end to update the page with, and the message for it to show instead of a toast:
+    {"message": "...", "line": {"item_id": "3", "size": null, "quantity": 2, "price": "19.99", "subtotal": "39.98"},
+     "totals": {"product_count": 2, "total": "39.98", "delivery": "3.20", "free_delivery_delta": "...", "grand_total": "43.18"}}
+A removed line has a quantity of 0.
+"""
+
+PENNY = Decimal('0.01')
+
+
+def _posted_size(request):
+    return request.POST.get('product_size') or None
+
+
+def _posted_quantity(request):
+    try:
+        return int(request.POST['quantity'])
+    except (KeyError, ValueError):
+        return None
+
+
+def _bag_json(request, product, item_id, size, previous, quantity):
+    """
+    Return the JSON response for the changed line of the bag
+    """
+    # update_bag_summary calculates the bag contents, which bag_contents then returns again without any query
+    update_bag_summary(request)
+    contents = bag_contents(request)
+    return JsonResponse({
+        'message': _bag_message(product, size, previous, quantity),
+        'line': {
+            'item_id': item_id,
+            'size': size,
+            'quantity': quantity,
+            'price': product.price,
+            'subtotal': product.price * quantity,
+        },
+        'totals': {
+            'product_count': contents['product_count'],
+            # the amounts are rounded to pence, as an empty bag's delivery can come out as 0E-55
+            **{key: Decimal(contents[key]).quantize(PENNY) for key in ('total', 'delivery', 'free_delivery_delta', 'grand_total')},
+        },
+    })
+
+
+def _bag_json_error(message, status):
+    return JsonResponse({'error': message}, status=status)
+
+
+@require_POST
+def add_to_bag_json(request, item_id):
+    """ Add a quantity of the specified product to the shopping bag, answering with JSON """
+    product = get_product_or_404(item_id)
+    quantity = _posted_quantity(request)
+    if quantity is None or quantity < 1:
+        return _bag_json_error('The quantity must be a whole number of at least 1', 400)
+    size = _posted_size(request)
+
+    previous, added = update_bag(request, add_to_line(item_id, size, quantity))
+    return _bag_json(request, product, item_id, size, previous, added)
+
+
+@require_POST
+def adjust_bag_json(request, item_id):
+    """ Adjust the quantity of the specified product to the specified amount, answering with JSON """
+    product = get_product_or_404(item_id)
+    quantity = _posted_quantity(request)
+    if quantity is None:
+        return _bag_json_error('The quantity must be a whole number', 400)
+    size = _posted_size(request)
+
+    previous, adjusted = update_bag(request, set_line(item_id, size, quantity))
+    if not previous:
+        return _bag_json_error(f'{product.name} is not in your bag', 404)
+    return _bag_json(request, product, item_id, size, previous, adjusted)
+
+
+@require_POST
+def remove_from_bag_json(request, item_id):
+    """ Remove the item from the shopping bag, answering with JSON """
+    product = get_product_or_404(item_id)
+    size = _posted_size(request)
+
+    previous, removed = update_bag(request, set_line(item_id, size, 0))
+    if not previous:
+        return _bag_json_error(f'{product.name} is not in your bag', 404)
+    return _bag_json(request, product, item_id, size, previous, removed)
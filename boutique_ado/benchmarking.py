@@ -0,0 +1,70 @@
+# Helpers shared by the benchmark_* management commands
+
+"""
+The benchmark commands time parts of the shop against the fixture catalog.
+benchmark_database() gives them a database of their own, created like the one of the test runner
+and destroyed afterwards, so the database the site uses is never read or written.
+"""
+
+import math
+import statistics
+import time
+from contextlib import contextmanager
+
+from django.core.management import call_command
+from django.db import connection, reset_queries
+from django.test.utils import CaptureQueriesContext, setup_test_environment, teardown_test_environment
+
+
+@contextmanager
+def benchmark_database(fixtures=('categories', 'products')):
+    """
+    Run the block against a new test database loaded with the fixtures, which is destroyed afterwards
+    """
+    # lets the test client reach the views, whatever ALLOWED_HOSTS is
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        if fixtures:
+            call_command('loaddata', *fixtures, verbosity=0)
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+
+def count_queries(func):
+    """
+    Call func, returning what it returned and the number of queries it ran
+    """
+    # django empties the log of the queries when a request starts, which would leave the count
+    # taken from a position past its end, so it's emptied before the count starts too
+    reset_queries()
+    with CaptureQueriesContext(connection) as queries:
+        result = func()
+    return result, len(queries)
+
+
+def time_calls(func, repeat):
+    """
+    Call func repeat times, returning how long each call took in seconds
+    """
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def describe(durations):
+    """
+    Return the median and 95th percentile of the durations in milliseconds, and the calls per second
+    """
+    ordered = sorted(durations)
+    # the nearest rank, so with few durations it's the longest one rather than one below the median
+    p95 = ordered[math.ceil(len(ordered) * 0.95) - 1]
+    return (
+        f'median {statistics.median(ordered) * 1000:.2f} ms, p95 {p95 * 1000:.2f} ms, '
+        f'{len(ordered) / sum(ordered):.0f}/s'
+    )
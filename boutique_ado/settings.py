@@ -12,6 +12,8 @@ https://docs.djangoproject.com/en/3.0/ref/settings/
 
 import os
 
+from django.core.exceptions import ImproperlyConfigured
+
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
@@ -53,6 +55,7 @@ INSTALLED_APPS = [
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
+    'bag.middleware.CartMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
@@ -86,7 +89,7 @@ TEMPLATES = [
                 # adding our custom context_processor below means that anytime we need to access the bag contents 
                 # in any template across the entire site they'll be available to us from bag/contexts.py
                 # without having to return them from a whole bunch of different views across different apps
-                'bag.contexts.bag_contents',
+                'bag.contexts.lazy_bag_contents',
             ],
             # add a list which contain all the tags we want available in all our templates by default
             # this gives us access to everything we need from crispy forms across all templates by default
@@ -131,6 +134,40 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        # the tests use a file rather than an in-memory database, so the threads of the concurrency tests
+        # in bag/tests.py wait for each other's writes instead of failing with "database table is locked"
+        'TEST': {'NAME': os.path.join(BASE_DIR, 'test_db.sqlite3')},
+    }
+}
+
+
+# Cache
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+# the cache holds the rendered product listings, the product counts and the price versions.
+# CACHE_BACKEND picks where it lives:
+#   'locmem' (the default, also used by the tests) keeps it in the memory of each process,
+#   'file' keeps it in the CACHE_LOCATION directory shared by all the processes on one machine,
+#   'redis' keeps it on the redis server at CACHE_LOCATION (needs the django-redis package installed)
+# A deploy running more than one worker process needs 'file' or 'redis': with 'locmem' every process has
+# its own catalog and price versions, so a product changed in one process stays cached in all the others,
+# and the locks keeping two changes to the same bag apart (see bag/stores.py) only hold within a single process.
+# CACHE_LOCATION has to be set for them, as there's no sensible default directory or redis server.
+
+CACHE_BACKENDS = {
+    'locmem': 'django.core.cache.backends.locmem.LocMemCache',
+    'file': 'django.core.cache.backends.filebased.FileBasedCache',
+    'redis': 'django_redis.cache.RedisCache',
+}
+CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'locmem')
+CACHE_LOCATION = os.getenv('CACHE_LOCATION', 'boutique-ado' if CACHE_BACKEND == 'locmem' else None)
+
+if CACHE_LOCATION is None:
+    raise ImproperlyConfigured(f'CACHE_LOCATION must be set when CACHE_BACKEND is {CACHE_BACKEND!r}')
+
+CACHES = {
+    'default': {
+        'BACKEND': CACHE_BACKENDS[CACHE_BACKEND],
+        'LOCATION': CACHE_LOCATION,
     }
 }
 
@@ -195,3 +232,65 @@ The public key is meant to be public so that doesn't really matter but is added
 STRIPE_PUBLIC_KEY = os.getenv('STRIPE_PUBLIC_KEY', '')
 STRIPE_SECRET_KEY = os.getenv('STRIPE_SECRET_KEY', '')
 STRIPE_WH_SECRET = os.getenv('STRIPE_WH_SECRET', '')
+# where the stripe API is, which can be a local stub server when testing
+STRIPE_API_BASE = os.getenv('STRIPE_API_BASE', 'https://api.stripe.com')
+# how long a call to stripe can take before it's given up on, in seconds,
+# and how many times a call failing with a network error or a 5xx response is retried
+STRIPE_TIMEOUT = 10
+STRIPE_MAX_NETWORK_RETRIES = 2
+
+# when on, the checkout and cache_checkout_data urls use the async views in checkout/async_views.py,
+# which only make sense when the site is served with ASGI
+CHECKOUT_ASYNC_VIEWS = os.getenv('CHECKOUT_ASYNC_VIEWS', '') == '1'
+# the most requests the async checkout views make to stripe at the same time
+STRIPE_MAX_CONCURRENT_REQUESTS = 16
+
+# when on, the webhook view stores verified stripe events in the WebhookEvent table and answers straight away,
+# and the process_webhooks management command handles them in the background
+STRIPE_WH_QUEUE = os.getenv('STRIPE_WH_QUEUE', '') == '1'
+# how many times a queued event is tried before it's marked as failed
+STRIPE_WH_MAX_ATTEMPTS = 8
+# the delay before retrying a failed event, in seconds, doubled after every attempt up to the maximum
+STRIPE_WH_RETRY_DELAY = 5
+STRIPE_WH_MAX_RETRY_DELAY = 60 * 60
+# how long a worker can hold an event before another worker takes it over, in seconds
+STRIPE_WH_LOCK_TIMEOUT = 60 * 5
+
+# the number of products shown on each page of the products listing
+PRODUCTS_PER_PAGE = 24
+# how long the total number of products for a listing is cached, in seconds
+PRODUCTS_COUNT_CACHE_TIMEOUT = 60 * 15
+# how long a rendered page of the products grid is cached, in seconds
+PRODUCTS_GRID_CACHE_TIMEOUT = 60 * 15
+# how long the rendered details of a product are cached, in seconds
+PRODUCTS_DETAIL_CACHE_TIMEOUT = 60 * 60
+
+# the backend searching the products: 'sqlite' (FTS5), 'postgres' (tsvector), 'python' (in memory)
+# or 'auto' to pick the one matching the database
+PRODUCTS_SEARCH_BACKEND = os.getenv('PRODUCTS_SEARCH_BACKEND', 'auto')
+
+# how the order totals are kept up to date when a line item is saved or deleted:
+# 'incremental' changes them by the difference the line item made,
+# 'aggregate' sums up all the line items of the order again every time
+ORDER_TOTALS_MODE = 'incremental'
+
+# where the shopping bag is kept between requests, see bag/stores.py:
+# 'session' (the default) in the session, 'cookie' in a signed cookie,
+# 'cache' in the cache and 'database' in the Cart table, both under a random id kept in a cookie
+CART_STORES = {
+    'session': 'bag.stores.SessionCartStore',
+    'cookie': 'bag.stores.CookieCartStore',
+    'cache': 'bag.stores.CacheCartStore',
+    'database': 'bag.stores.DatabaseCartStore',
+}
+CART_STORE = os.getenv('CART_STORE', 'session')
+# the cookie holding the cart or its id, and how long it's kept, in seconds
+CART_COOKIE_NAME = 'cart'
+CART_COOKIE_AGE = 60 * 60 * 24 * 14
+# how long a request can hold the lock on a cart while changing it, in seconds, see bag/stores.py
+CART_LOCK_TIMEOUT = 5
+
+# the most products kept in the snapshot cache of each process, and how long one is kept, in seconds,
+# see products/snapshots.py
+PRODUCT_SNAPSHOT_CACHE_SIZE = 1000
+PRODUCT_SNAPSHOT_CACHE_TIMEOUT = 60 * 5
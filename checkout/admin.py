@@ -1,7 +1,8 @@
 # Castomize admin
 
 from django.contrib import admin
-from .models import Order, OrderLineItem
+from .models import Order, OrderLineItem, WebhookEvent
+from .totals import defer_order_totals
 
 
 # OrderLineItemAdminInline inherits from admin.TabularInline
@@ -41,6 +42,23 @@ class OrderAdmin(admin.ModelAdmin):
     # set items to be ordered by date in reverse chronological order putting the most recent orders at the top
     ordering = ('-date',)
 
+    def save_related(self, request, form, formsets, change):
+        # the line items of the inlines are saved one by one, so recalculate the order totals
+        # once after all of them are saved rather than after every one of them
+        with defer_order_totals():
+            super().save_related(request, form, formsets, change)
+
 # register the Order model and the OrderAdmin.
 # not register the OrderLineItem model since it's accessible via the inlines on the Order model
-admin.site.register(Order, OrderAdmin)
\ No newline at end of file
+admin.site.register(Order, OrderAdmin)
+
+# the queued stripe webhook events, so the failed ones and their errors can be looked at
+class WebhookEventAdmin(admin.ModelAdmin):
+    list_display = ('event_id', 'event_type', 'status', 'attempts',
+                    'next_attempt_at', 'received_at', 'processed_at',)
+    list_filter = ('status', 'event_type',)
+    readonly_fields = ('event_id', 'event_type', 'payload', 'attempts',
+                       'locked_at', 'last_error', 'received_at', 'processed_at',)
+    ordering = ('-received_at',)
+
+admin.site.register(WebhookEvent, WebhookEventAdmin)
@@ -0,0 +1,93 @@
+# Async versions of the checkout views which call stripe
+
+"""
+The checkout view creates a payment intent and cache_checkout_data modifies one,
+and with the sync views the worker serving the request waits for the whole round trip to stripe.
+When the site runs under ASGI (boutique_ado/asgi.py) and the CHECKOUT_ASYNC_VIEWS setting is on,
+checkout/urls.py routes to the views below instead. They run the same steps as the sync views
+in checkout/views.py, but the stripe requests go to a thread pool of their own and the event loop
+carries on serving other requests while they're waiting, so one process keeps many checkouts in flight.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotAllowed
+
+from .forms import OrderForm
+from .payment_intents import advance, make_stripe_call, payment_intent_steps
+from .stripe_client import get_stripe_client
+from .views import (
+    checkout_amount,
+    payment_error,
+    payment_intent_metadata,
+    place_order,
+    render_checkout,
+)
+
+import stripe
+
+# the pool is bounded so a burst of checkouts can't open more connections to stripe than this at once;
+# the requests beyond it wait for a free thread
+stripe_executor = ThreadPoolExecutor(
+    max_workers=settings.STRIPE_MAX_CONCURRENT_REQUESTS,
+    thread_name_prefix='stripe',
+)
+
+
+def call_stripe(func):
+    """
+    Return an awaitable version of a stripe API function which runs in the stripe thread pool
+    """
+    # the stripe calls don't touch the database, so they don't need to queue up
+    # on the single thread django runs the sync code of the request in
+    return sync_to_async(func, thread_sensitive=False, executor=stripe_executor)
+
+
+async def payment_intent_client_secret(request, amount):
+    """
+    The async version of checkout.payment_intents.payment_intent_client_secret,
+    running the same steps while making their stripe calls in the stripe thread pool
+    """
+    client = get_stripe_client()
+    steps = payment_intent_steps(request, amount)
+    # the steps read and write the session, so they run in django's sync thread
+    call, client_secret = await sync_to_async(advance)(steps)
+    while call is not None:
+        result, error = None, None
+        try:
+            result = await call_stripe(make_stripe_call)(client, call)
+        except stripe.error.InvalidRequestError as e:
+            error = e
+        call, client_secret = await sync_to_async(advance)(steps, result, error)
+    return client_secret
+
+
+# the session, the messages and the database are sync only, so every step using them
+# goes through sync_to_async, and the require_POST decorator only works with sync views in django 3.2
+async def cache_checkout_data(request):
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    try:
+        pid, metadata = await sync_to_async(payment_intent_metadata)(request)
+        await call_stripe(get_stripe_client().payment_intents.update)(pid, params={'metadata': metadata})
+        return HttpResponse(status=200)
+    except Exception as e:
+        return await sync_to_async(payment_error)(request, e)
+
+
+async def checkout(request):
+    if request.method == 'POST':
+        response, order_form = await sync_to_async(place_order)(request)
+        if response is not None:
+            return response
+    else:
+        order_form = OrderForm()
+
+    response, stripe_total = await sync_to_async(checkout_amount)(request)
+    if response is not None:
+        return response
+
+    client_secret = await payment_intent_client_secret(request, stripe_total)
+    return await sync_to_async(render_checkout)(request, order_form, client_secret)
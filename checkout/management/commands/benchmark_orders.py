@@ -0,0 +1,109 @@
+"""
+Time turning bags of 1, 10 and 100 lines into orders with build_order(), see checkout/orders.py,
+against the way the checkout view used to do it: getting each product with its own query
+and saving the line items one at a time, each save updating the order totals through the post_save signal.
+Both ways must come to the same totals, which is checked too.
+Then time get_or_build_order(), which the checkout view and the stripe webhook handler both go through,
+building the order of a new payment intent and finding the order of one that was already built,
+against the field by field lookup the webhook handler used to find it.
+The orders are saved to a database of their own loaded with the fixture catalog, see boutique_ado/benchmarking.py.
+
+    python3 manage.py benchmark_orders
+    python3 manage.py benchmark_orders --lines 1,10,100,150 --repeat 50
+"""
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+
+from boutique_ado.benchmarking import benchmark_database, count_queries, describe, time_calls
+from checkout.models import Order, OrderLineItem
+from checkout.orders import build_order, get_or_build_order
+from products.models import Product
+
+
+def new_order(stripe_pid=None):
+    return Order(full_name='Shopper', email='shopper@example.com', phone_number='1',
+                 country='IE', town_or_city='Dublin', street_address1='Street', stripe_pid=stripe_pid)
+
+
+def make_bag(lines):
+    """
+    Return a bag with the given number of lines, every third one a product with sizes
+    """
+    bag = {}
+    for item_id in Product.objects.order_by('pk').values_list('pk', flat=True)[:lines]:
+        if item_id % 3:
+            bag[str(item_id)] = item_id % 4 + 1
+        else:
+            bag[str(item_id)] = {'items_by_size': {'m': 1, 'l': 2}}
+    return bag
+
+
+def build_order_line_by_line(order, bag):
+    """
+    Save the order and its line items the way the checkout view did before build_order()
+    """
+    order.save()
+    for item_id, item_data in bag.items():
+        product = Product.objects.get(id=item_id)
+        if isinstance(item_data, int):
+            OrderLineItem(order=order, product=product, quantity=item_data).save()
+        else:
+            for size, quantity in item_data['items_by_size'].items():
+                OrderLineItem(order=order, product=product, quantity=quantity, product_size=size).save()
+    return order
+
+
+class Command(BaseCommand):
+    help = 'Time building orders from bags of different sizes'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--lines', default='1,10,100',
+            help='Comma separated numbers of lines in the bag (default: 1,10,100)',
+        )
+        parser.add_argument(
+            '--repeat', type=int, default=20,
+            help='How many orders of each size are built (default: 20)',
+        )
+
+    def handle(self, *args, **options):
+        with benchmark_database():
+            builders = {
+                'line by line': build_order_line_by_line,
+                'build_order': build_order,
+            }
+            for lines in [int(lines) for lines in options['lines'].split(',')]:
+                bag = make_bag(lines)
+                self.stdout.write(self.style.MIGRATE_HEADING(f'bag of {len(bag)} lines'))
+                totals = set()
+                for name, builder in builders.items():
+                    # the product snapshots are warm like they are on a busy site
+                    cache.clear()
+                    builder(new_order(), bag)
+                    order, queries = count_queries(lambda: builder(new_order(), bag))
+                    totals.add((order.order_total, order.delivery_cost, order.grand_total))
+                    durations = time_calls(lambda: builder(new_order(), bag), options['repeat'])
+                    self.stdout.write(f'  {name}: {describe(durations)}, {queries} queries')
+                if len(totals) != 1:
+                    raise CommandError(f'The orders have different totals: {totals}')
+                self.stdout.write(f'  same totals: {totals.pop()}')
+                self.benchmark_get_or_build_order(bag, options['repeat'])
+
+    def benchmark_get_or_build_order(self, bag, repeat):
+        pids = (f'pi_benchmark_{len(bag)}_{n}' for n in range(repeat + 1))
+        built = get_or_build_order(new_order(next(pids)), bag)[0]
+        requests = {
+            'get_or_build_order, new payment intent': lambda: get_or_build_order(new_order(next(pids)), bag),
+            'get_or_build_order, order already built': lambda: get_or_build_order(new_order(built.stripe_pid), bag),
+            'field by field lookup': lambda: Order.objects.get(
+                full_name__iexact=built.full_name, email__iexact=built.email,
+                phone_number__iexact=built.phone_number, country__iexact=built.country,
+                postcode__iexact=built.postcode, town_or_city__iexact=built.town_or_city,
+                street_address1__iexact=built.street_address1, street_address2__iexact=built.street_address2,
+                county__iexact=built.county, grand_total=built.grand_total,
+                original_bag=built.original_bag, stripe_pid=built.stripe_pid,
+            ),
+        }
+        for name, request in requests.items():
+            self.stdout.write(f'  {name}: {describe(time_calls(request, repeat))}')
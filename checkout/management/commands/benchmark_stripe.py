@@ -0,0 +1,118 @@
+"""
+Time creating payment intents through the pooled stripe client, see checkout/stripe_client.py,
+against a client with a new requests session for every call, which is what calling the stripe library
+without a client of our own amounted to: a new connection and handshake for every call.
+The calls go to a stripe stand-in on localhost, which waits --handshake milliseconds on every new connection
+like a TCP and TLS handshake with stripe would take, and they are made from --threads threads at once
+like the requests of several shoppers checking out together. Nothing is sent to stripe.
+
+    python3 manage.py benchmark_stripe
+    python3 manage.py benchmark_stripe --handshake 100 --threads 8 --repeat 50
+"""
+
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from boutique_ado.benchmarking import describe
+from checkout.stripe_client import build_stripe_client
+
+
+def make_server(handshake):
+    """
+    Return a server on localhost answering payment intent creates,
+    waiting handshake seconds before the first request of every connection
+    """
+    ids = count(1)
+
+    class Handler(BaseHTTPRequestHandler):
+        # keeps the connection open between requests, like stripe does
+        protocol_version = 'HTTP/1.1'
+        # otherwise the reply to a request on a reused connection waits for the delayed ACK of the last one
+        disable_nagle_algorithm = True
+
+        def setup(self):
+            time.sleep(handshake)
+            super().setup()
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            pid = f'pi_benchmark{next(ids)}'
+            content = json.dumps({
+                'id': pid,
+                'object': 'payment_intent',
+                'client_secret': f'{pid}_secret',
+            }).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    return server
+
+
+class Command(BaseCommand):
+    help = 'Time stripe calls through the pooled client and through a new session for every call'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--handshake', type=float, default=50,
+            help='How many milliseconds every new connection takes to set up (default: 50)',
+        )
+        parser.add_argument(
+            '--threads', type=int, default=4,
+            help='How many threads make calls at once (default: 4)',
+        )
+        parser.add_argument(
+            '--repeat', type=int, default=25,
+            help='How many calls each thread makes (default: 25)',
+        )
+
+    def handle(self, *args, **options):
+        server = make_server(options['handshake'] / 1000)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            with override_settings(
+                STRIPE_API_BASE=f'http://127.0.0.1:{server.server_port}',
+                STRIPE_SECRET_KEY='sk_test_benchmark',
+                STRIPE_MAX_NETWORK_RETRIES=0,
+            ):
+                pooled = build_stripe_client()
+                clients = {
+                    'pooled client': lambda: pooled,
+                    'new session per call': build_stripe_client,
+                }
+                self.stdout.write(self.style.MIGRATE_HEADING(
+                    f'{options["threads"]} threads, {options["handshake"]:g} ms handshake'
+                ))
+                for name, get_client in clients.items():
+                    self.benchmark_client(name, get_client, options['threads'], options['repeat'])
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def benchmark_client(self, name, get_client, threads, repeat):
+        def create_payment_intent():
+            start = time.perf_counter()
+            get_client().payment_intents.create(params={'amount': 1000, 'currency': 'eur'})
+            return time.perf_counter() - start
+
+        # the first call of every thread opens the connections the pooled client keeps
+        with ThreadPoolExecutor(threads) as executor:
+            list(executor.map(lambda _: create_payment_intent(), range(threads)))
+            start = time.perf_counter()
+            durations = list(executor.map(lambda _: create_payment_intent(), range(threads * repeat)))
+            elapsed = time.perf_counter() - start
+        self.stdout.write(f'  {name}: {describe(durations)}, {len(durations) / elapsed:.0f} calls/s in all')
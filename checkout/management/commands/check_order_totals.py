@@ -0,0 +1,53 @@
+"""
+Verify the stored totals of every order against the sum of its line items,
+which is what update_total() would calculate, and list the orders where they differ.
+With ORDER_TOTALS_MODE set to 'incremental' this is how to make sure the totals haven't drifted.
+
+    python3 manage.py check_order_totals
+    python3 manage.py check_order_totals --fix
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Sum
+
+from checkout.models import Order
+from checkout.totals import recalculate_order_totals
+
+
+class Command(BaseCommand):
+    help = 'Check the stored order totals against a full sum of their line items'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--fix', action='store_true',
+            help='Recalculate the totals of the orders which are wrong',
+        )
+
+    def handle(self, *args, **options):
+        # sum up the line items of all the orders in a single query
+        orders = Order.objects.annotate(lineitems_sum=Sum('lineitems__lineitem_total')).order_by('pk')
+        field = Order._meta.get_field('grand_total')
+        wrong = []
+        checked = 0
+        for order in orders.iterator():
+            checked += 1
+            order_total = order.lineitems_sum or 0
+            delivery_cost, grand_total = order._calculate_delivery(order_total)
+            # round the expected values the way they're rounded when they're saved
+            expected = [field.to_python(value) for value in (order_total, delivery_cost, grand_total)]
+            expected = [round(value, field.decimal_places) for value in expected]
+            stored = [order.order_total, order.delivery_cost, order.grand_total]
+            if stored != expected:
+                wrong.append(order)
+                self.stdout.write(
+                    f'{order.order_number}: stored {" / ".join(map(str, stored))}, '
+                    f'expected {" / ".join(map(str, expected))} (total / delivery / grand total)'
+                )
+
+        if options['fix']:
+            recalculate_order_totals(order.pk for order in wrong)
+            self.stdout.write(f'{checked} orders checked, {len(wrong)} fixed')
+        elif wrong:
+            raise CommandError(f'{checked} orders checked, {len(wrong)} with wrong totals')
+        else:
+            self.stdout.write(f'{checked} orders checked, all totals are right')
@@ -0,0 +1,47 @@
+"""
+Handle the stripe webhook events stored by the webhook view when the STRIPE_WH_QUEUE setting is on,
+with a pool of worker threads retrying the failed events with an increasing delay.
+
+    python3 manage.py process_webhooks
+    python3 manage.py process_webhooks --workers 8
+    python3 manage.py process_webhooks --once
+"""
+
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+
+from checkout.webhook_queue import run_workers
+
+
+class Command(BaseCommand):
+    help = 'Handle the queued stripe webhook events with a pool of background workers'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=4,
+            help='The number of events handled at the same time',
+        )
+        parser.add_argument(
+            '--poll-interval', type=float, default=1.0,
+            help='How long to wait when no event is due, in seconds',
+        )
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Handle the events which are due and stop, instead of running until interrupted',
+        )
+
+    def handle(self, *args, **options):
+        stop = threading.Event()
+        # finish the events being handled before stopping on ctrl-c or a TERM from the process manager
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *args: stop.set())
+
+        handled, failed = run_workers(
+            workers=options['workers'],
+            poll_interval=options['poll_interval'],
+            once=options['once'],
+            stop=stop,
+        )
+        self.stdout.write(f'{handled} events handled, {failed} failed')
@@ -0,0 +1,44 @@
+# Generated by Django 3.2.25 on 2026-10-18 15:50
+
+from django.db import migrations, models
+
+
+def make_stripe_pids_unique(apps, schema_editor):
+    """
+    Clear the blank payment intent ids and rename the duplicated ones,
+    so the unique constraint can be added
+    """
+    Order = apps.get_model('checkout', 'Order')
+    Order.objects.filter(stripe_pid='').update(stripe_pid=None)
+    seen = set()
+    for order in Order.objects.exclude(stripe_pid=None).order_by('id').only('id', 'stripe_pid'):
+        if order.stripe_pid in seen:
+            # an order created twice for the same payment, keep the first one as the original
+            Order.objects.filter(pk=order.pk).update(stripe_pid=f'{order.stripe_pid}_duplicate_{order.pk}')
+        seen.add(order.stripe_pid)
+
+
+def restore_blank_stripe_pids(apps, schema_editor):
+    Order = apps.get_model('checkout', 'Order')
+    Order.objects.filter(stripe_pid=None).update(stripe_pid='')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('checkout', '0002_auto_20240619_1756'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='order',
+            name='stripe_pid',
+            field=models.CharField(default=None, max_length=254, null=True),
+        ),
+        migrations.RunPython(make_stripe_pids_unique, restore_blank_stripe_pids),
+        migrations.AlterField(
+            model_name='order',
+            name='stripe_pid',
+            field=models.CharField(default=None, max_length=254, null=True, unique=True),
+        ),
+    ]
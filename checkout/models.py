@@ -1,11 +1,13 @@
 # Python Universal Unique Identifier class will be used to generate the order number
 import uuid
 
-from django.db import models
+from django.db import models, transaction
 from django.db.models import Sum
+from django.utils import timezone
 from django.conf import settings
 
 from products.models import Product
+from products.snapshots import get_product_snapshot
 
 # Here are the models we need to create and track orders for anyone who makes a purchase
 
@@ -21,7 +23,8 @@ And the second is a CharField stripe_pid that contain the stripe payment intent
 # the Order model will handle all orders across the store and is related to the OrderLineItem model
 class Order(models.Model):
     # automatically generate this order number as we want it to be unique and permanent so users can find their previous orders
-    order_number = models.CharField(max_length=32, null=False, editable=False)
+    # it's unique, which also indexes it, as the checkout success page looks the order up by it
+    order_number = models.CharField(max_length=32, null=False, editable=False, unique=True)
     full_name = models.CharField(max_length=50, null=False, blank=False)
     email = models.EmailField(max_length=254, null=False, blank=False)
     phone_number = models.CharField(max_length=20, null=False, blank=False)
@@ -36,7 +39,9 @@ class Order(models.Model):
     order_total = models.DecimalField(max_digits=10, decimal_places=2, null=False, default=0)
     grand_total = models.DecimalField(max_digits=10, decimal_places=2, null=False, default=0)
     original_bag = models.TextField(null=False, blank=False, default='')
-    stripe_pid = models.CharField(max_length=254, null=False, blank=False, default='')
+    # the payment intent id is unique so the checkout view and the webhook handler can never create the same order twice.
+    # It's null rather than blank for orders without a payment intent, as any number of rows can be null
+    stripe_pid = models.CharField(max_length=254, null=True, blank=False, default=None, unique=True)
 
     # the first underscore by convention indicates it's a private method which will only be used inside this class
     def _generate_order_number(self):
@@ -59,14 +64,36 @@ class Order(models.Model):
         if we manually delete all the lineitems from an order, by making sure that this sets the order_total to zero instead of None.
         Without this, the next line would cause an error because it would try to determine if None is less than or equal to the delivery threshold.
         """
-        if self.order_total < settings.FREE_DELIVERY_THRESHOLD:
-            self.delivery_cost = self.order_total * settings.STANDARD_DELIVERY_PERCENTAGE / 100
-        else:
-            self.delivery_cost = 0
-        self.grand_total = self.order_total + self.delivery_cost
+        self.delivery_cost, self.grand_total = self._calculate_delivery(self.order_total)
         # save the instance
         self.save()
 
+    def _calculate_delivery(self, order_total):
+        """
+        Return the delivery cost and the grand total for an order total
+        """
+        if order_total < settings.FREE_DELIVERY_THRESHOLD:
+            delivery_cost = order_total * settings.STANDARD_DELIVERY_PERCENTAGE / 100
+        else:
+            delivery_cost = 0
+        return delivery_cost, order_total + delivery_cost
+
+    def update_total_by(self, delta):
+        """
+        Add delta to the order total when a single line item changes,
+        instead of summing up all the line items again like update_total does.
+        Only the total columns are written, not the whole order.
+        """
+        orders = Order.objects.filter(pk=self.pk)
+        # savepoint=False as there's nothing to roll back to when the UPDATE fails
+        with transaction.atomic(savepoint=False):
+            # lock the order row until the end of the transaction and add to the total stored in it
+            # rather than the one read earlier, so two line items changing at the same time can't overwrite each other
+            self.order_total = orders.select_for_update().values_list('order_total', flat=True).get() + delta
+            # the delivery is calculated by the same code as in update_total, so it's rounded the same way
+            self.delivery_cost, self.grand_total = self._calculate_delivery(self.order_total)
+            orders.update(order_total=self.order_total, delivery_cost=self.delivery_cost, grand_total=self.grand_total)
+
     def save(self, *args, **kwargs):
         """
         Override the original save method to set the order number
@@ -93,13 +120,81 @@ class OrderLineItem(models.Model):
     quantity = models.IntegerField(null=False, blank=False, default=0)
     lineitem_total = models.DecimalField(max_digits=6, decimal_places=2, null=False, blank=False, editable=False)
 
+    # the lineitem total and the order the line item had when it was loaded from the database,
+    # so when it's saved or deleted the order total can be changed by the difference, see checkout/signals.py.
+    # None means they aren't known, for a line item which wasn't loaded from the database
+    _original_lineitem_total = None
+    _original_order_id = None
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._remember_original()
+        return instance
+
+    def _remember_original(self):
+        # deferred fields aren't loaded, so leave them unknown rather than loading them
+        loaded = self.__dict__
+        self._original_lineitem_total = loaded.get('lineitem_total')
+        self._original_order_id = loaded.get('order_id')
+
     def save(self, *args, **kwargs):
         """
         Override the original save method to set the lineitem total
         and update the order total.
         """
-        self.lineitem_total = self.product.price * self.quantity
+        # the price comes from the snapshot cache unless the product is already loaded, see products/snapshots.py
+        if OrderLineItem.product.is_cached(self):
+            price = self.product.price
+        else:
+            price = get_product_snapshot(self.product_id).price
+        self.lineitem_total = price * self.quantity
         super().save(*args, **kwargs)
+        # the post_save signal has used the original values by now, so the next save compares with this one
+        self._remember_original()
+
+    def __str__(self):
+        return f'SKU {self.product.sku} on order {self.order.order_number}'
+
+# A stripe webhook event waiting to be handled by the webhook workers
+"""
+When the STRIPE_WH_QUEUE setting is on, the webhook view only verifies the signature of an event,
+stores it here and answers stripe straight away, so the time stripe waits for us doesn't depend
+on how big the order is. The process_webhooks management command then handles the stored events
+in the background, retrying the ones that fail with an increasing delay.
+"""
+class WebhookEvent(models.Model):
+    PENDING = 'pending'
+    PROCESSING = 'processing'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (PROCESSING, 'Processing'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    # stripe can send the same event more than once, so its id is unique and a repeated one is only stored once
+    event_id = models.CharField(max_length=254, unique=True)
+    event_type = models.CharField(max_length=254)
+    # the verified JSON body of the event exactly as stripe sent it
+    payload = models.TextField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    # when the event is next due to be handled, pushed further back after every failed attempt
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    # when a worker took the event, so an event left behind by a worker that died can be taken again
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True, default='')
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        # the workers look for the events that are due, oldest first
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='webhookevent_due_idx'),
+        ]
 
     def __str__(self):
-        return f'SKU {self.product.sku} on order {self.order.order_number}'
\ No newline at end of file
+        return f'{self.event_type} {self.event_id} ({self.status})'
@@ -0,0 +1,72 @@
+# Turning a shopping bag into an order
+
+"""
+Both the checkout view and the stripe webhook handler create orders from a shopping bag,
+the view from the bag in the session and the webhook from the bag stored in the payment intent metadata.
+They both go through build_order() below, so there's a single code path to profile and optimize.
+"""
+
+from django.db import IntegrityError, transaction
+
+from .models import Order, OrderLineItem
+from products.models import Product
+from products.snapshots import get_product_snapshots
+
+
+def build_order(order, bag):
+    """
+    Save the order together with a line item for everything in the bag
+    and return it with its totals calculated.
+    Raises Product.DoesNotExist if a product in the bag isn't in the database,
+    in which case nothing is saved.
+    """
+    # create the order and all its line items in a single transaction,
+    # so if a product isn't found nothing is left behind in the database
+    with transaction.atomic():
+        order.save()
+        # get the prices of all the products in the bag with a single query, if they aren't in the snapshot cache
+        products = get_product_snapshots(bag)
+        # then iterate through the bag items to build each line item; code like that in the context processor
+        line_items = []
+        for item_id, item_data in bag.items():
+            product = products.get(int(item_id))
+            if product is None:
+                raise Product.DoesNotExist(f'Product {item_id} in the bag was not found')
+            # if its value is an integer we know we're working with an item that doesn't have sizes
+            # so the quantity is just the item_data, otherwise there's a line item for each size
+            if isinstance(item_data, int):
+                sizes = {None: item_data}
+            else:
+                sizes = item_data['items_by_size']
+            for size, quantity in sizes.items():
+                line_items.append(OrderLineItem(
+                    order=order,
+                    product_id=product.id,
+                    quantity=quantity,
+                    product_size=size,
+                    # bulk_create doesn't call OrderLineItem.save() so set the total here
+                    lineitem_total=product.price * quantity,
+                ))
+        # insert all the line items at once; bulk_create doesn't send the post_save signal
+        # so the order totals are updated just once after all of them are in
+        OrderLineItem.objects.bulk_create(line_items)
+        order.update_total()
+    return order
+
+
+def get_or_build_order(order, bag):
+    """
+    Return the order with the same stripe_pid as the given one, building it from the bag
+    if there isn't one yet, along with whether it was created.
+    """
+    # stripe_pid is unique and indexed so this is a single index lookup
+    if order.stripe_pid:
+        existing = Order.objects.filter(stripe_pid=order.stripe_pid).first()
+        if existing is not None:
+            return existing, False
+    try:
+        return build_order(order, bag), True
+    except IntegrityError:
+        # the checkout view and the webhook handler created the order at the same time
+        # and the other one got there first, so use that one
+        return Order.objects.get(stripe_pid=order.stripe_pid), False
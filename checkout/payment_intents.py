@@ -0,0 +1,163 @@
+# Reusing the payment intent of a checkout
+
+"""
+Every visit to the checkout page used to create a new payment intent on stripe, even a page refresh,
+which is a round trip to stripe each time and leaves the earlier intents behind unused.
+Instead the intent is stored in the session along with a fingerprint of the bag it was created for:
+    1. if the bag hasn't changed, the stored intent is used again without calling stripe at all.
+    2. if the bag has changed, the amount of the stored intent is updated, if it's actually different.
+    3. otherwise, or when the stored intent can't be changed any more, a new intent is created.
+The stored intent is forgotten once the order is placed, see place_order and checkout_success,
+and when an order was created for it anyway, by the webhook when the shopper left before the order was placed.
+How often each of these happens is counted in the cache, see payment_intent_counts().
+
+The sync and the async checkout views both go through payment_intent_steps(), a generator which decides
+what to do and yields the stripe calls it needs, so each view makes them the way it calls stripe:
+    call, client_secret = advance(steps)                 # run the steps up to the first stripe call
+    call, client_secret = advance(steps, result, error)  # send back its result, or the error it raised
+until there's no call left and the client secret is returned.
+"""
+
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+
+from bag.stores import load_bag
+
+from .models import Order
+from .stripe_client import get_stripe_client
+
+import stripe
+
+PAYMENT_INTENT_SESSION_KEY = 'payment_intent'
+
+CREATED = 'created'
+REUSED = 'reused'
+UPDATED = 'updated'
+
+
+def bag_fingerprint(bag):
+    """
+    Return a short hash identifying the contents of a bag
+    """
+    # sort the keys so the same bag always gives the same fingerprint
+    return hashlib.sha256(json.dumps(bag, sort_keys=True).encode()).hexdigest()[:32]
+
+
+def count_payment_intent(action):
+    key = f'checkout:payment_intents:{action}'
+    # add() only sets the counter when it doesn't exist yet, incr() is atomic on every cache backend
+    cache.add(key, 0, timeout=None)
+    cache.incr(key)
+
+
+def payment_intent_counts():
+    """
+    Return how many payment intents have been created, reused and updated
+    """
+    keys = {action: f'checkout:payment_intents:{action}' for action in (CREATED, REUSED, UPDATED)}
+    values = cache.get_many(keys.values())
+    return {action: values.get(key, 0) for action, key in keys.items()}
+
+
+def stored_payment_intent(request, amount):
+    """
+    Return the intent stored in the session, whether it can be used as it is for the current bag,
+    and the fingerprint of the current bag
+    """
+    fingerprint = bag_fingerprint(load_bag(request))
+    stored = request.session.get(PAYMENT_INTENT_SESSION_KEY)
+    # an intent which already has an order has been paid and can't be paid again,
+    # stripe_pid is unique so this is a single index lookup
+    if stored is not None and Order.objects.filter(stripe_pid=stored['id']).exists():
+        forget_payment_intent(request)
+        stored = None
+    # the amount is compared too, as a price may have changed since the intent was created
+    unchanged = stored is not None and stored['fingerprint'] == fingerprint and stored['amount'] == amount
+    return stored, unchanged, fingerprint
+
+
+def forget_payment_intent(request):
+    request.session.pop(PAYMENT_INTENT_SESSION_KEY, None)
+
+
+def remember_payment_intent(request, intent, fingerprint, action):
+    """
+    Store the intent in the session for the bag with the given fingerprint and count what was done
+    """
+    request.session[PAYMENT_INTENT_SESSION_KEY] = {
+        'id': intent['id'],
+        'client_secret': intent['client_secret'],
+        'amount': intent['amount'],
+        'fingerprint': fingerprint,
+    }
+    count_payment_intent(action)
+
+
+def payment_intent_steps(request, amount):
+    """
+    Return the client secret of a payment intent for the amount of the bag,
+    asking for a stripe call only when there isn't a suitable intent in the session already.
+    A generator yielding each stripe call as a (payment intents method, arguments, params) tuple, see advance()
+    """
+    stored, unchanged, fingerprint = stored_payment_intent(request, amount)
+    if unchanged:
+        count_payment_intent(REUSED)
+        return stored['client_secret']
+
+    intent, action = None, CREATED
+    if stored is not None:
+        if stored['amount'] == amount:
+            # the bag has changed but not what it costs, so the intent is still right as it is
+            intent, action = stored, REUSED
+        else:
+            try:
+                intent = yield ('update', [stored['id']], {'amount': amount})
+                action = UPDATED
+            except stripe.error.InvalidRequestError:
+                # the intent can't be changed once it's been paid or canceled, so start a new one
+                intent = None
+    if intent is None:
+        intent = yield ('create', [], {
+            'amount': amount,
+            'currency': settings.STRIPE_CURRENCY,
+        })
+    remember_payment_intent(request, intent, fingerprint, action)
+    return intent['client_secret']
+
+
+def advance(steps, result=None, error=None):
+    """
+    Run payment_intent_steps() up to its next stripe call, sending it the result of the previous one
+    or throwing the error it raised. Returns the next call and None, or None and the client secret once done
+    """
+    try:
+        call = steps.throw(error) if error is not None else steps.send(result)
+    except StopIteration as done:
+        # returned rather than raised, as a StopIteration can't come out of the async views' sync_to_async
+        return None, done.value
+    return call, None
+
+
+def make_stripe_call(client, call):
+    method, args, params = call
+    return getattr(client.payment_intents, method)(*args, params=params)
+
+
+def payment_intent_client_secret(request, amount):
+    """
+    Return the client secret of a payment intent for the amount of the bag, calling stripe when it's needed
+    """
+    client = get_stripe_client()
+    steps = payment_intent_steps(request, amount)
+    call, client_secret = advance(steps)
+    while call is not None:
+        result, error = None, None
+        try:
+            result = make_stripe_call(client, call)
+        except stripe.error.InvalidRequestError as e:
+            error = e
+        call, client_secret = advance(steps, result, error)
+    return client_secret
@@ -25,7 +25,42 @@ from django.db.models.signals import post_save, post_delete
 # (since we'll be listening for signals from the OrderLineItem model we'll also need that)
 from django.dispatch import receiver
 
-from .models import OrderLineItem
+from django.conf import settings
+
+from .models import Order, OrderLineItem
+from .totals import defer_order_total
+
+
+"""
+update_total() sums up every line item of the order and saves the whole order, which it does for every line item saved,
+so editing an order with many line items does that many times over.
+With the ORDER_TOTALS_MODE setting set to 'incremental' the order total is instead changed by the difference the line item
+made, see Order.update_total_by. The check_order_totals management command verifies the totals are still right.
+"""
+def update_incrementally(instance, created=False, deleted=False):
+    """
+    Change the order total by the difference the line item made,
+    returning False when the difference isn't known and the total has to be summed up again
+    """
+    if settings.ORDER_TOTALS_MODE != 'incremental':
+        return False
+    if created:
+        old_total, old_order_id = 0, instance.order_id
+    else:
+        old_total, old_order_id = instance._original_lineitem_total, instance._original_order_id
+        if old_total is None or old_order_id is None:
+            return False
+    new_total = 0 if deleted else instance.lineitem_total
+
+    if old_order_id != instance.order_id:
+        # the line item was moved to another order, which only happens by hand, so take it off the old one
+        Order(pk=old_order_id).update_total_by(-old_total)
+        old_total = 0
+    if new_total != old_total:
+        instance.order.update_total_by(new_total - old_total)
+    return True
+
+
 
 # to execute update_on_save() function anytime the post_save signal is sent,
 # use the receiver decorator telling it we're receiving post saved signals from the OrderLineItem model
@@ -40,9 +75,13 @@ def update_on_save(sender, instance, created, **kwargs):
     """
     Update order total on lineitem update/create
     """
+    # inside a defer_order_totals() block the order is only noted, to be recalculated at the end of it
+    if defer_order_total(instance.order_id, instance._original_order_id):
+        return
     # access instance.order (it refers to the order this specific line item is related to)
-    # and call the update_total method on it
-    instance.order.update_total()
+    # and call the update_total method on it, unless the total could be changed by the difference
+    if not update_incrementally(instance, created=created):
+        instance.order.update_total()
 
 # handle updating the totals when a line item is deleted
 @receiver(post_delete, sender=OrderLineItem)
@@ -52,4 +91,7 @@ def update_on_delete(sender, instance, **kwargs):
     """
     # print('!!! Delete signal receive!')
     
-    instance.order.update_total()
\ No newline at end of file
+    if defer_order_total(instance.order_id, instance._original_order_id):
+        return
+    if not update_incrementally(instance, deleted=True):
+        instance.order.update_total()
\ No newline at end of file
@@ -0,0 +1,125 @@
+# The client every request to the stripe API goes through
+
+"""
+The views, the webhook handler and the webhook workers all talk to stripe through get_stripe_client(),
+instead of each of them setting stripe.api_key and using the library's default HTTP client.
+The client is configured once from the settings:
+    - its requests session keeps a pool of connections to stripe open, so a checkout reuses
+      an open connection instead of paying for a new TCP and TLS handshake on every call.
+    - every HTTP call has a timeout, STRIPE_TIMEOUT, so a slow stripe can't hold up a worker indefinitely.
+    - calls failing with a network error, or with a response stripe says can be retried, are tried again
+      up to STRIPE_MAX_NETWORK_RETRIES times by the stripe library, with the idempotency key it adds
+      so a retried create isn't done twice.
+    - STRIPE_API_BASE points it at another server, like a local stub server when testing.
+How long the calls take is recorded per method and path, see stripe_latency().
+"""
+
+import re
+import threading
+import time
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import stripe
+
+_client = None
+_client_lock = threading.Lock()
+
+_latency = {}
+_latency_lock = threading.Lock()
+
+# object ids in the paths, like /v1/payment_intents/pi_3Mtw..., are replaced
+# so all the calls of the same kind are recorded together.
+# Unlike the resource names they always have digits or capitals after the prefix
+OBJECT_ID = re.compile(r'/[a-z]+_(?=[a-z_]*[A-Z0-9])[A-Za-z0-9_]+')
+
+
+def record_latency(method, url, seconds, failed):
+    path = OBJECT_ID.sub('/:id', requests.utils.urlparse(url).path)
+    with _latency_lock:
+        stats = _latency.setdefault(f'{method.upper()} {path}', {
+            'calls': 0, 'failed': 0, 'total': 0.0, 'max': 0.0,
+        })
+        stats['calls'] += 1
+        stats['failed'] += failed
+        stats['total'] += seconds
+        stats['max'] = max(stats['max'], seconds)
+
+
+def stripe_latency():
+    """
+    Return the number of calls to each stripe endpoint, how many of them failed
+    and their total, average and longest durations in seconds
+    """
+    with _latency_lock:
+        return {
+            endpoint: dict(stats, average=stats['total'] / stats['calls'])
+            for endpoint, stats in _latency.items()
+        }
+
+
+class TimedRequestsClient(stripe.RequestsClient):
+    """
+    The stripe requests HTTP client, recording how long every HTTP call takes.
+    The stripe library calls request() once for every attempt, so each retry is recorded as a call of its own
+    and a call that's retried after failing shows up as a failed call followed by another one
+    """
+    def request(self, method, url, headers, post_data=None):
+        start = time.monotonic()
+        failed = True
+        try:
+            response = super().request(method, url, headers, post_data)
+            failed = response[1] >= 500
+            return response
+        finally:
+            record_latency(method, url, time.monotonic() - start, failed)
+
+
+def build_stripe_client():
+    session = requests.Session()
+    # one connection for each request the async views can make at once, kept open between calls
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=settings.STRIPE_MAX_CONCURRENT_REQUESTS,
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return stripe.StripeClient(
+        settings.STRIPE_SECRET_KEY,
+        base_addresses={'api': settings.STRIPE_API_BASE},
+        max_network_retries=settings.STRIPE_MAX_NETWORK_RETRIES,
+        http_client=TimedRequestsClient(timeout=settings.STRIPE_TIMEOUT, session=session),
+    )
+
+
+def get_stripe_client():
+    """
+    Return the stripe client, creating it the first time it's needed
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = build_stripe_client()
+    return _client
+
+
+def set_stripe_client(client):
+    """
+    Replace the stripe client, or with None have it created again from the settings on next use
+    """
+    global _client
+    with _client_lock:
+        _client = client
+
+
+@receiver(setting_changed)
+def reset_stripe_client(setting, **kwargs):
+    # so override_settings(STRIPE_API_BASE=...) in a test points the client at a stub server
+    if setting.startswith('STRIPE_'):
+        set_stripe_client(None)
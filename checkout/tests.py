@@ -1,3 +1,630 @@
-from django.test import TestCase
+import asyncio
+import hashlib
+import hmac
+import json
+import threading
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+from urllib.parse import parse_qs
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import AsyncClient, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import include, path, resolve, reverse
+from django.utils import timezone
+
+from bag.serialization import bag_from_metadata, bag_metadata
+from products.models import Product
+
+from . import async_views, totals
+from .models import Order, OrderLineItem, WebhookEvent
+from .orders import build_order
+from .payment_intents import PAYMENT_INTENT_SESSION_KEY
+from .totals import defer_order_totals
+from .webhook_handler import StripeWH_Handler
+from .webhook_queue import claim_due_events, process_event, run_workers
+
+import stripe
+
+
+class FakeStripe:
+    """
+    A stripe API server on localhost, answering the few calls the checkout makes,
+    which the stripe client is pointed at with the STRIPE_API_BASE setting
+    """
+    def __init__(self):
+        # (method, path, params) of every call received
+        self.calls = []
+        # the payment intents created, by id
+        self.intents = {}
+        # the ids of the intents stripe won't let be changed any more, like a paid one
+        self.frozen = set()
+        # how long every POST takes to answer, in seconds, and the most of them answered at once
+        self.delay = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                fake.record('GET', self.path, {})
+                charge_id = self.path.rsplit('/', 1)[-1]
+                self.reply(200, {
+                    'id': charge_id,
+                    'object': 'charge',
+                    'billing_details': {'email': 'shopper@example.com'},
+                })
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+                params = {key: values[0] for key, values in parse_qs(body).items()}
+                fake.record('POST', self.path, params)
+                with fake.answering():
+                    status, data = fake.payment_intent(self.path, params)
+                self.reply(status, data)
+
+            def reply(self, status, data):
+                content = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def record(self, method, path, params):
+        with self._lock:
+            self.calls.append((method, path, params))
+
+    @contextmanager
+    def answering(self):
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(self.delay)
+            yield
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def payment_intent(self, path, params):
+        """
+        Create the payment intent posted to /v1/payment_intents, or update the one posted to /v1/payment_intents/<id>
+        """
+        with self._lock:
+            pid = path.rsplit('/', 1)[-1]
+            if pid == 'payment_intents':
+                pid = f'pi_Fake{len(self.intents) + 1}'
+                self.intents[pid] = {
+                    'id': pid,
+                    'object': 'payment_intent',
+                    'client_secret': f'{pid}_secret_Fake',
+                    'amount': 0,
+                }
+            elif pid not in self.intents:
+                return 404, {'error': {'type': 'invalid_request_error', 'message': f'No such payment_intent: {pid}'}}
+            elif pid in self.frozen:
+                return 400, {'error': {'type': 'invalid_request_error', 'message': 'This PaymentIntent can no longer be updated'}}
+            if 'amount' in params:
+                self.intents[pid]['amount'] = int(params['amount'])
+            return 200, self.intents[pid]
+
+    def calls_to(self, method, prefix):
+        return [call for call in self.calls if call[0] == method and call[1].startswith(prefix)]
+
+
+class FakeStripeMixin:
+    """
+    Runs the tests of a TestCase against a FakeStripe server
+    """
+    fixtures = ['categories', 'products']
+
+    @classmethod
+    def setUpClass(cls):
+        cls.stripe = FakeStripe()
+        cls.stripe.start()
+        cls.stripe_settings = override_settings(
+            STRIPE_API_BASE=cls.stripe.url,
+            STRIPE_SECRET_KEY='sk_test_fake',
+            STRIPE_MAX_NETWORK_RETRIES=0,
+        )
+        cls.stripe_settings.enable()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.stripe_settings.disable()
+        cls.stripe.stop()
+
+    def setUp(self):
+        cache.clear()
+        self.stripe.calls.clear()
+
+    def add_to_bag(self, item_id, quantity=1):
+        self.client.post(reverse('add_to_bag', args=[item_id]), {'quantity': quantity, 'redirect_url': '/'})
+
+
+class FakeStripeTestCase(FakeStripeMixin, TestCase):
+    pass
+
+
+def payment_intent_event(pid, bag, event_id='evt_Fake1'):
+    """
+    Return the payment_intent.succeeded event stripe sends once the bag has been paid for
+    """
+    return {
+        'id': event_id,
+        'object': 'event',
+        'type': 'payment_intent.succeeded',
+        'data': {'object': {
+            'id': pid,
+            'object': 'payment_intent',
+            'latest_charge': 'ch_Fake1',
+            'metadata': dict(bag_metadata(bag), save_info='false', username='AnonymousUser'),
+            'shipping': {
+                'name': 'Shopper',
+                'phone': '1',
+                'address': {
+                    'country': 'IE', 'postal_code': '', 'city': 'Dublin', 'line1': 'Street',
+                    'line2': '', 'state': '',
+                },
+            },
+        }},
+    }
+
+
+class CheckoutViewsTestsMixin:
+    """
+    The checkout views calling stripe, mixed into a FakeStripeTestCase for the sync and for the async views.
+    The checkout reuses the payment intent stored in the session, until it's been paid for
+    """
+    def created(self):
+        return self.stripe.calls_to('POST', '/v1/payment_intents')
+
+    def stored_pid(self):
+        return self.client.session[PAYMENT_INTENT_SESSION_KEY]['id']
+
+    def test_reloading_the_checkout_reuses_the_intent(self):
+        self.add_to_bag(1)
+        first = self.client.get(reverse('checkout')).context['client_secret']
+        second = self.client.get(reverse('checkout')).context['client_secret']
+        self.assertEqual(first, second)
+        self.assertEqual(len(self.created()), 1)
+
+    def test_changing_the_bag_updates_the_amount_of_the_intent(self):
+        self.add_to_bag(1)
+        self.client.get(reverse('checkout'))
+        pid = self.stored_pid()
+        self.add_to_bag(2)
+        self.client.get(reverse('checkout'))
+        self.assertEqual(self.stored_pid(), pid)
+        self.assertEqual(self.stripe.calls_to('POST', f'/v1/payment_intents/{pid}')[-1][2]['amount'],
+                         str(self.stripe.intents[pid]['amount']))
+
+    def test_an_intent_that_cant_be_updated_is_replaced(self):
+        self.add_to_bag(1)
+        self.client.get(reverse('checkout'))
+        pid = self.stored_pid()
+        self.stripe.frozen.add(pid)
+        self.add_to_bag(2)
+        self.client.get(reverse('checkout'))
+        self.assertNotEqual(self.stored_pid(), pid)
+
+    def test_an_intent_with_an_order_is_not_reused(self):
+        # the webhook created the order while the shopper didn't reach the success page
+        self.add_to_bag(1)
+        self.client.get(reverse('checkout'))
+        pid = self.stored_pid()
+        Order.objects.create(full_name='Shopper', email='shopper@example.com', phone_number='1',
+                             country='IE', town_or_city='Dublin', street_address1='Street', stripe_pid=pid)
+        self.add_to_bag(1)
+        response = self.client.get(reverse('checkout'))
+        self.assertNotEqual(self.stored_pid(), pid)
+        self.assertFalse(response.context['client_secret'].startswith(pid + '_'))
+        # the paid intent wasn't touched
+        self.assertEqual(self.stripe.calls_to('POST', f'/v1/payment_intents/{pid}'), [])
+
+    def test_placing_the_order_forgets_the_intent(self):
+        self.add_to_bag(1)
+        client_secret = self.client.get(reverse('checkout')).context['client_secret']
+        response = self.client.post(reverse('checkout'), {
+            'full_name': 'Shopper', 'email': 'shopper@example.com', 'phone_number': '1', 'country': 'IE',
+            'postcode': '', 'town_or_city': 'Dublin', 'street_address1': 'Street', 'street_address2': '',
+            'county': '', 'client_secret': client_secret,
+        })
+        self.assertEqual(response.status_code, 302)
+        self.assertNotIn(PAYMENT_INTENT_SESSION_KEY, self.client.session)
+
+    def test_intent_is_for_the_grand_total(self):
+        self.add_to_bag(1, quantity=2)
+        self.client.get(reverse('checkout'))
+        grand_total = self.client.get(reverse('view_bag')).context['grand_total']()
+        self.assertEqual(self.stripe.intents[self.stored_pid()]['amount'], round(grand_total * 100))
+        self.assertEqual(self.created()[0][2]['currency'], settings.STRIPE_CURRENCY)
+
+    def test_empty_bag_doesnt_call_stripe(self):
+        response = self.client.get(reverse('checkout'))
+        self.assertRedirects(response, reverse('products'), fetch_redirect_response=False)
+        self.assertEqual(self.stripe.calls, [])
+
+    def test_cache_checkout_data_adds_the_bag_to_the_intent(self):
+        self.add_to_bag(1, quantity=2)
+        client_secret = self.client.get(reverse('checkout')).context['client_secret']
+        response = self.client.post(reverse('cache_checkout_data'), {
+            'client_secret': client_secret, 'save_info': 'true',
+        })
+        self.assertEqual(response.status_code, 200)
+        params = self.stripe.calls_to('POST', f'/v1/payment_intents/{self.stored_pid()}')[-1][2]
+        self.assertEqual(bag_from_metadata({
+            key[len('metadata['):-1]: value for key, value in params.items() if key.startswith('metadata[')
+        }), {'1': 2})
+        self.assertEqual(params['metadata[save_info]'], 'true')
+
+    def test_cache_checkout_data_stripe_error_is_a_400(self):
+        self.add_to_bag(1)
+        response = self.client.post(reverse('cache_checkout_data'), {'client_secret': 'pi_Unknown_secret_Fake'})
+        self.assertEqual(response.status_code, 400)
+
+
+class SyncCheckoutViewsTests(CheckoutViewsTestsMixin, FakeStripeTestCase):
+    pass
+
+
+# the site's urls with the checkout served by the async views, like CHECKOUT_ASYNC_VIEWS does
+urlpatterns = [
+    path('checkout/', async_views.checkout, name='checkout'),
+    path('checkout/cache_checkout_data/', async_views.cache_checkout_data, name='cache_checkout_data'),
+    path('', include('boutique_ado.urls')),
+]
+
+
+# the test client runs the async views in an event loop of their own, stripe calls in the stripe thread pool included
+@override_settings(ROOT_URLCONF='checkout.tests')
+class AsyncCheckoutViewsTests(CheckoutViewsTestsMixin, FakeStripeTestCase):
+
+    def test_async_views_are_used(self):
+        self.assertIs(resolve(reverse('checkout')).func, async_views.checkout)
+
+    def test_checkouts_wait_for_stripe_at_the_same_time(self):
+        # every middleware is async capable, so no checkout holds django's sync thread while stripe answers
+        shoppers = []
+        for _ in range(5):
+            self.client = self.client_class()
+            self.add_to_bag(1)
+            shopper = AsyncClient()
+            shopper.cookies = self.client.cookies
+            shoppers.append(shopper)
+
+        async def checkout_together():
+            return await asyncio.gather(*(shopper.get(reverse('checkout')) for shopper in shoppers))
+
+        self.stripe.delay = 0.5
+        self.stripe.max_in_flight = 0
+        try:
+            responses = async_to_sync(checkout_together)()
+        finally:
+            self.stripe.delay = 0
+        self.assertEqual([response.status_code for response in responses], [200] * 5)
+        self.assertEqual(self.stripe.max_in_flight, 5)
+
+
+class WebhookHandlerTests(FakeStripeTestCase):
+    """
+    The webhook handler only asks stripe for the billing details of an order it has to create
+    """
+    def handle(self, pid, bag):
+        event = stripe.Event.construct_from(payment_intent_event(pid, bag), 'sk_test_fake')
+        return StripeWH_Handler(None).handle(event)
+
+    def test_existing_order_doesnt_call_stripe(self):
+        Order.objects.create(full_name='Shopper', email='shopper@example.com', phone_number='1',
+                             country='IE', town_or_city='Dublin', street_address1='Street', stripe_pid='pi_Paid')
+        response = self.handle('pi_Paid', {'1': 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'already in database', response.content)
+        self.assertEqual(self.stripe.calls, [])
+
+    def test_missing_order_is_created_with_the_billing_email(self):
+        response = self.handle('pi_Paid', {'1': 2})
+        self.assertIn(b'Created order', response.content)
+        self.assertEqual(len(self.stripe.calls_to('GET', '/v1/charges/ch_Fake1')), 1)
+        order = Order.objects.get(stripe_pid='pi_Paid')
+        self.assertEqual(order.email, 'shopper@example.com')
+        self.assertEqual(order.lineitems.get().quantity, 2)
+
+
+class CheckoutSuccessQueryTests(TestCase):
+    """
+    The success page runs the same number of queries however many line items the order has
+    """
+    fixtures = ['categories', 'products']
+
+    def setUp(self):
+        cache.clear()
+
+    def order_with_lines(self, count):
+        order = Order(full_name='Shopper', email='shopper@example.com', phone_number='1',
+                      country='IE', town_or_city='Dublin', street_address1='Street')
+        return build_order(order, {str(item_id): 1 for item_id in range(1, count + 1)})
+
+    def success_queries(self, order):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('checkout_success', args=[order.order_number]))
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_constant_number_of_queries(self):
+        # the first request creates the session, so warm it up first
+        self.success_queries(self.order_with_lines(1))
+        counts = [self.success_queries(self.order_with_lines(count)) for count in (1, 5, 20)]
+        self.assertEqual(counts, [counts[0]] * 3)
+
+
+@override_settings(STRIPE_WH_QUEUE=True, STRIPE_WH_SECRET='whsec_fake', STRIPE_WH_RETRY_DELAY=5,
+                   STRIPE_WH_MAX_RETRY_DELAY=60, STRIPE_WH_MAX_ATTEMPTS=3, STRIPE_WH_LOCK_TIMEOUT=60)
+class WebhookQueueTests(FakeStripeMixin, TransactionTestCase):
+    """
+    Verified events are queued once, retried with a growing delay and taken over from a worker that died.
+    A TransactionTestCase, as the workers have database connections of their own
+    """
+    def send(self, event, secret='whsec_fake'):
+        """
+        Post the event to the webhook view signed the way stripe signs it
+        """
+        payload = json.dumps(event)
+        timestamp = int(time.time())
+        signature = hmac.new(secret.encode(), f'{timestamp}.{payload}'.encode(), hashlib.sha256).hexdigest()
+        return self.client.post(
+            reverse('webhook'), payload, content_type='application/json',
+            HTTP_STRIPE_SIGNATURE=f't={timestamp},v1={signature}',
+        )
+
+    def make_due(self, webhook_event):
+        WebhookEvent.objects.filter(pk=webhook_event.pk).update(next_attempt_at=timezone.now())
+
+    def test_event_is_queued_once(self):
+        event = payment_intent_event('pi_Paid', {'1': 2})
+        response = self.send(event)
+        self.assertContains(response, '| queued')
+        response = self.send(event)
+        self.assertContains(response, 'already queued')
+        self.assertEqual(WebhookEvent.objects.count(), 1)
+        # nothing is handled until a worker takes it
+        self.assertFalse(Order.objects.exists())
+
+    def test_badly_signed_event_isnt_queued(self):
+        response = self.send(payment_intent_event('pi_Paid', {'1': 2}), secret='whsec_other')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(WebhookEvent.objects.exists())
+
+    def test_worker_creates_the_order(self):
+        self.send(payment_intent_event('pi_Paid', {'1': 2}))
+        self.assertEqual(run_workers(workers=1, once=True), (1, 0))
+        webhook_event = WebhookEvent.objects.get()
+        self.assertEqual(webhook_event.status, WebhookEvent.DONE)
+        self.assertEqual(webhook_event.attempts, 1)
+        self.assertIsNone(webhook_event.locked_at)
+        self.assertTrue(Order.objects.filter(stripe_pid='pi_Paid').exists())
+
+    def test_claimed_event_isnt_claimed_again(self):
+        self.send(payment_intent_event('pi_Paid', {'1': 2}))
+        self.assertEqual(len(claim_due_events(10)), 1)
+        self.assertEqual(claim_due_events(10), [])
+
+    def test_failing_event_is_retried_with_backoff_then_failed(self):
+        # a product which isn't in the database makes the handler fail
+        self.send(payment_intent_event('pi_Paid', {'99999': 1}))
+        delays = []
+        for attempt in range(1, 4):
+            before = timezone.now()
+            webhook_event, = claim_due_events(10)
+            self.assertFalse(process_event(webhook_event))
+            webhook_event.refresh_from_db()
+            self.assertEqual(webhook_event.attempts, attempt)
+            self.assertIn('ERROR', webhook_event.last_error)
+            if attempt < 3:
+                self.assertEqual(webhook_event.status, WebhookEvent.PENDING)
+                delays.append(round((webhook_event.next_attempt_at - before).total_seconds()))
+                # not due yet
+                self.assertEqual(claim_due_events(10), [])
+                self.make_due(webhook_event)
+        self.assertEqual(delays, [5, 10])
+        self.assertEqual(webhook_event.status, WebhookEvent.FAILED)
+        self.assertEqual(claim_due_events(10), [])
+
+    def test_stale_lock_is_taken_over(self):
+        self.send(payment_intent_event('pi_Paid', {'1': 2}))
+        webhook_event, = claim_due_events(10)
+        # the worker holding it is still within the lock timeout
+        self.assertEqual(claim_due_events(10), [])
+        # then it dies without releasing it
+        WebhookEvent.objects.filter(pk=webhook_event.pk).update(locked_at=timezone.now() - timedelta(seconds=61))
+        taken, = claim_due_events(10)
+        self.assertEqual(taken.pk, webhook_event.pk)
+        self.assertGreater(taken.locked_at, webhook_event.locked_at)
+        self.assertTrue(process_event(taken))
+
+
+@override_settings(ORDER_TOTALS_MODE='incremental')
+class IncrementalOrderTotalsTests(TestCase):
+    """
+    The totals changed by the difference every line item makes come out exactly like a full recalculation,
+    and check_order_totals finds and fixes the ones which don't
+    """
+    fixtures = ['categories', 'products']
+
+    def setUp(self):
+        cache.clear()
+        # 16.99, so a single one is under FREE_DELIVERY_THRESHOLD and its delivery has to be rounded
+        self.cheap = Product.objects.get(pk=122)
+        self.order = self.new_order()
+
+    def new_order(self):
+        return Order.objects.create(full_name='Shopper', email='shopper@example.com', phone_number='1',
+                                    country='IE', town_or_city='Dublin', street_address1='Street')
+
+    def assertTotalsMatchAggregate(self, order):
+        order = Order.objects.get(pk=order.pk)
+        stored = (order.order_total, order.delivery_cost, order.grand_total)
+        with self.settings(ORDER_TOTALS_MODE='aggregate'):
+            order.update_total()
+        order.refresh_from_db()
+        self.assertEqual(stored, (order.order_total, order.delivery_cost, order.grand_total))
+        return stored
+
+    def test_create_edit_and_delete(self):
+        line = OrderLineItem.objects.create(order=self.order, product=self.cheap, quantity=1)
+        self.assertEqual(self.assertTotalsMatchAggregate(self.order),
+                         (Decimal('16.99'), Decimal('1.70'), Decimal('18.69')))
+        OrderLineItem.objects.create(order=self.order, product_id=1, quantity=2)
+        self.assertTotalsMatchAggregate(self.order)
+        line.quantity = 3
+        line.save()
+        self.assertTotalsMatchAggregate(self.order)
+        # back under the threshold
+        self.order.lineitems.exclude(pk=line.pk).delete()
+        line.quantity = 2
+        line.save()
+        self.assertEqual(self.assertTotalsMatchAggregate(self.order),
+                         (Decimal('33.98'), Decimal('3.40'), Decimal('37.38')))
+        line.delete()
+        self.assertEqual(self.assertTotalsMatchAggregate(self.order), (0, 0, 0))
+
+    def test_moving_a_line_item_to_another_order(self):
+        line = OrderLineItem.objects.create(order=self.order, product=self.cheap, quantity=2)
+        OrderLineItem.objects.create(order=self.order, product_id=1, quantity=1)
+        other = self.new_order()
+        line = OrderLineItem.objects.get(pk=line.pk)
+        line.order = other
+        line.save()
+        self.assertTotalsMatchAggregate(self.order)
+        self.assertEqual(self.assertTotalsMatchAggregate(other),
+                         (Decimal('33.98'), Decimal('3.40'), Decimal('37.38')))
+
+    def test_check_order_totals_reports_and_fixes_a_wrong_total(self):
+        OrderLineItem.objects.create(order=self.order, product=self.cheap, quantity=1)
+        call_command('check_order_totals', stdout=StringIO())
+        Order.objects.filter(pk=self.order.pk).update(grand_total=Decimal('99.99'))
+
+        out = StringIO()
+        with self.assertRaises(CommandError):
+            call_command('check_order_totals', stdout=out)
+        self.assertIn(self.order.order_number, out.getvalue())
+
+        out = StringIO()
+        call_command('check_order_totals', '--fix', stdout=out)
+        self.assertIn('1 fixed', out.getvalue())
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.grand_total, Decimal('18.69'))
+        call_command('check_order_totals', stdout=StringIO())
+
+
+class DeferOrderTotalsTests(TestCase):
+    """
+    The totals recalculated at the end of a defer_order_totals() block are the ones the signals would have saved
+    """
+    fixtures = ['categories', 'products']
+
+    def setUp(self):
+        cache.clear()
+
+    def new_order(self):
+        return Order.objects.create(full_name='Shopper', email='shopper@example.com', phone_number='1',
+                                    country='IE', town_or_city='Dublin', street_address1='Street')
+
+    def add_lines(self, order):
+        # under FREE_DELIVERY_THRESHOLD so the delivery is rounded too
+        OrderLineItem.objects.create(order=order, product_id=122, quantity=1)
+        OrderLineItem.objects.create(order=order, product_id=12, quantity=1)
+
+    def stored_totals(self, order):
+        order = Order.objects.get(pk=order.pk)
+        return order.order_total, order.delivery_cost, order.grand_total
+
+    def test_deferred_totals_are_the_immediate_ones(self):
+        immediate = self.new_order()
+        self.add_lines(immediate)
+        deferred = self.new_order()
+        with defer_order_totals():
+            self.add_lines(deferred)
+            # nothing is recalculated until the block ends
+            self.assertEqual(self.stored_totals(deferred), (0, 0, 0))
+        self.assertEqual(self.stored_totals(deferred), self.stored_totals(immediate))
+        self.assertEqual(self.stored_totals(deferred), (Decimal('36.98'), Decimal('3.70'), Decimal('40.68')))
+
+    def test_the_outermost_block_recalculates(self):
+        order = self.new_order()
+        with defer_order_totals():
+            with defer_order_totals():
+                self.add_lines(order)
+            self.assertEqual(self.stored_totals(order), (0, 0, 0))
+        self.assertEqual(self.stored_totals(order)[0], Decimal('36.98'))
+
+    def test_an_exception_leaves_nothing_behind(self):
+        order = self.new_order()
+        with self.assertRaises(ValueError):
+            with defer_order_totals():
+                self.add_lines(order)
+                raise ValueError
+        # the line items were rolled back and nothing was recalculated
+        self.assertFalse(order.lineitems.exists())
+        self.assertEqual(self.stored_totals(order), (0, 0, 0))
+        # nor is anything left pending, so the next line item updates the totals straight away
+        self.assertIsNone(totals._deferred.order_ids)
+        OrderLineItem.objects.create(order=order, product_id=122, quantity=1)
+        self.assertEqual(self.stored_totals(order)[0], Decimal('16.99'))
+
+    def test_admin_inlines_update_the_order_once(self):
+        order = self.new_order()
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        data = {
+            'full_name': 'Shopper', 'email': 'shopper@example.com', 'phone_number': '1', 'country': 'IE',
+            'postcode': '', 'town_or_city': 'Dublin', 'street_address1': 'Street', 'street_address2': '',
+            'county': '',
+            'lineitems-TOTAL_FORMS': '3', 'lineitems-INITIAL_FORMS': '0',
+            'lineitems-MIN_NUM_FORMS': '0', 'lineitems-MAX_NUM_FORMS': '1000',
+        }
+        for number, product_id in enumerate((122, 12, 1)):
+            data.update({
+                f'lineitems-{number}-product': str(product_id),
+                f'lineitems-{number}-quantity': '1',
+                f'lineitems-{number}-product_size': '',
+            })
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('admin:checkout_order_change', args=[order.pk]), data)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(order.lineitems.count(), 3)
+        # the order form saving the order, then the totals recalculated once for all three line items
+        order_updates = [query for query in queries if query['sql'].startswith('UPDATE "checkout_order"')]
+        self.assertEqual(len(order_updates), 2)
+        immediate = self.new_order()
+        for product_id in (122, 12, 1):
+            OrderLineItem.objects.create(order=immediate, product_id=product_id, quantity=1)
+        self.assertEqual(self.stored_totals(order), self.stored_totals(immediate))
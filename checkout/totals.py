@@ -0,0 +1,75 @@
+# Recalculating the order totals for many line items at once
+
+"""
+Every line item saved or deleted updates the totals of its order straight away, see checkout/signals.py.
+When many line items are changed together, like all the inlines of an order saved in the admin
+or a batch of line items imported, that's one update of the order for every line item.
+Inside a defer_order_totals() block the signals only note which orders were changed instead,
+and when the block ends all of them are recalculated at once with recalculate_order_totals().
+"""
+
+import threading
+from contextlib import contextmanager
+
+from django.db import transaction
+from django.db.models import Sum
+
+from .models import Order, OrderLineItem
+
+_deferred = threading.local()
+
+
+def recalculate_order_totals(order_ids):
+    """
+    Recalculate the totals of the orders with the given ids from their line items,
+    with one query summing up the line items of all of them and one query updating them all
+    """
+    order_ids = set(order_ids)
+    if not order_ids:
+        return
+    sums = dict(
+        OrderLineItem.objects.filter(order_id__in=order_ids)
+        .values('order_id').annotate(total=Sum('lineitem_total'))
+        .values_list('order_id', 'total')
+    )
+    orders = list(Order.objects.filter(pk__in=order_ids).only('pk'))
+    for order in orders:
+        # the same calculation as Order.update_total, so the totals come out exactly the same
+        order.order_total = sums.get(order.pk) or 0
+        order.delivery_cost, order.grand_total = order._calculate_delivery(order.order_total)
+    Order.objects.bulk_update(orders, ['order_total', 'delivery_cost', 'grand_total'])
+
+
+def defer_order_total(*order_ids):
+    """
+    Note the orders to recalculate at the end of the current defer_order_totals() block,
+    returning False when there isn't one and the totals have to be updated now
+    """
+    pending = getattr(_deferred, 'order_ids', None)
+    if pending is None:
+        return False
+    pending.update(order_id for order_id in order_ids if order_id is not None)
+    return True
+
+
+@contextmanager
+def defer_order_totals():
+    """
+    Recalculate the totals of the orders whose line items are saved or deleted in the block
+    just once for each order, when the block ends
+    """
+    if getattr(_deferred, 'order_ids', None) is not None:
+        # the outermost block recalculates everything
+        yield
+        return
+
+    _deferred.order_ids = set()
+    try:
+        # the block runs in a transaction so the totals are never left out of date:
+        # either the changes and the recalculated totals are saved together or neither of them is
+        with transaction.atomic():
+            yield
+            order_ids, _deferred.order_ids = _deferred.order_ids, None
+            recalculate_order_totals(order_ids)
+    finally:
+        _deferred.order_ids = None
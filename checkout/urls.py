@@ -1,14 +1,22 @@
+from django.conf import settings
 from django.urls import path
 from . import views
 
+# when the site is served with ASGI the views calling stripe can be the async ones,
+# which don't hold up a worker while waiting for stripe
+if settings.CHECKOUT_ASYNC_VIEWS:
+    from . import async_views as stripe_views
+else:
+    stripe_views = views
+
 # as the webhook function live in checkout/webhooks.py file 
 # import the webhook function from .webhooks
 from .webhooks import webhook
 
 urlpatterns = [
-    path('', views.checkout, name='checkout'),
+    path('', stripe_views.checkout, name='checkout'),
     path('checkout_success/<order_number>', views.checkout_success, name='checkout_success'),
-    path('cache_checkout_data/', views.cache_checkout_data, name='cache_checkout_data'),
+    path('cache_checkout_data/', stripe_views.cache_checkout_data, name='cache_checkout_data'),
     # to get webhook handler listening we need create a url for it
     # call this path 'wh/' and it will return a function called webhook with the name of webhook
     path('wh/', webhook, name='webhook'),
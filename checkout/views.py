@@ -2,16 +2,20 @@ from django.shortcuts import render, redirect, reverse, get_object_or_404, HttpR
 from django.views.decorators.http import require_POST
 from django.contrib import messages
 from django.conf import settings
+from django.db.models import Prefetch
 
 from .forms import OrderForm
 from .models import Order, OrderLineItem
+from .orders import get_or_build_order
+from .payment_intents import forget_payment_intent, payment_intent_client_secret
+from .stripe_client import get_stripe_client
 from products.models import Product
 # import the bag_contents() as a function to calculate the current bag total in the view
 # what is needed to call the confirmCardPayment method from stripe js
 from bag.contexts import bag_contents
-
-import stripe
-import json
+from bag.serialization import bag_metadata, encode_bag
+from bag.operations import clear_bag
+from bag.stores import get_cart, load_bag, update_bag
 
 """ Stripe works with what are called payment intents.
 The process: when a user hits the checkout page
@@ -25,6 +29,31 @@ and this secret will be returned to us and we'll send it to the template as the
         we can do it from the server-side by adding that to the payment intent in a key called metadata,
         in our cache_checkout_data view
 """
+def payment_intent_metadata(request):
+    """
+    Return the payment intent id from the posted client secret
+    and the metadata cache_checkout_data adds to the payment intent
+    """
+    # store payment intent id as pid variable
+    pid = request.POST.get('client_secret').split('_secret')[0]
+    """ pass customer information through a stripe PaymentIntent as metadata to ensure that 
+        all orders are entered into our database even in the event of a user error during the checkout process """
+    metadata = {
+        # add the bag to the metadata in its compact format, split over more keys if it's too long for one
+        **bag_metadata(load_bag(request)),
+        # add the user who's placing the order whether or not they wanted to save their information
+        'save_info': request.POST.get('save_info'),
+        'username': str(request.user),
+    }
+    return pid, metadata
+
+
+def payment_error(request, e):
+    messages.error(request, 'Sorry, your payment cannot be \
+        processed right now. Please try again later.')
+    return HttpResponse(content=e, status=400)
+
+
 # we expect only the post method here as we want to post to this view from JavaScript
 # and if everything goes ok we should get a 200 response.
 @require_POST
@@ -32,148 +61,104 @@ and this secret will be returned to us and we'll send it to the template as the
 # and give it the client secret from the payment intent.
 def cache_checkout_data(request):
     try:
-        # store payment intent id as pid variable
-        pid = request.POST.get('client_secret').split('_secret')[0]
-        # set up stripe with the secret key
-        stripe.api_key = settings.STRIPE_SECRET_KEY
-        """ pass customer information through a stripe PaymentIntent as metadata to ensure that 
-            all orders are entered into our database even in the event of a user error during the checkout process """
-        # we can modify the payment intent calling: stripe.PaymentIntent.modify,
+        pid, metadata = payment_intent_metadata(request)
+        # we can modify the payment intent calling payment_intents.update on the stripe client, see checkout/stripe_client.py,
         # give it the pid, and tell it what we want to modify in this case add metadata
-        stripe.PaymentIntent.modify(pid, metadata={
-            # add the bag to the metadata by adding a JSON dump of user shopping bag
-            'bag': json.dumps(request.session.get('bag', {})),
-            # add the user who's placing the order whether or not they wanted to save their information
-            'save_info': request.POST.get('save_info'),
-            'username': request.user,
-        })
+        get_stripe_client().payment_intents.update(pid, params={'metadata': metadata})
         return HttpResponse(status=200)
     except Exception as e:
-        messages.error(request, 'Sorry, your payment cannot be \
-            processed right now. Please try again later.')
-        return HttpResponse(content=e, status=400)
+        return payment_error(request, e)
 # to access this view create a URL in urls.py and create variables in stripe_elements.js
 
+"""
+The checkout view is split into the steps below so the async version of it in checkout/async_views.py
+can run the same steps, only calling stripe without blocking.
+"""
 
-def checkout(request):
-    # create the payment intent
-    
-    # set variables for the public and secret keys
-    stripe_public_key = settings.STRIPE_PUBLIC_KEY
-    stripe_secret_key = settings.STRIPE_SECRET_KEY
-
+def place_order(request):
     """
     When a user submits their payment information we also create the order in the database
     and redirect them to a success page.
+    Return the redirect and the form, the redirect being None if the form isn't valid.
     """
-    # first check whether the method is POST
-    if request.method == 'POST':
-        # get a shopping bag
-        bag = request.session.get('bag', {})
-
-        # put the form data into a dictionary; fields can come directly from the form.
-        # we skip the save infobox which doesn't have a field on the order model.
-        form_data = {
-            'full_name': request.POST['full_name'],
-            'email': request.POST['email'],
-            'phone_number': request.POST['phone_number'],
-            'country': request.POST['country'],
-            'postcode': request.POST['postcode'],
-            'town_or_city': request.POST['town_or_city'],
-            'street_address1': request.POST['street_address1'],
-            'street_address2': request.POST['street_address2'],
-            'county': request.POST['county'],
-        }
-        # create an instance of the form using the form data
-        order_form = OrderForm(form_data)
-
-        # If the form is valid save the order
-        if order_form.is_valid():
-            # add commit=false to prevent multiple save events from being executed on the database
-            order = order_form.save(commit=False)
-            # get client secret from the checkout page hidden input if the order form is valid 
-            # and split it to get the payment intent id
-            pid = request.POST.get('client_secret').split('_secret')[0]
-            order.stripe_pid = pid
-            # get the shopping bag; add that to the model original_bag by dumping bag to a JSON string.
-            # set it on the order
-            order.original_bag = json.dumps(bag)
-            # then save the order
-            order.save()
-            # then iterate through the bag items to create each line item;code like that in the context processor 
-            for item_id, item_data in bag.items():
-                try:
-                    # get the product ID out of the bag
-                    product = Product.objects.get(id=item_id)
-                    # if its value is an integer we know we're working with an item that doesn't have sizes
-                    if isinstance(item_data, int):
-                        order_line_item = OrderLineItem(
-                            order=order,
-                            product=product,
-                            # as an item that doesn't have sizes the quantity is just the item_data
-                            quantity=item_data,
-                        )
-                        order_line_item.save()
-                    else:
-                        # if the item has sizes iterate through each size and create a line item accordingly
-                        for size, quantity in item_data['items_by_size'].items():
-                            order_line_item = OrderLineItem(
-                                order=order,
-                                product=product,
-                                quantity=quantity,
-                                product_size=size,
-                            )
-                            order_line_item.save()
-                # if a product isn't found
-                except Product.DoesNotExist:
-                    messages.error(request, (
-                        "One of the products in your bag wasn't found in our database. "
-                        "Please call us for assistance!")
-                    )
-                    # delete the empty order
-                    order.delete()
-                    # return the user to the shopping bag page
-                    return redirect(reverse('view_bag'))
-
-            # whether or not the user wanted to save their profile information to the session
-            request.session['save_info'] = 'save-info' in request.POST
-            return redirect(reverse('checkout_success', args=[order.order_number]))
-        else:
-            messages.error(request, 'There was an error with your form. \
-                Please double check your information.')
-
-    # else handle the GET requests
-    else:
-        # get the bag from the session
-        bag = request.session.get('bag', {})
-        if not bag:
-            # if there's nothing in the bag add an error message
-            messages.error(request, "There's nothing in your bag at the moment")
-            # and redirect back to the products page
-            # this will prevent people from manually accessing the URL by typing /checkout
-            return redirect(reverse('products'))
-
-        # get Python dictionary as current_bag than not to overwrite the bag variable that already exists
-        current_bag = bag_contents(request)
-        total = current_bag['grand_total']
-        # set stripe_total multiplying total by a hundred and round it to zero decimal places using the round function 
-        # because stripe require the amount to charge as an integer
-        stripe_total = round(total * 100)
-
-        # set the secret key on stripe
-        stripe.api_key = stripe_secret_key
-        # create the payment intent giving it the amount and the currency:
-        intent = stripe.PaymentIntent.create(
-            amount=stripe_total,
-            currency=settings.STRIPE_CURRENCY,
-        )
-
-        # print to the terminal the payment intent which is back from stripe like a dictionary with many keys
-        # print(intent)
-
-        # create an empty instance of OrderForm class
-        order_form = OrderForm()
-
+    # get a shopping bag
+    bag = load_bag(request)
+
+    # put the form data into a dictionary; fields can come directly from the form.
+    # we skip the save infobox which doesn't have a field on the order model.
+    form_data = {
+        'full_name': request.POST['full_name'],
+        'email': request.POST['email'],
+        'phone_number': request.POST['phone_number'],
+        'country': request.POST['country'],
+        'postcode': request.POST['postcode'],
+        'town_or_city': request.POST['town_or_city'],
+        'street_address1': request.POST['street_address1'],
+        'street_address2': request.POST['street_address2'],
+        'county': request.POST['county'],
+    }
+    # create an instance of the form using the form data
+    order_form = OrderForm(form_data)
+
+    # If the form is valid save the order
+    if order_form.is_valid():
+        # add commit=false to prevent multiple save events from being executed on the database
+        order = order_form.save(commit=False)
+        # get client secret from the checkout page hidden input if the order form is valid 
+        # and split it to get the payment intent id
+        pid = request.POST.get('client_secret').split('_secret')[0]
+        order.stripe_pid = pid
+        # get the shopping bag; add that to the model original_bag in its compact format, see bag/serialization.py.
+        # set it on the order
+        order.original_bag = encode_bag(bag)
+        try:
+            # save the order with a line item for each item in the bag, see checkout/orders.py.
+            # If the webhook handler has already created the order for this payment intent use that one
+            order, created = get_or_build_order(order, bag)
+        # if a product isn't found
+        except Product.DoesNotExist:
+            messages.error(request, (
+                "One of the products in your bag wasn't found in our database. "
+                "Please call us for assistance!")
+            )
+            # return the user to the shopping bag page; build_order hasn't saved anything
+            return redirect(reverse('view_bag')), order_form
+
+        # the payment intent is paid now, so a checkout started before the success page is reached needs a new one
+        forget_payment_intent(request)
+        # whether or not the user wanted to save their profile information to the session
+        request.session['save_info'] = 'save-info' in request.POST
+        return redirect(reverse('checkout_success', args=[order.order_number])), order_form
+
+    messages.error(request, 'There was an error with your form. \
+        Please double check your information.')
+    return None, order_form
+
+
+def checkout_amount(request):
+    """
+    Return a redirect to the products page if the bag is empty
+    and otherwise None and the amount to charge for the bag as stripe wants it
+    """
+    # get the bag from the session
+    bag = load_bag(request)
+    if not bag:
+        # if there's nothing in the bag add an error message
+        messages.error(request, "There's nothing in your bag at the moment")
+        # and redirect back to the products page
+        # this will prevent people from manually accessing the URL by typing /checkout
+        return redirect(reverse('products')), None
+
+    # get Python dictionary as current_bag than not to overwrite the bag variable that already exists
+    current_bag = bag_contents(request)
+    total = current_bag['grand_total']
+    # set stripe_total multiplying total by a hundred and round it to zero decimal places using the round function 
+    # because stripe require the amount to charge as an integer
+    return None, round(total * 100)
+
+
+def render_checkout(request, order_form, client_secret):
+    stripe_public_key = settings.STRIPE_PUBLIC_KEY
     if not stripe_public_key:
         messages.warning(request, 'Stripe public key is missing. \
             Did you forget to set it in your environment?')
@@ -186,12 +171,35 @@ def checkout(request):
         # copy the public key from https://dashboard.stripe.com/test/apikeys and put it to the gitpod Environment Variables as STRIPE_PUBLIC_KEY
         'stripe_public_key': stripe_public_key,
         # we'll send a secret created by Stripe to the checkout template as the client_secret variable
-        'client_secret': intent.client_secret,
+        'client_secret': client_secret,
     }
 
     return render(request, template, context)
 
 
+def checkout(request):
+    # first check whether the method is POST
+    if request.method == 'POST':
+        response, order_form = place_order(request)
+        if response is not None:
+            return response
+    # else handle the GET requests
+    else:
+        # create an empty instance of OrderForm class
+        order_form = OrderForm()
+
+    # the checkout page needs a payment intent again when the form wasn't valid, so this is done for both
+    response, stripe_total = checkout_amount(request)
+    if response is not None:
+        return response
+
+    # get a payment intent for the amount, reusing the one already created for this bag
+    # rather than creating a new one every time the page is loaded, see checkout/payment_intents.py
+    client_secret = payment_intent_client_secret(request, stripe_total)
+
+    return render_checkout(request, order_form, client_secret)
+
+
 # take the order number and render a success page letting the user know that their payment is complete.
 def checkout_success(request, order_number):
     """
@@ -199,16 +207,21 @@ def checkout_success(request, order_number):
     """
     # check whether the user wanted to save their information by getting that from the session
     save_info = request.session.get('save_info')
-    # get the order created in the previous view
-    order = get_object_or_404(Order, order_number=order_number)
+    # get the order created in the previous view, along with its line items and their products
+    # in a single query, as the template shows the product of every line item
+    lineitems = Prefetch('lineitems', queryset=OrderLineItem.objects.select_related('product'))
+    order = get_object_or_404(Order.objects.prefetch_related(lineitems), order_number=order_number)
     # attach a success message letting the user know what their order number is
     # and that will be sending an email to the email they put in the form.
     messages.success(request, f'Order successfully processed! \
         Your order number is {order_number}. A confirmation \
         email will be sent to {order.email}.')
-    # delete the user shopping bag from the session since it'll no longer be needed for this session
-    if 'bag' in request.session:
-        del request.session['bag']
+    # delete the user shopping bag from the cart since it'll no longer be needed for this session
+    update_bag(request, clear_bag())
+    # and the bag summary used by the header with it
+    get_cart(request).pop('bag_summary')
+    # the payment intent is paid so the next checkout needs a new one
+    forget_payment_intent(request)
 
     # Set the template and the context
     template = 'checkout/checkout_success.html'
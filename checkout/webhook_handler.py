@@ -16,11 +16,11 @@ from stripe to a URL we specify.
 
 from django.http import HttpResponse
 
-from .models import Order, OrderLineItem
-from products.models import Product
+from .models import Order
+from .orders import get_or_build_order
+from .stripe_client import get_stripe_client
+from bag.serialization import bag_from_metadata, encode_bag
 
-import json
-import time
 
 
 class StripeWH_Handler:
@@ -35,6 +35,24 @@ class StripeWH_Handler:
     # for each type of webhook we want a different method to handle it which makes them easy to manage 
     # and makes it easy to add more as stripe adds new ones
 
+    def handle(self, event):
+        """
+        Pass the event to the method handling its type and return its response.
+        Used by the webhook view and by the workers handling queued events.
+        """
+        # Map webhook events to relevant handler functions
+        # the dictionarie's keys are the names of the webhooks coming from stripe
+        # while its values are the actual methods inside the handler.
+        event_map = {
+            'payment_intent.succeeded': self.handle_payment_intent_succeeded,
+            'payment_intent.payment_failed': self.handle_payment_intent_payment_failed,
+        }
+        # If there's a handler for it, get it from the event_map
+        # Use the generic one by default
+        event_handler = event_map.get(event['type'], self.handle_event)
+        # Call the event_handler with the event
+        return event_handler(event)
+
     # take the event stripe is sending us
     # the generic handle event method here is receiving the webhook we are otherwise not handling
     def handle_event(self, event):
@@ -65,15 +83,26 @@ class StripeWH_Handler:
         # like if the user closes the page on the loading screen
         # get the payment intent id
         pid = intent.id
-        # get shopping bag and the user's save info preference from the metadata added in cache_checkout_data view
-        bag = intent.metadata.bag
+
+        """ Most of the time when a user checks out, everything go well and the form
+            is submitted so the order should already be in our database when we receive this webhook.
+            The stripe_pid of an order is unique, so the payment intent id alone finds it with a single index lookup,
+            and stripe isn't called for the billing details of an order we don't need to create. """
+        # If an order does exists we'll just return a response, and say everything is all set
+        if Order.objects.filter(stripe_pid=pid).exists():
+            return self._order_already_exists(event)
+
+        # get shopping bag and the user's save info preference from the metadata added in cache_checkout_data view.
+        # the bag is in its compact format, and split over more keys when it's long, see bag/serialization.py
+        bag = bag_from_metadata(intent.metadata)
         save_info = intent.metadata.save_info
 
+        # the billing details come from the latest charge of the payment intent
+        stripe_charge = get_stripe_client().charges.retrieve(intent.latest_charge)
+
         #billing_details = intent.charges.data[0].billing_details
         billing_details = stripe_charge.billing_details # updated
         shipping_details = intent.shipping
-        #grand_total = round(intent.charges.data[0].amount / 100, 2)
-        grand_total = round(stripe_charge.amount / 100, 2) # updated
 
         """ Clean data in the shipping details """
         # to ensure the data is in the same form as what we want in the database
@@ -84,111 +113,52 @@ class StripeWH_Handler:
             if value == "":
                 shipping_details.address[field] = None
 
-        """ Most of the time when a user checks out, everything go well and the form
-            is submitted so the order should already be in our database when we receive this webhook.
-            The first thing then is to check if the order exists already. """
-        # assume the order doesn't exist
-        order_exists = False
-
-        # In case if the view is slow for some reason and hasn't created the order by the time we get the webhook from stripe
-        # instead of immediately creating the order if it's not found in the database let's introduce a bit of delay 
-        # create a variable attempt and set it to 1
-        attempt = 1
-        # create a while loop that will execute up to 5 times.
-        while attempt <= 5:
-            # try to get the order using all the information from the payment intent
-            try:
-                order = Order.objects.get(
-                    # use the __iexact lookup field to make it an exact match but case-insensitive
-                    full_name__iexact=shipping_details.name,
-                    email__iexact=billing_details.email,
-                    phone_number__iexact=shipping_details.phone,
-                    country__iexact=shipping_details.address.country,
-                    postcode__iexact=shipping_details.address.postal_code,
-                    town_or_city__iexact=shipping_details.address.city,
-                    street_address1__iexact=shipping_details.address.line1,
-                    street_address2__iexact=shipping_details.address.line2,
-                    county__iexact=shipping_details.address.state,
-                    grand_total=grand_total,
-                    original_bag=bag,
-                    stripe_pid=pid,
-                )
-                order_exists = True
-                break
-            # now instead of creating the order if the order is not found the first time increment attempt by 1
-            # and then use python's time module to sleep for one second, this means that
-            # the webhook handler will try to find the order five times over five seconds 
-            # before giving up and creating the order itself
-            except Order.DoesNotExist:
-                attempt += 1
-                time.sleep(1)
-        # If an order does exists we'll just return a response, and say everything is all set
-        if order_exists:
+        try:
+            # the view may still have created the order since the lookup above, so get the order by its payment intent id,
+            # or create it using all the data from the payment intent,
+            # loading the bag from the payment intent instead of from the session.
+            # see get_or_build_order in checkout/orders.py, which is shared with the checkout view
+            order, created = get_or_build_order(Order(
+                full_name=shipping_details.name,
+                email=billing_details.email,
+                phone_number=shipping_details.phone,
+                country=shipping_details.address.country,
+                postcode=shipping_details.address.postal_code,
+                town_or_city=shipping_details.address.city,
+                street_address1=shipping_details.address.line1,
+                street_address2=shipping_details.address.line2,
+                county=shipping_details.address.state,
+                original_bag=encode_bag(bag),
+                stripe_pid=pid,
+            ), bag)
+        except Exception as e:
+            # if anything goes wrong build_order has rolled back the order and its line items
+            # and return a 500 server error response to stripe,
+            # which cause stripe to automatically try the webhook again later.
             return HttpResponse(
-                content=f'Webhook received: {event["type"]} | SUCCESS: Verified order already in database',
-                status=200)
-        # if an order doesn't exists we'll create it here in the webhook
-        else:
-            order = None
-            try:
-                # create order with Order.objects.create using all the data from the payment intent
-                order = Order.objects.create(
-                    full_name=shipping_details.name,
-                    email=billing_details.email,
-                    phone_number=shipping_details.phone,
-                    country=shipping_details.address.country,
-                    postcode=shipping_details.address.postal_code,
-                    town_or_city=shipping_details.address.city,
-                    street_address1=shipping_details.address.line1,
-                    street_address2=shipping_details.address.line2,
-                    county=shipping_details.address.state,
-                    original_bag=bag,
-                    stripe_pid=pid,
-                )
-                # load the bag from the JSON version in the payment intent instead of from the session
-                for item_id, item_data in json.loads(bag).items():
-                    product = Product.objects.get(id=item_id)
-                    if isinstance(item_data, int):
-                        order_line_item = OrderLineItem(
-                            order=order,
-                            product=product,
-                            quantity=item_data,
-                        )
-                        order_line_item.save()
-                    else:
-                        for size, quantity in item_data['items_by_size'].items():
-                            order_line_item = OrderLineItem(
-                                order=order,
-                                product=product,
-                                quantity=quantity,
-                                product_size=size,
-                            )
-                            order_line_item.save()
-            except Exception as e:
-                # if anything goes wrong delete the order if it was created.
-                if order:
-                    order.delete()
-                # and return a 500 server error response to stripe,
-                # which cause stripe to automatically try the webhook again later.
-                return HttpResponse(
-                    content=f'Webhook received: {event["type"]} | ERROR: {e}',
-                    status=500)
+                content=f'Webhook received: {event["type"]} | ERROR: {e}',
+                status=500)
+
+        if not created:
+            return self._order_already_exists(event)
         # the order have been created by the webhook handler so we should return a response to stripe indicating that
         return HttpResponse(
             content=f'Webhook received: {event["type"]} | SUCCESS: Created order in webhook',
             status=200)
-    """ 
+    """
     If our view is slow for some reason and hasn't created the order by the time we get the webhook from stripe,
-    means that the view will create the order but it might be a few seconds late.
-    This is not good because our webhook handler won't find the order when it first gets the webhook from stripe
-    and will create the order itself resulting in the same order being added to the database twice, 
-    once the view finally finishes.
+    the view and the webhook handler both try to create the same order at once.
     This is, one of the downfalls of asynchronous applications where multiple processes are happening at once.
-    So, instead of just immediately going to create the order if it's not found in the database we introduce 
-    a delay using a variable called attempt. 
+    Rather than waiting a few seconds for the view to finish, the unique stripe_pid lets the database decide:
+    whichever inserts the order second gets an IntegrityError and uses the order the other one created.
     """
 
 
+    def _order_already_exists(self, event):
+        return HttpResponse(
+            content=f'Webhook received: {event["type"]} | SUCCESS: Verified order already in database',
+            status=200)
+
     def handle_payment_intent_payment_failed(self, event):
         """
         Handle the payment_intent.payment_failed webhook from Stripe
@@ -0,0 +1,140 @@
+# The queue of stripe webhook events handled in the background
+
+"""
+With the STRIPE_WH_QUEUE setting on, the webhook view verifies the signature of an event
+and stores it with enqueue_event() instead of creating the order while stripe waits for the response.
+The workers started by the process_webhooks management command then take the events that are due,
+rebuild the stripe event from the stored payload and pass it to StripeWH_Handler, exactly as the view would have.
+An event whose handler fails or doesn't return a 2xx response is tried again later,
+waiting twice as long after every attempt, until STRIPE_WH_MAX_ATTEMPTS is reached.
+"""
+
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import WebhookEvent
+from .webhook_handler import StripeWH_Handler
+
+import stripe
+
+
+def enqueue_event(event, payload):
+    """
+    Store a verified stripe event to be handled by the workers.
+    Return False if an event with the same id was already stored.
+    """
+    if isinstance(payload, bytes):
+        payload = payload.decode('utf-8')
+    # the event id is unique so stripe sending the same event twice, even at the same time, stores it just once
+    webhook_event, created = WebhookEvent.objects.get_or_create(
+        event_id=event['id'],
+        defaults={'event_type': event['type'], 'payload': payload},
+    )
+    return created
+
+
+def claim_due_events(limit):
+    """
+    Take up to limit events which are due to be handled, marking them as being processed
+    so no other worker takes them at the same time
+    """
+    now = timezone.now()
+    stale = now - timedelta(seconds=settings.STRIPE_WH_LOCK_TIMEOUT)
+    due = (
+        Q(status=WebhookEvent.PENDING, next_attempt_at__lte=now)
+        # events held by a worker which died or got stuck
+        | Q(status=WebhookEvent.PROCESSING, locked_at__lt=stale)
+    )
+    candidates = WebhookEvent.objects.filter(due).order_by('next_attempt_at', 'id')
+    claimed = []
+    for event_id, status, locked_at in candidates.values_list('id', 'status', 'locked_at')[:limit]:
+        # only mark the event if it's still in the state we read it in.
+        # if another worker got to it first this updates no rows and the event is left to that worker
+        taken = WebhookEvent.objects.filter(id=event_id, status=status, locked_at=locked_at).update(
+            status=WebhookEvent.PROCESSING, locked_at=now,
+        )
+        if taken:
+            claimed.append(event_id)
+    return list(WebhookEvent.objects.filter(id__in=claimed).order_by('next_attempt_at', 'id'))
+
+
+def retry_delay(attempts):
+    """
+    Return how long to wait before the next attempt after the given number of failed attempts
+    """
+    delay = settings.STRIPE_WH_RETRY_DELAY * 2 ** (attempts - 1)
+    return timedelta(seconds=min(delay, settings.STRIPE_WH_MAX_RETRY_DELAY))
+
+
+def handle_event(webhook_event):
+    """
+    Pass a stored event to StripeWH_Handler, raising an exception if it wasn't handled
+    """
+    # rebuild the same kind of stripe object stripe.Webhook.construct_event returned in the view
+    event = stripe.Event.construct_from(json.loads(webhook_event.payload), settings.STRIPE_SECRET_KEY)
+    # there's no request to pass along as the event doesn't come from one
+    response = StripeWH_Handler(None).handle(event)
+    if not 200 <= response.status_code < 300:
+        raise RuntimeError(response.content.decode('utf-8', 'replace'))
+
+
+def process_event(webhook_event):
+    """
+    Handle one claimed event and record the outcome, scheduling another attempt if it failed.
+    Return True if the event was handled.
+    """
+    try:
+        handle_event(webhook_event)
+    except Exception as e:
+        webhook_event.last_error = str(e)
+        handled = False
+    else:
+        webhook_event.last_error = ''
+        handled = True
+
+    webhook_event.attempts += 1
+    webhook_event.locked_at = None
+    if handled:
+        webhook_event.status = WebhookEvent.DONE
+        webhook_event.processed_at = timezone.now()
+    elif webhook_event.attempts >= settings.STRIPE_WH_MAX_ATTEMPTS:
+        webhook_event.status = WebhookEvent.FAILED
+    else:
+        webhook_event.status = WebhookEvent.PENDING
+        webhook_event.next_attempt_at = timezone.now() + retry_delay(webhook_event.attempts)
+    webhook_event.save()
+    # every worker thread has its own database connection, so don't let it go stale between events
+    close_old_connections()
+    return handled
+
+
+def run_workers(workers=4, poll_interval=1.0, once=False, stop=None):
+    """
+    Handle the queued events with a pool of worker threads until stop is set,
+    or until no event is due when once is True.
+    Return the number of events handled and the number that failed.
+    """
+    if stop is None:
+        stop = threading.Event()
+    handled = failed = 0
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='webhook-worker') as pool:
+        while not stop.is_set():
+            events = claim_due_events(workers)
+            if not events:
+                if once:
+                    break
+                stop.wait(poll_interval)
+                continue
+            for result in pool.map(process_event, events):
+                if result:
+                    handled += 1
+                else:
+                    failed += 1
+    return handled, failed
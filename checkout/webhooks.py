@@ -10,6 +10,8 @@ from django.views.decorators.http import require_POST
 from django.views.decorators.csrf import csrf_exempt
 
 from checkout.webhook_handler import StripeWH_Handler
+from checkout.webhook_queue import enqueue_event
+from checkout.stripe_client import get_stripe_client
 
 import stripe
 
@@ -20,8 +22,6 @@ def webhook(request):
     """Listen for webhooks from Stripe"""
     # setup the webhook secret which will be used to verify that the webhook actually came from stripe
     wh_secret = settings.STRIPE_WH_SECRET
-    # setup the stripe API key
-    stripe.api_key = settings.STRIPE_SECRET_KEY
 
     # Get the webhook data and verify its signature
     payload = request.body
@@ -29,7 +29,9 @@ def webhook(request):
     event = None
 
     try:
-        event = stripe.Webhook.construct_event(
+        # verifying the signature doesn't call stripe, but the event is then tied to the client
+        # for any API calls made from it, see checkout/stripe_client.py
+        event = get_stripe_client().construct_event(
         payload, sig_header, wh_secret
         )
     except ValueError as e:
@@ -42,29 +44,21 @@ def webhook(request):
     except Exception as e:
         return HttpResponse(content=e, status=400)
 
+    # when the webhook queue is on, store the event and let stripe know we got it straight away.
+    # The process_webhooks management command handles it in the background, see checkout/webhook_queue.py
+    if settings.STRIPE_WH_QUEUE:
+        created = enqueue_event(event, payload)
+        status = 'queued' if created else 'already queued'
+        return HttpResponse(content=f'Webhook received: {event["type"]} | {status}', status=200)
+
     """ we can pass the event along to our webhook_handler.py 
     where is a convenient method written up for each type of webhook.
      """
     # Set up a webhook handler
     handler = StripeWH_Handler(request)
 
-    # Map webhook events to relevant handler functions
-    # the dictionarie's keys are the names of the webhooks coming from stripe
-    # while its values are the actual methods inside the handler.
-    event_map = {
-        'payment_intent.succeeded': handler.handle_payment_intent_succeeded,
-        'payment_intent.payment_failed': handler.handle_payment_intent_payment_failed,
-    }
-
-    # Get the webhook type from Stripe
-    event_type = event['type']
-
-    # If there's a handler for it, get it from the event_map
-    # Use the generic one by default
-    event_handler = event_map.get(event_type, handler.handle_event)
-
-    # Call the event_handler with the event
-    response = event_handler(event)
+    # Call the method handling the type of the event; the map of event types is in StripeWH_Handler.handle
+    response = handler.handle(event)
 
     # return the response to stripe
     return response
@@ -0,0 +1,77 @@
+"""
+Time rendering the home and products pages for a shopper with a full bag,
+with the lazy bag context processor the site uses and with the eager bag_contents it replaced,
+which loaded the products of the bag and calculated its totals on every page whether it showed them or not.
+The requests run against a database of their own loaded with the fixture catalog, see boutique_ado/benchmarking.py.
+
+    python3 manage.py benchmark_pages
+    python3 manage.py benchmark_pages --lines 30 --repeat 200
+"""
+
+import copy
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.test import Client, override_settings
+from django.urls import reverse
+
+from boutique_ado.benchmarking import benchmark_database, count_queries, describe, time_calls
+from products.snapshots import clear_product_snapshots
+
+CONTEXT_PROCESSORS = {
+    'lazy': 'bag.contexts.lazy_bag_contents',
+    'eager': 'bag.contexts.bag_contents',
+}
+
+
+def templates_with(context_processor):
+    """
+    Return the TEMPLATES setting with the bag context processor replaced
+    """
+    templates = copy.deepcopy(settings.TEMPLATES)
+    processors = templates[0]['OPTIONS']['context_processors']
+    processors[processors.index(CONTEXT_PROCESSORS['lazy'])] = context_processor
+    return templates
+
+
+class Command(BaseCommand):
+    help = 'Time the home and products pages with the lazy and the eager bag context processor'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--lines', type=int, default=10,
+            help='How many lines the bag has (default: 10)',
+        )
+        parser.add_argument(
+            '--repeat', type=int, default=100,
+            help='How many times each page is timed (default: 100)',
+        )
+
+    def handle(self, *args, **options):
+        with benchmark_database():
+            client = Client()
+            for item_id in range(1, options['lines'] + 1):
+                client.post(reverse('add_to_bag_json', args=[item_id]), {'quantity': 1})
+
+            for name, context_processor in CONTEXT_PROCESSORS.items():
+                with override_settings(TEMPLATES=templates_with(context_processor)):
+                    self.stdout.write(self.style.MIGRATE_HEADING(f'{name} bag context ({options["lines"]} lines)'))
+                    for page in ('home', 'products'):
+                        self.benchmark_page(client, page, options['repeat'])
+
+    def benchmark_page(self, client, page, repeat):
+        url = reverse(page)
+        # the first request fills the caches, like the grid of the products page
+        client.get(url)
+        _, queries = count_queries(lambda: client.get(url))
+        self.stdout.write(f'  {page}: {describe(time_calls(lambda: client.get(url), repeat))}, {queries} queries')
+
+        # and again with the product snapshots loaded on every request, like a shopper the process hasn't seen lately
+        def cold():
+            clear_product_snapshots()
+            client.get(url)
+
+        _, queries = count_queries(cold)
+        self.stdout.write(f'  {page}, no product snapshots: {describe(time_calls(cold, repeat))}, {queries} queries')
+        cache.clear()
@@ -0,0 +1,2 @@
+# point django at ProductsConfig so its ready method connects the signals in products/signals.py
+default_app_config = 'products.apps.ProductsConfig'
@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class ProductsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'products'
+
+    # import the signals module so the caches built from products
+    # are invalidated every time a product is saved or deleted
+    def ready(self):
+        import products.signals
@@ -0,0 +1,55 @@
+# Cache keys and helpers shared by everything that caches data derived from the product catalog
+
+import hashlib
+from uuid import uuid4
+
+from django.core.cache import cache
+
+# the price version is a random token which changes every time a product is saved or deleted,
+# so anything stamped with an older token knows it was calculated from stale prices
+PRICE_VERSION_KEY = 'products:price_version'
+
+
+def get_price_version():
+    """
+    Return the current price version, creating one if the cache doesn't have it yet
+    """
+    # timeout=None keeps the token until it's bumped; if the cache loses it anyway
+    # a new token is created which simply makes every stamped value stale
+    return cache.get_or_set(PRICE_VERSION_KEY, uuid4().hex, timeout=None)
+
+
+def bump_price_version():
+    """
+    Replace the price version so everything stamped with the old one is recalculated
+    """
+    cache.set(PRICE_VERSION_KEY, uuid4().hex, timeout=None)
+
+
+# the catalog version changes every time a product or a category is saved or deleted
+# and is part of the key of everything cached from the product listing
+CATALOG_VERSION_KEY = 'products:catalog_version'
+
+
+def get_catalog_version():
+    """
+    Return the current catalog version, creating one if the cache doesn't have it yet
+    """
+    return cache.get_or_set(CATALOG_VERSION_KEY, uuid4().hex, timeout=None)
+
+
+def bump_catalog_version():
+    """
+    Replace the catalog version so every cached listing value is recalculated
+    """
+    cache.set(CATALOG_VERSION_KEY, uuid4().hex, timeout=None)
+
+
+def listing_cache_key(params):
+    """
+    Return the cache key for a products listing from its normalized parameters,
+    which changes along with the catalog version
+    """
+    # sort the parameters so the same listing always gives the same key
+    digest = hashlib.md5(repr(sorted(params.items())).encode()).hexdigest()
+    return f'{get_catalog_version()}:{digest}'
@@ -0,0 +1,88 @@
+# The categories, kept in the memory of each process
+
+"""
+There are only a handful of categories and they hardly ever change, yet the products listing looked up
+the categories in the url with a query on every request and joined the category of every product it showed.
+get_category_map() returns all of them instead, loaded with a single query the first time it's needed.
+
+The map can't be changed, it's replaced by a new one when a category is saved or deleted:
+products/signals.py drops it once the change is committed, so the next request loads it again,
+and every other process loads it again when it sees the catalog version has changed (see caching.py).
+"""
+
+import threading
+from collections import namedtuple
+from types import MappingProxyType
+
+from django.db import transaction
+
+from .caching import get_catalog_version
+from .models import Category
+
+CategoryEntry = namedtuple('CategoryEntry', ['id', 'name', 'friendly_name'])
+
+
+class CategoryMap:
+    """
+    The categories keyed by id and by name
+    """
+    def __init__(self, categories, catalog_version=None):
+        self.catalog_version = catalog_version
+        self.by_id = MappingProxyType({category.id: category for category in categories})
+        self.by_name = MappingProxyType({category.name: category for category in categories})
+
+    def get(self, category_id):
+        return self.by_id.get(category_id)
+
+    def with_names(self, names):
+        """
+        Return the categories with the given names, in the order of their ids like the table
+        """
+        return sorted(
+            (self.by_name[name] for name in set(names) if name in self.by_name),
+            key=lambda category: category.id,
+        )
+
+
+_map = None
+_map_lock = threading.Lock()
+
+
+def load_category_map():
+    """
+    Load a new map of all the categories from the database
+    """
+    # read the version first, so a category changed while loading makes the map stale rather than the other way round
+    catalog_version = get_catalog_version()
+    categories = [
+        CategoryEntry(*values)
+        for values in Category.objects.order_by('id').values_list('id', 'name', 'friendly_name')
+    ]
+    return CategoryMap(categories, catalog_version)
+
+
+def get_category_map():
+    """
+    Return the map of all the categories, loading it if it's not loaded yet or it's stale
+    """
+    global _map
+    category_map = _map
+    if category_map is None or category_map.catalog_version != get_catalog_version():
+        with _map_lock:
+            # another thread may have loaded it while this one was waiting
+            if _map is category_map:
+                _map = load_category_map()
+            category_map = _map
+    return category_map
+
+
+def _drop_category_map():
+    global _map
+    _map = None
+
+
+def drop_category_map():
+    """
+    Drop the map once the current transaction is committed, so the next request loads the change
+    """
+    transaction.on_commit(_drop_category_map)
@@ -0,0 +1,55 @@
+"""
+Time loading a product detail page three ways: rendered from scratch with the fragment cache empty,
+rendered with the image and the details of the product coming from the fragment cache,
+and answered with a 304 Not Modified to a browser sending back the ETag it was given.
+The requests run against a database of their own loaded with the fixture catalog, see boutique_ado/benchmarking.py.
+
+    python3 manage.py benchmark_product_detail
+    python3 manage.py benchmark_product_detail --product 5 --repeat 500
+"""
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.test import Client
+from django.urls import reverse
+
+from boutique_ado.benchmarking import benchmark_database, count_queries, describe, time_calls
+
+
+class Command(BaseCommand):
+    help = 'Time the product detail page uncached, from the fragment cache and as a conditional GET'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--product', type=int, default=1,
+            help='The id of the product whose page is loaded (default: 1)',
+        )
+        parser.add_argument(
+            '--repeat', type=int, default=200,
+            help='How many times each request is timed (default: 200)',
+        )
+
+    def handle(self, *args, **options):
+        with benchmark_database():
+            client = Client()
+            url = reverse('product_detail', args=[options['product']])
+            etag = client.get(url)['ETag']
+
+            def uncached():
+                cache.clear()
+                return client.get(url)
+
+            requests = {
+                'uncached render': uncached,
+                'cached fragments': lambda: client.get(url),
+                'conditional GET': lambda: client.get(url, HTTP_IF_NONE_MATCH=etag),
+            }
+            self.stdout.write(self.style.MIGRATE_HEADING(f'product {options["product"]}'))
+            for name, request in requests.items():
+                # the first request warms up the caches the later ones rely on
+                request()
+                response, queries = count_queries(request)
+                self.stdout.write(
+                    f'  {name}: {describe(time_calls(request, options["repeat"]))}, '
+                    f'{queries} queries, status {response.status_code}'
+                )
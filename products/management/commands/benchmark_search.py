@@ -0,0 +1,134 @@
+"""
+Time the product search on made up catalogs of 1,000, 10,000 and 100,000 products, comparing
+the Q(name__icontains=q) | Q(description__icontains=q) scan the listing used to run with the search backends:
+the full text index of the database (FTS5 on sqlite, tsvector on postgres) and the in-memory index,
+along with how long building the in-memory index takes, which happens again every time the catalog version changes.
+The products are saved to a database of their own, see boutique_ado/benchmarking.py.
+
+    python3 manage.py benchmark_search
+    python3 manage.py benchmark_search --sizes 1000,10000 --repeat 50
+"""
+
+import random
+import time
+from itertools import accumulate
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Q
+
+from boutique_ado.benchmarking import benchmark_database, describe, time_calls
+from products.models import Product
+from products.search import (
+    SQLITE_FTS_TABLE,
+    PostgresSearchBackend,
+    PythonSearchBackend,
+    SQLiteSearchBackend,
+)
+
+# searches for a common word, a rarer one, a prefix and two words at once
+QUERIES = ('cotton', 'linen', 'sh', 'blue shirt')
+
+COMMON_WORDS = (
+    'cotton', 'shirt', 'blue', 'black', 'white', 'classic', 'soft', 'fit', 'slim', 'men', 'women',
+    'kitchen', 'towel', 'jeans', 'denim', 'sport', 'summer', 'winter', 'casual', 'linen',
+)
+
+
+def make_catalog(size, seed=0):
+    """
+    Return size (id, name, description, sku) rows of made up products,
+    whose words are drawn from a vocabulary where a few words are far more common than the rest.
+    The rows of a smaller catalog are the first rows of a bigger one
+    """
+    rng = random.Random(seed)
+    vocabulary = list(COMMON_WORDS) + [f'word{n}' for n in range(5000)]
+    # summed up once rather than by every call of choices()
+    cum_weights = list(accumulate(1 / (rank + 1) for rank in range(len(vocabulary))))
+    rows = []
+    for product_id in range(1, size + 1):
+        name = ' '.join(rng.choices(vocabulary, cum_weights=cum_weights, k=4))
+        description = ' '.join(rng.choices(vocabulary, cum_weights=cum_weights, k=60))
+        rows.append((product_id, name, description, f'sku{product_id:08d}'))
+    return rows
+
+
+def database_backend():
+    """
+    Return the backend searching the full text index of the database, or None if it doesn't have one
+    """
+    if connection.vendor == 'postgresql':
+        return PostgresSearchBackend()
+    if connection.vendor == 'sqlite' and SQLITE_FTS_TABLE in connection.introspection.table_names():
+        return SQLiteSearchBackend()
+    return None
+
+
+def icontains_search(query):
+    """
+    The search the products listing ran before the search backends
+    """
+    return list(
+        Product.objects.filter(Q(name__icontains=query) | Q(description__icontains=query)).values_list('id', flat=True)
+    )
+
+
+class Command(BaseCommand):
+    help = 'Compare the icontains scan with the search backends on catalogs of different sizes'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes', default='1000,10000,100000',
+            help='Comma separated numbers of products (default: 1000,10000,100000)',
+        )
+        parser.add_argument(
+            '--repeat', type=int, default=20,
+            help='How many times each search is timed (default: 20)',
+        )
+
+    def handle(self, *args, **options):
+        sizes = sorted(int(size) for size in options['sizes'].split(','))
+        rows = make_catalog(sizes[-1])
+        with benchmark_database(fixtures=()):
+            backend = database_backend()
+            saved = 0
+            for size in sizes:
+                # each catalog is the one before with more products added to it
+                self.add_products(rows[saved:size])
+                saved = size
+
+                python_backend = PythonSearchBackend()
+                start = time.perf_counter()
+                python_backend.load(Product.objects.values_list('id', 'name', 'description', 'sku').iterator())
+                build = time.perf_counter() - start
+
+                self.stdout.write(self.style.MIGRATE_HEADING(f'{size} products'))
+                self.stdout.write(f'  building the in-memory index: {build * 1000:.1f} ms')
+                searches = {'icontains': icontains_search}
+                if backend is not None:
+                    searches[f'{connection.vendor} full text'] = backend.search
+                searches['in-memory index'] = python_backend.search_index
+
+                for query in QUERIES:
+                    self.stdout.write(f'  {query!r}:')
+                    for name, search in searches.items():
+                        matches = len(search(query))
+                        durations = time_calls(lambda: search(query), options['repeat'])
+                        self.stdout.write(f'    {name}: {matches} matches, {describe(durations)}')
+
+    def add_products(self, rows):
+        Product.objects.bulk_create(
+            [
+                Product(id=product_id, name=name, description=description, sku=sku, price=10)
+                for product_id, name, description, sku in rows
+            ],
+            batch_size=1000,
+        )
+        # bulk_create doesn't send the signals keeping the FTS table up to date, so add the products to it here
+        if isinstance(database_backend(), SQLiteSearchBackend):
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f'INSERT INTO {SQLITE_FTS_TABLE} (rowid, name, description, sku) '
+                    f'SELECT id, name, description, sku FROM products_product WHERE id BETWEEN %s AND %s',
+                    [rows[0][0], rows[-1][0]],
+                )
@@ -0,0 +1,82 @@
+"""
+Time looking up the products of a bag through the product snapshot cache, see products/snapshots.py,
+against loading the whole product rows with Product.objects.in_bulk() like the bag and the checkout used to,
+for bags of 10 and 100 products of the fixture catalog. Then look up random bags with a cache smaller
+than the catalog, like a busy site with a catalog bigger than PRODUCT_SNAPSHOT_CACHE_SIZE,
+and show the hits, misses and evictions of the cache.
+The products are read from a database of their own loaded with the fixture catalog, see boutique_ado/benchmarking.py.
+
+    python3 manage.py benchmark_snapshots
+    python3 manage.py benchmark_snapshots --lines 10,50 --cache-size 20 --repeat 500
+"""
+
+import random
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from boutique_ado.benchmarking import benchmark_database, describe, time_calls
+from products.models import Product
+from products.snapshots import clear_product_snapshots, get_product_snapshots, product_snapshot_stats
+
+
+class Command(BaseCommand):
+    help = 'Time the product snapshot cache against loading the products of a bag from the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--lines', default='10,100',
+            help='Comma separated numbers of products in the bag (default: 10,100)',
+        )
+        parser.add_argument(
+            '--cache-size', type=int, default=50,
+            help='How many products the cache holds for the random bags (default: 50)',
+        )
+        parser.add_argument(
+            '--repeat', type=int, default=200,
+            help='How many times each lookup is timed (default: 200)',
+        )
+
+    def handle(self, *args, **options):
+        with benchmark_database():
+            cache.clear()
+            catalog = list(Product.objects.order_by('pk').values_list('pk', flat=True))
+            for lines in [int(lines) for lines in options['lines'].split(',')]:
+                bag = [str(product_id) for product_id in catalog[:lines]]
+
+                def cold():
+                    clear_product_snapshots()
+                    return get_product_snapshots(bag)
+
+                lookups = {
+                    'in_bulk': lambda: Product.objects.in_bulk(bag),
+                    'snapshots, empty cache': cold,
+                    'snapshots, warm cache': lambda: get_product_snapshots(bag),
+                }
+                self.stdout.write(self.style.MIGRATE_HEADING(f'bag of {len(bag)} products'))
+                for name, lookup in lookups.items():
+                    lookup()
+                    self.stdout.write(f'  {name}: {describe(time_calls(lookup, options["repeat"]))}')
+
+            with override_settings(PRODUCT_SNAPSHOT_CACHE_SIZE=options['cache_size']):
+                self.benchmark_random_bags(catalog, options['cache_size'], options['repeat'])
+
+    def benchmark_random_bags(self, catalog, cache_size, repeat):
+        rng = random.Random(0)
+        # a few products are far more popular than the rest, like on a real shop
+        weights = [1 / (rank + 1) for rank in range(len(catalog))]
+
+        def lookup():
+            return get_product_snapshots(rng.choices(catalog, weights, k=5))
+
+        self.stdout.write(self.style.MIGRATE_HEADING(
+            f'random bags of 5 products, cache of {cache_size} of the {len(catalog)} products'
+        ))
+        self.stdout.write(f'  snapshots: {describe(time_calls(lookup, repeat))}')
+        stats = product_snapshot_stats()
+        lookups = stats['hits'] + stats['misses']
+        self.stdout.write(
+            f'  {stats["hits"]} hits ({stats["hits"] / lookups:.0%}), {stats["misses"]} misses, '
+            f'{stats["evictions"]} evictions, {stats["size"]} products cached'
+        )
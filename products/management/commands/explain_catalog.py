@@ -0,0 +1,97 @@
+"""
+Print the query plans of every query the products listing runs,
+for each combination of sorting, direction and filters the all_products view supports,
+so a change that stops the database from using the catalog indexes shows up straight away.
+
+    python3 manage.py explain_catalog
+    python3 manage.py explain_catalog --categories jeans,shirts --search cotton
+"""
+
+from itertools import product as combinations
+from urllib.parse import urlencode
+
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.backends.base import SessionBase
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from products.models import Category
+from products.views import all_products
+
+# the sort options of the sort selector in products.html, None being the default order
+SORTS = (None, 'price', 'rating', 'name', 'category')
+DIRECTIONS = ('asc', 'desc')
+
+EXPLAIN_PREFIXES = {
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+    'postgresql': 'EXPLAIN ',
+    'mysql': 'EXPLAIN ',
+}
+
+
+class Command(BaseCommand):
+    help = 'Print the query plans of the products listing for every sort and filter combination'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--categories',
+            help='Comma separated category names to filter by (default: the first two categories)',
+        )
+        parser.add_argument(
+            '--search', default='shirt',
+            help='The search term used for the search combinations (default: shirt)',
+        )
+
+    def handle(self, *args, **options):
+        prefix = EXPLAIN_PREFIXES.get(connection.vendor)
+        if prefix is None:
+            self.stderr.write(f'EXPLAIN is not supported for the {connection.vendor} database')
+            return
+
+        categories = options['categories']
+        if categories is None:
+            categories = ','.join(Category.objects.order_by('id').values_list('name', flat=True)[:2])
+
+        filters = (
+            {},
+            {'category': categories},
+            {'q': options['search']},
+            {'category': categories, 'q': options['search']},
+        )
+        for sort, direction, params in combinations(SORTS, DIRECTIONS, filters):
+            if sort is None and direction == 'desc':
+                continue
+            params = dict(params)
+            if sort is not None:
+                params.update(sort=sort, direction=direction)
+            for pagination in ({'page': 2}, {'cursor': ''}):
+                url = f"{reverse('products')}?{urlencode({**params, **pagination})}"
+                # the view runs against a cache of this command which never keeps anything,
+                # so the products counts and the grid are calculated again and their queries explained as well,
+                # without touching the catalog version, and so the caches, of the running site
+                with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}}):
+                    self.explain(prefix, url)
+
+    def explain(self, prefix, url):
+        # calling the view runs exactly the queries it runs for an anonymous shopper,
+        # pagination and search included, instead of rebuilding them here
+        request = RequestFactory().get(url)
+        request.session = SessionBase()
+        request.user = AnonymousUser()
+
+        with CaptureQueriesContext(connection) as queries:
+            response = all_products(request)
+        self.stdout.write(self.style.MIGRATE_HEADING(f'{url} ({response.status_code})'))
+        for query in queries.captured_queries:
+            sql = query['sql']
+            # the session and other bookkeeping queries aren't part of the catalog
+            if 'products_' not in sql:
+                continue
+            self.stdout.write(f'  {sql}')
+            with connection.cursor() as cursor:
+                cursor.execute(prefix + sql)
+                for row in cursor.fetchall():
+                    self.stdout.write('    ' + ' '.join(str(column) for column in row))
@@ -0,0 +1,44 @@
+from django.db import migrations
+from django.db.utils import OperationalError
+
+# keep in step with SQLITE_FTS_TABLE in products/search.py
+FTS_TABLE = 'products_product_fts'
+
+
+def create_search_index(apps, schema_editor):
+    """
+    Create and fill the FTS5 table used by the sqlite search backend.
+    Other databases, and sqlite builds without FTS5, fall back to another backend.
+    """
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        try:
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5("
+                f"name, description, sku, tokenize='unicode61 remove_diacritics 2')"
+            )
+        except OperationalError:
+            return
+        cursor.execute(
+            f"INSERT INTO {FTS_TABLE} (rowid, name, description, sku) "
+            f"SELECT id, name, description, COALESCE(sku, '') FROM products_product"
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0002_auto_20240509_0940'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
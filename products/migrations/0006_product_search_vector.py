@@ -0,0 +1,43 @@
+from django.db import migrations
+
+# keep in step with POSTGRES_SEARCH_COLUMN and POSTGRES_SEARCH_CONFIG in products/search.py
+SEARCH_COLUMN = 'search_vector'
+SEARCH_INDEX = 'product_search_vector_idx'
+
+
+def create_search_vector(apps, schema_editor):
+    """
+    Add the stored tsvector column searched by the postgres search backend, with a GIN index on it.
+    Postgres keeps the column up to date itself whenever a product is saved.
+    It isn't a model field, so the other databases don't get it and django never writes to it.
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        f"ALTER TABLE products_product ADD COLUMN {SEARCH_COLUMN} tsvector GENERATED ALWAYS AS ("
+        f"setweight(to_tsvector('english', COALESCE(name, '')), 'A') || "
+        f"setweight(to_tsvector('english', COALESCE(sku, '')), 'A') || "
+        f"setweight(to_tsvector('english', COALESCE(description, '')), 'B')"
+        f") STORED"
+    )
+    schema_editor.execute(
+        f'CREATE INDEX {SEARCH_INDEX} ON products_product USING GIN ({SEARCH_COLUMN})'
+    )
+
+
+def drop_search_vector(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(f'DROP INDEX IF EXISTS {SEARCH_INDEX}')
+    schema_editor.execute(f'ALTER TABLE products_product DROP COLUMN IF EXISTS {SEARCH_COLUMN}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0005_product_updated_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_vector, drop_search_vector),
+    ]
@@ -1,4 +1,7 @@
 from django.db import models
+from django.db.models import F
+from django.db.models.functions import Lower
+from django.utils import timezone
 
 # create category model which will give products a category like clothing, kitchen and dining, or deals
 class Category(models.Model):
@@ -8,7 +11,8 @@ class Category(models.Model):
     class Meta:
         verbose_name_plural = 'Categories'
 
-    name = models.CharField(max_length=254)
+    # index the name since the products listing filters and sorts by the category name
+    name = models.CharField(max_length=254, db_index=True)
     # null equals true and blank equals true so that the friendly name is optional
     friendly_name = models.CharField(max_length=254, null=True, blank=True)
 
@@ -23,6 +27,20 @@ class Category(models.Model):
 
 # create Product model
 class Product(models.Model):
+
+    # indexes for the ways the products listing filters and sorts the products.
+    # the id comes last as the listing uses it as the tie breaker between products with the same value
+    class Meta:
+        indexes = [
+            models.Index(fields=['price', 'id'], name='product_price_idx'),
+            models.Index(fields=['rating', 'id'], name='product_rating_idx'),
+            # a functional index for the case-insensitive sorting on Lower('name')
+            models.Index(Lower('name'), F('id'), name='product_lower_name_idx'),
+            # filtering by category and sorting within it
+            models.Index(fields=['category', 'price', 'id'], name='product_category_price_idx'),
+            models.Index(fields=['category', 'rating', 'id'], name='product_category_rating_idx'),
+        ]
+
     #The first field is a foreign key to the category model. We'll allow this to be null in the database and blank in forms
     # and if a category is deleted we'll set any products that use it to have null for this field rather than deleting the product.
     category = models.ForeignKey('Category', null=True, blank= True, on_delete=models.SET_NULL)
@@ -36,6 +54,16 @@ class Product(models.Model):
     rating = models.DecimalField(max_digits=6, decimal_places=2, null=True, blank=True)
     image_url = models.URLField(max_length=1024, null=True, blank=True)
     image = models.ImageField(null=True, blank=True)
+    # when the product was last changed, used for the ETag and Last-Modified headers of the product detail page.
+    # It's a default rather than auto_now so products loaded from the fixtures get a value too
+    updated_at = models.DateTimeField(default=timezone.now, editable=False)
+
+    def save(self, *args, **kwargs):
+        """
+        Override the original save method to record when the product was changed
+        """
+        self.updated_at = timezone.now()
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return self.name
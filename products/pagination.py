@@ -0,0 +1,170 @@
+# Pagination for the products listing
+
+"""
+Two ways of paging through the products are supported:
+    1. page based pagination (?page=3) with django's Paginator,
+       which is what the page links at the bottom of the listing use.
+    2. keyset pagination (?cursor=...) where the cursor holds the sort value and the id
+       of the last product on the previous page, along with the sorting it was made for. The next page is then simply the products
+       sorting after that one, so going deep into the listing doesn't need the database
+       to skip over all the earlier products like an OFFSET does.
+The total number of products for a listing comes from the cache instead of a COUNT query on every request.
+Search results shown best match first are paged through by the ids of the matches instead, see RankedPaginator.
+"""
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.paginator import Page, Paginator
+from django.db.models import Case, F, IntegerField, Q, Value, When
+from django.utils.functional import cached_property
+
+from .caching import listing_cache_key
+
+# the sort keys keyset pagination works with; the id is always added as the tie breaker
+KEYSET_SORT_KEYS = ('id', 'price', 'rating', 'lower_name', 'category_name')
+
+CURSOR_SALT = 'products.pagination.cursor'
+
+
+def cached_count(queryset, params):
+    """
+    Return the number of products in the queryset, caching it by the filter parameters
+    until the catalog changes
+    """
+    key = f'products:count:{listing_cache_key(params)}'
+    count = cache.get(key)
+    if count is None:
+        count = queryset.count()
+        cache.set(key, count, settings.PRODUCTS_COUNT_CACHE_TIMEOUT)
+    return count
+
+
+class CachedCountPaginator(Paginator):
+    """
+    Paginator which takes its total count from cached_count() instead of counting the queryset
+    """
+    def __init__(self, object_list, per_page, count_params, **kwargs):
+        self.count_params = count_params
+        super().__init__(object_list, per_page, **kwargs)
+
+    @cached_property
+    def count(self):
+        return cached_count(self.object_list, self.count_params)
+
+
+class RankedPaginator(Paginator):
+    """
+    Paginator over the ids of the search matches, best match first, whose pages hold the products with those ids.
+    The count is simply the number of ids, and only the products of the current page are loaded
+    """
+    def __init__(self, queryset, ranked_ids, per_page, **kwargs):
+        self.queryset = queryset
+        super().__init__(ranked_ids, per_page, **kwargs)
+
+    def _get_page(self, ids, number, paginator):
+        # order the products of the page like their ids, which only takes a branch for each product of the page
+        products = self.queryset.filter(pk__in=ids).annotate(search_rank=Case(
+            *[When(pk=pk, then=Value(rank)) for rank, pk in enumerate(ids)],
+            output_field=IntegerField(),
+        )).order_by('search_rank')
+        return Page(products, number, paginator)
+
+
+def keyset_ordering(sortkey, descending):
+    """
+    Return the order_by arguments for keyset pagination on sortkey
+    """
+    # empty values (no rating or no category) always come at the end when descending
+    # and at the start when ascending, so every database orders them the same way
+    if descending:
+        ordering = F(sortkey).desc(nulls_last=True)
+    else:
+        ordering = F(sortkey).asc(nulls_first=True)
+    if sortkey == 'id':
+        return [ordering]
+    return [ordering, 'id']
+
+
+def keyset_filter(sortkey, descending, value, pk):
+    """
+    Return the Q object matching every product which sorts after the (value, pk) position
+    """
+    if sortkey == 'id':
+        return Q(id__lt=pk) if descending else Q(id__gt=pk)
+
+    null_lookup = {f'{sortkey}__isnull': True}
+    if value is None:
+        after_in_nulls = Q(**null_lookup, id__gt=pk)
+        if descending:
+            # the empty values come last so only the rest of them follow
+            return after_in_nulls
+        # the empty values come first so every product with a value follows
+        return after_in_nulls | Q(**{f'{sortkey}__isnull': False})
+
+    same_value = Q(**{sortkey: value}, id__gt=pk)
+    if descending:
+        return Q(**{f'{sortkey}__lt': value}) | same_value | Q(**null_lookup)
+    return Q(**{f'{sortkey}__gt': value}) | same_value
+
+
+def sort_value(product, sortkey):
+    """
+    Read the value of sortkey from a product, following relations like category__name
+    """
+    value = product
+    for attr in sortkey.split('__'):
+        value = getattr(value, attr, None)
+        if value is None:
+            return None
+    return value
+
+
+def encode_cursor(product, sortkey, descending):
+    # sign the cursor so a tampered one is rejected rather than producing a broken query
+    value = sort_value(product, sortkey)
+    return signing.dumps(
+        [sortkey, descending, None if value is None else str(value), product.pk],
+        salt=CURSOR_SALT,
+    )
+
+
+def decode_cursor(cursor, queryset, sortkey, descending):
+    """
+    Return the (value, pk) position stored in a cursor, or None if it's invalid
+    or was made for another sorting, like a cursor kept in the url when the sorting is changed
+    """
+    try:
+        cursor_sortkey, cursor_descending, value, pk = signing.loads(cursor, salt=CURSOR_SALT)
+    except (signing.BadSignature, TypeError, ValueError):
+        return None
+    if cursor_sortkey != sortkey or cursor_descending != descending:
+        return None
+    # convert the value the way the sort key's field does, so a value which isn't valid for it
+    # is caught here rather than when the query runs
+    try:
+        if value is not None:
+            value = queryset.query.clone().resolve_ref(sortkey).output_field.to_python(value)
+        pk = int(pk)
+    except (ValidationError, TypeError, ValueError):
+        return None
+    return value, pk
+
+
+def keyset_page(queryset, sortkey, descending, cursor, per_page):
+    """
+    Return the products of one keyset page and the cursor of the next page or None on the last page.
+    An invalid cursor gives the first page
+    """
+    position = decode_cursor(cursor, queryset, sortkey, descending) if cursor else None
+    if position is not None:
+        queryset = queryset.filter(keyset_filter(sortkey, descending, *position))
+
+    # fetch one extra product to find out whether there's another page after this one
+    products = list(queryset.order_by(*keyset_ordering(sortkey, descending))[:per_page + 1])
+    next_cursor = None
+    if len(products) > per_page:
+        products = products[:per_page]
+        next_cursor = encode_cursor(products[-1], sortkey, descending)
+    return products, next_cursor
@@ -0,0 +1,281 @@
+# Full text search for the products listing
+
+"""
+Searching with Q(name__icontains=q) | Q(description__icontains=q) scans every description
+in the table on every search. Instead the search term goes to a search backend which keeps
+an inverted index over the name, description and sku of every product. Every backend can:
+    - return the ids of all the matching products, best match first, for the listing to page through
+      when it shows the best matches first, see search_products().
+    - filter a queryset down to the matching products, for the listing sorted any other way,
+      see filter_products().
+
+There are three backends:
+    1. SQLiteSearchBackend uses an FTS5 virtual table kept up to date by the product signals.
+    2. PostgresSearchBackend uses the postgres tsvector full text search on a stored, GIN indexed column.
+    3. PythonSearchBackend keeps the inverted index in memory, for databases with neither of them.
+       It's built again when the catalog version changes, so a product changed by another process is found too.
+The backend is picked from the PRODUCTS_SEARCH_BACKEND setting, or from the database when it's 'auto'.
+"""
+
+import math
+import re
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models.expressions import RawSQL
+
+from .caching import get_catalog_version
+from .models import Product
+
+# the name of the FTS5 table created by the 0003_product_search_index migration
+SQLITE_FTS_TABLE = 'products_product_fts'
+
+# the tsvector column created by the 0006_product_search_vector migration, and the text search configuration
+# it's built with, which the search query has to use as well
+POSTGRES_SEARCH_COLUMN = 'search_vector'
+POSTGRES_SEARCH_CONFIG = 'english'
+
+# how much a matching word counts in each of the indexed fields
+FIELD_WEIGHTS = {
+    'name': 10.0,
+    'description': 1.0,
+    'sku': 5.0,
+}
+
+
+def tokenize(text):
+    """
+    Split text into lowercase words
+    """
+    return re.findall(r'\w+', (text or '').lower())
+
+
+class SQLiteSearchBackend:
+    """
+    Search the FTS5 table, ranking the matches with bm25
+    """
+    def _match(self, query):
+        # quote every word so characters like " or * in the search can't break the match expression
+        # and add * to match the words as prefixes, so 'shirt' still finds 'shirts'
+        return ' '.join('"{}"*'.format(word.replace('"', '""')) for word in tokenize(query))
+
+    def search(self, query):
+        match = self._match(query)
+        if not match:
+            return []
+        weights = ', '.join(str(FIELD_WEIGHTS[field]) for field in ('name', 'description', 'sku'))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT rowid FROM {SQLITE_FTS_TABLE} WHERE {SQLITE_FTS_TABLE} MATCH %s '
+                f'ORDER BY bm25({SQLITE_FTS_TABLE}, {weights}), rowid',
+                [match],
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+    def filter(self, queryset, query):
+        match = self._match(query)
+        if not match:
+            return queryset.none()
+        # a subquery, so the database looks the matches up in the FTS table itself
+        # rather than being sent the id of every one of them
+        return queryset.filter(pk__in=RawSQL(
+            f'SELECT rowid FROM {SQLITE_FTS_TABLE} WHERE {SQLITE_FTS_TABLE} MATCH %s', [match],
+        ))
+
+    def index_product(self, product):
+        # the FTS table lives in the same database so this is part of the transaction saving the product
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {SQLITE_FTS_TABLE} WHERE rowid = %s', [product.pk])
+            cursor.execute(
+                f'INSERT INTO {SQLITE_FTS_TABLE} (rowid, name, description, sku) VALUES (%s, %s, %s, %s)',
+                [product.pk, product.name, product.description, product.sku or ''],
+            )
+
+    def remove_product(self, product_id):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {SQLITE_FTS_TABLE} WHERE rowid = %s', [product_id])
+
+
+class PostgresSearchBackend:
+    """
+    Search with the postgres tsvector full text search, ranking the matches with ts_rank.
+    The vectors are stored in a column of the product table with a GIN index on it,
+    instead of being built from the name, sku and description of every product on every search
+    """
+    def _vector_and_query(self, query):
+        # imported here because django.contrib.postgres needs the postgres driver installed
+        from django.contrib.postgres.search import SearchQuery, SearchVectorField
+
+        vector = RawSQL(
+            f'"{Product._meta.db_table}"."{POSTGRES_SEARCH_COLUMN}"', [], output_field=SearchVectorField(),
+        )
+        return vector, SearchQuery(query, search_type='websearch', config=POSTGRES_SEARCH_CONFIG)
+
+    def search(self, query):
+        from django.contrib.postgres.search import SearchRank
+
+        vector, search_query = self._vector_and_query(query)
+        matches = Product.objects.annotate(
+            search=vector, rank=SearchRank(vector, search_query),
+        ).filter(search=search_query).order_by('-rank', 'id')
+        return list(matches.values_list('id', flat=True))
+
+    def filter(self, queryset, query):
+        vector, search_query = self._vector_and_query(query)
+        return queryset.annotate(search=vector).filter(search=search_query)
+
+    # postgres updates the stored vector column itself when a product is saved so there's no separate index to update
+    def index_product(self, product):
+        pass
+
+    def remove_product(self, product_id):
+        pass
+
+
+class PythonSearchBackend:
+    """
+    Search an inverted index held in memory, ranking the matches with tf-idf.
+    The index is built from the database on the first search, and again on the first search after
+    the catalog version has changed, like the category map (see products/categories.py)
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # word -> {product id: weighted number of times the word appears in the product}
+        self._postings = None
+        # the number of products indexed, for the idf
+        self._product_count = 0
+        # the indexed words in order, to find all the words starting with a search word
+        self._vocabulary = []
+        self._vocabulary_stale = True
+        # the catalog version the index was built at
+        self._catalog_version = None
+
+    def _build(self):
+        # read the version first, so a product changed while building makes the index stale rather than the other way round
+        catalog_version = get_catalog_version()
+        fields = ('id',) + tuple(FIELD_WEIGHTS)
+        self.load(Product.objects.values_list(*fields).iterator(), catalog_version)
+
+    def load(self, rows, catalog_version=None):
+        """
+        Replace the index with one of the given (id, name, description, sku) rows
+        """
+        self._postings = defaultdict(dict)
+        self._product_count = 0
+        for values in rows:
+            self._add(values[0], dict(zip(FIELD_WEIGHTS, values[1:])))
+        self._catalog_version = catalog_version
+
+    def _add(self, product_id, texts):
+        counts = defaultdict(float)
+        for field, text in texts.items():
+            for word in tokenize(text):
+                counts[word] += FIELD_WEIGHTS[field]
+        for word, count in counts.items():
+            self._postings[word][product_id] = count
+        self._product_count += 1
+        self._vocabulary_stale = True
+
+    def _words_starting_with(self, prefix):
+        if self._vocabulary_stale:
+            self._vocabulary = sorted(self._postings)
+            self._vocabulary_stale = False
+        start = bisect_left(self._vocabulary, prefix)
+        for word in self._vocabulary[start:]:
+            if not word.startswith(prefix):
+                break
+            yield word
+
+    def search(self, query):
+        if not tokenize(query):
+            return []
+        catalog_version = get_catalog_version()
+        with self._lock:
+            if self._postings is None or self._catalog_version != catalog_version:
+                self._build()
+            return self.search_index(query)
+
+    def search_index(self, query):
+        """
+        Search the index as it is, without checking it's up to date, like the benchmark_search command does
+        """
+        words = tokenize(query)
+        total = self._product_count or 1
+        scores = {}
+        for position, search_word in enumerate(words):
+            # a product has to match every word of the search, each of them as a prefix
+            word_scores = defaultdict(float)
+            for word in self._words_starting_with(search_word):
+                postings = self._postings[word]
+                idf = math.log(1 + total / len(postings))
+                for product_id, count in postings.items():
+                    word_scores[product_id] += count * idf
+            if position == 0:
+                scores = word_scores
+            else:
+                scores = {
+                    product_id: score + word_scores[product_id]
+                    for product_id, score in scores.items() if product_id in word_scores
+                }
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        return [product_id for product_id, score in ranked]
+
+    def filter(self, queryset, query):
+        # the index is in this process, so the database can only be given the ids of the matches
+        return queryset.filter(pk__in=self.search(query))
+
+    def _drop(self):
+        with self._lock:
+            self._postings = None
+
+    # the product signals change the catalog version, so every process builds its index again on its next search.
+    # This one also drops it once the change is committed, in case it was built again before the commit
+    def index_product(self, product):
+        transaction.on_commit(self._drop)
+
+    def remove_product(self, product_id):
+        transaction.on_commit(self._drop)
+
+
+BACKENDS = {
+    'sqlite': SQLiteSearchBackend,
+    'postgres': PostgresSearchBackend,
+    'python': PythonSearchBackend,
+}
+
+_backend = None
+
+
+def get_search_backend():
+    """
+    Return the search backend, creating it the first time it's needed
+    """
+    global _backend
+    if _backend is None:
+        name = settings.PRODUCTS_SEARCH_BACKEND
+        if name == 'auto':
+            if connection.vendor == 'postgresql':
+                name = 'postgres'
+            elif connection.vendor == 'sqlite' and SQLITE_FTS_TABLE in connection.introspection.table_names():
+                name = 'sqlite'
+            else:
+                name = 'python'
+        _backend = BACKENDS[name]()
+    return _backend
+
+
+def search_products(query):
+    """
+    Return the ids of all the products matching the search query, best match first
+    """
+    return get_search_backend().search(query)
+
+
+def filter_products(queryset, query):
+    """
+    Return the products of the queryset matching the search query
+    """
+    return get_search_backend().filter(queryset, query)
@@ -0,0 +1,55 @@
+# Keep the caches built from the product catalog in step with the database
+# the same way checkout/signals.py keeps the order totals in step with the line items
+
+from django.db.models.signals import post_save, post_delete, pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .caching import bump_price_version, bump_catalog_version
+from .categories import drop_category_map
+from .models import Product, Category
+from .search import get_search_backend
+from .snapshots import invalidate_product_snapshot
+
+
+@receiver(post_save, sender=Product)
+def update_on_save(sender, instance, created, **kwargs):
+    """
+    Invalidate cached prices, listings and snapshots and update the search index on product update/create
+    """
+    bump_price_version()
+    bump_catalog_version()
+    invalidate_product_snapshot(instance.pk)
+    get_search_backend().index_product(instance)
+
+
+@receiver(post_delete, sender=Product)
+def update_on_delete(sender, instance, **kwargs):
+    """
+    Invalidate cached prices, listings and snapshots and update the search index on product delete
+    """
+    bump_price_version()
+    bump_catalog_version()
+    invalidate_product_snapshot(instance.pk)
+    get_search_backend().remove_product(instance.pk)
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def update_on_category_change(sender, instance, **kwargs):
+    """
+    Invalidate cached listings and the category map on category update/create/delete
+    """
+    bump_catalog_version()
+    drop_category_map()
+
+
+@receiver(post_save, sender=Category)
+@receiver(pre_delete, sender=Category)
+def touch_category_products(sender, instance, **kwargs):
+    """
+    Mark the products of a changed category as updated,
+    since their detail pages show the category too
+    """
+    # this runs before a delete as well, while the products still point to the category
+    Product.objects.filter(category=instance).update(updated_at=timezone.now())
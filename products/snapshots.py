@@ -0,0 +1,187 @@
+# A cache of the few product fields the bag and the checkout need, kept in the memory of each process
+
+"""
+The bag context processor, the bag views, the checkout and the webhook handler only need the name, price,
+image and sizes of a product, yet each of them loaded whole product rows, description included, on every request.
+get_product_snapshots() returns those fields as read-only ProductSnapshots instead,
+loading only the products it doesn't have yet with a single query.
+
+The cache holds at most PRODUCT_SNAPSHOT_CACHE_SIZE products, dropping the least recently used one when it's full,
+and loads a product again once it's older than PRODUCT_SNAPSHOT_CACHE_TIMEOUT seconds.
+When a product is saved or deleted, products/signals.py drops it from the cache of this process,
+and the cache of every other process is emptied when it sees the price version has changed (see caching.py).
+product_snapshot_stats() returns the number of hits, misses, evictions and invalidations.
+"""
+
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from .caching import get_price_version
+from .models import Product
+
+
+class SnapshotImage(namedtuple('SnapshotImage', ['name', 'url'])):
+    """
+    The image of a product snapshot, used like the image field of a product in the templates
+    """
+    # a product without an image has an empty name, which should be falsy like an empty image field
+    def __bool__(self):
+        return bool(self.name)
+
+
+ProductSnapshot = namedtuple('ProductSnapshot', ['id', 'sku', 'name', 'price', 'has_sizes', 'image', 'image_url'])
+
+# only these columns are read from the database
+SNAPSHOT_FIELDS = ('id', 'sku', 'name', 'price', 'has_sizes', 'image', 'image_url')
+
+
+def make_snapshot(product):
+    """
+    Return the snapshot of a product
+    """
+    image = SnapshotImage(product.image.name or '', product.image.url if product.image else '')
+    return ProductSnapshot(
+        id=product.id,
+        sku=product.sku,
+        name=product.name,
+        price=product.price,
+        has_sizes=product.has_sizes,
+        image=image,
+        image_url=product.image_url,
+    )
+
+
+class ProductSnapshotCache:
+    """
+    A least recently used cache of product snapshots, whose entries expire after a timeout
+    """
+    def __init__(self, max_size, timeout):
+        self.max_size = max_size
+        self.timeout = timeout
+        # product id -> (snapshot, when it was loaded), the least recently used first
+        self._snapshots = OrderedDict()
+        self._lock = threading.Lock()
+        self._price_version = None
+        # raised by every invalidation, so products loaded before it aren't cached after it
+        self._generation = 0
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    def get_many(self, product_ids):
+        """
+        Return a dictionary of the snapshots of the given product ids, leaving out the products which don't exist
+        """
+        price_version = get_price_version()
+        now = time.monotonic()
+        found = {}
+        missing = []
+        with self._lock:
+            if price_version != self._price_version:
+                # a product was changed, maybe by another process
+                self._clear()
+                self._price_version = price_version
+            for product_id in product_ids:
+                entry = self._snapshots.get(product_id)
+                if entry is not None and now - entry[1] < self.timeout:
+                    self._snapshots.move_to_end(product_id)
+                    found[product_id] = entry[0]
+                    self._stats['hits'] += 1
+                else:
+                    missing.append(product_id)
+                    self._stats['misses'] += 1
+            generation = self._generation
+
+        if missing:
+            # the query runs without the lock, so other requests aren't kept waiting
+            loaded = {
+                product.id: make_snapshot(product)
+                for product in Product.objects.filter(pk__in=missing).only(*SNAPSHOT_FIELDS)
+            }
+            found.update(loaded)
+            with self._lock:
+                # a product changed while it was being loaded is left for the next request to load again
+                if generation == self._generation:
+                    for product_id, snapshot in loaded.items():
+                        self._snapshots[product_id] = (snapshot, now)
+                        self._snapshots.move_to_end(product_id)
+                    while len(self._snapshots) > self.max_size:
+                        self._snapshots.popitem(last=False)
+                        self._stats['evictions'] += 1
+        return found
+
+    def invalidate(self, product_id):
+        """
+        Drop a product from the cache
+        """
+        with self._lock:
+            self._snapshots.pop(product_id, None)
+            self._generation += 1
+            self._stats['invalidations'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._clear()
+
+    def _clear(self):
+        if self._snapshots:
+            self._stats['invalidations'] += len(self._snapshots)
+        self._snapshots.clear()
+        self._generation += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, size=len(self._snapshots))
+
+
+def build_product_snapshot_cache():
+    return ProductSnapshotCache(settings.PRODUCT_SNAPSHOT_CACHE_SIZE, settings.PRODUCT_SNAPSHOT_CACHE_TIMEOUT)
+
+
+_cache = build_product_snapshot_cache()
+
+
+@receiver(setting_changed)
+def reset_product_snapshot_cache(setting, **kwargs):
+    # so override_settings(PRODUCT_SNAPSHOT_CACHE_SIZE=...) in a test gets a cache of that size
+    global _cache
+    if setting.startswith('PRODUCT_SNAPSHOT_'):
+        _cache = build_product_snapshot_cache()
+
+
+def get_product_snapshots(product_ids):
+    """
+    Return a dictionary of product snapshots keyed by their integer ids,
+    leaving out the products which don't exist, like Product.objects.in_bulk()
+    """
+    return _cache.get_many([int(product_id) for product_id in product_ids])
+
+
+def get_product_snapshot(product_id):
+    """
+    Return the snapshot of a product, or None if it doesn't exist
+    """
+    try:
+        product_id = int(product_id)
+    except (TypeError, ValueError):
+        return None
+    return _cache.get_many([product_id]).get(product_id)
+
+
+def invalidate_product_snapshot(product_id):
+    _cache.invalidate(product_id)
+
+
+def clear_product_snapshots():
+    _cache.clear()
+
+
+def product_snapshot_stats():
+    """
+    Return the number of hits, misses, evictions and invalidations of the cache since the process started,
+    along with the number of products it holds
+    """
+    return _cache.stats()
@@ -0,0 +1,23 @@
+"""
+A custom template filter to show the category of a product from the category map in products/categories.py,
+so the products listing doesn't need to join the category of every product
+"""
+
+from django import template
+
+from products.categories import get_category_map
+
+register = template.Library()
+
+
+# {% with category=product.category_id|category:category_map %} gives the category's name and friendly_name,
+# or None for a product without a category.
+# The views pass the category map of the request, so the catalog version is checked once per page
+# rather than once per card; without it the filter gets the map itself
+@register.filter(name='category')
+def category(category_id, category_map=None):
+    if category_id is None:
+        return None
+    if category_map is None:
+        category_map = get_category_map()
+    return category_map.get(category_id)
@@ -1,3 +1,339 @@
-from django.test import TestCase
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from . import categories
+from .caching import bump_catalog_version, bump_price_version, get_catalog_version
+from .models import Category, Product
+from .search import PythonSearchBackend, get_search_backend, search_products
+from .snapshots import get_product_snapshot, get_product_snapshots, product_snapshot_stats
+
+
+class ProductListingQueryTests(TestCase):
+    """
+    The products listing runs the same few queries whatever the number of products on the page,
+    without loading the descriptions
+    """
+    fixtures = ['categories', 'products']
+
+    LISTINGS = (
+        {},
+        {'sort': 'category', 'direction': 'asc'},
+        {'sort': 'price', 'direction': 'desc', 'page': 3},
+        {'category': 'shirts,jeans'},
+        {'cursor': ''},
+    )
+
+    def setUp(self):
+        cache.clear()
+
+    def test_listing_queries(self):
+        for params in self.LISTINGS:
+            with self.subTest(params=params):
+                cache.clear()
+                # the count, the products of the page and the category map
+                with self.assertNumQueries(3):
+                    self.client.get(reverse('products'), params)
+                # then the count and the category map come from the caches
+                with self.assertNumQueries(1):
+                    self.client.get(reverse('products'), params)
+
+    def test_search_queries(self):
+        # the search, the products of the page and the category map
+        with self.assertNumQueries(3):
+            self.client.get(reverse('products'), {'q': 'shirt'})
+        # then the category map is loaded, as is the in-memory index of the python search backend
+        search_queries = 0 if isinstance(get_search_backend(), PythonSearchBackend) else 1
+        with self.assertNumQueries(1 + search_queries):
+            self.client.get(reverse('products'), {'q': 'shirt'})
+
+    def test_category_map_is_checked_once_per_page(self):
+        # rather than once for every card of the grid. The first page loads the map, the second isn't cached yet
+        self.client.get(reverse('products'))
+        with mock.patch.object(categories, 'get_catalog_version', wraps=categories.get_catalog_version) as version:
+            response = self.client.get(reverse('products'), {'page': 2})
+        self.assertEqual(len(response.context['products']), settings.PRODUCTS_PER_PAGE)
+        self.assertEqual(version.call_count, 1)
+
+    def test_descriptions_are_not_loaded(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('products'))
+        self.assertEqual(len(response.context['products']), settings.PRODUCTS_PER_PAGE)
+        for query in queries:
+            self.assertNotIn('"description"', query['sql'])
+
+
+class ExplainCatalogTests(TestCase):
+    """
+    explain_catalog explains the counts as well, without invalidating the caches of the site
+    """
+    fixtures = ['categories', 'products']
+
+    def test_caches_are_left_alone(self):
+        version = get_catalog_version()
+        out = StringIO()
+        call_command('explain_catalog', stdout=out)
+        self.assertIn('COUNT(', out.getvalue())
+        self.assertEqual(get_catalog_version(), version)
+
+
+class ProductDetailConditionalTests(TestCase):
+    """
+    The product detail page is only answered with a 304 while neither the product, its category
+    nor the header showing the bag have changed, and never while messages are waiting to be shown
+    """
+    fixtures = ['categories', 'products']
+
+    def setUp(self):
+        cache.clear()
+        self.product = Product.objects.filter(category__isnull=False).first()
+        self.url = reverse('product_detail', args=[self.product.pk])
+
+    def get(self, **headers):
+        return self.client.get(self.url, **headers)
+
+    def test_matching_etag_is_a_304(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        response = self.get(HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+    def test_last_modified_of_a_page_without_personal_content(self):
+        last_modified = self.get()['Last-Modified']
+        self.assertEqual(self.get(HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+
+    def test_product_change_is_a_200(self):
+        etag = self.get()['ETag']
+        self.product.price += 1
+        self.product.save()
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_category_change_is_a_200(self):
+        etag = self.get()['ETag']
+        category = self.product.category
+        category.friendly_name = 'Renamed'
+        category.save()
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Renamed')
+
+    def test_bag_change_is_a_200(self):
+        etag = self.get()['ETag']
+        self.client.post(reverse('add_to_bag_json', args=[self.product.pk]), {'quantity': 1})
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        # the header shows the bag, so it's no longer the same page for everyone
+        self.assertNotIn('Last-Modified', response)
+
+    def test_pending_messages_have_no_etag(self):
+        etag = self.get()['ETag']
+        # the redirecting view leaves a message for the next page to show
+        self.client.post(reverse('add_to_bag', args=[self.product.pk]), {'quantity': 1, 'redirect_url': '/'})
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('ETag', response)
+        # once shown the page can be cached again
+        self.assertIn('ETag', self.get())
+
+    def test_saving_the_product_evicts_its_fragments(self):
+        self.assertContains(self.get(), self.product.name)
+        old_name = self.product.name
+        self.product.name = 'A renamed product'
+        self.product.description = 'A new description'
+        self.product.save()
+        response = self.get()
+        self.assertContains(response, 'A renamed product')
+        self.assertContains(response, 'A new description')
+        self.assertNotContains(response, old_name)
+
+
+class KeysetCursorTests(TestCase):
+    """
+    The cursor of the keyset pagination is only used with the sorting it was made for
+    """
+    fixtures = ['categories', 'products']
+
+    def setUp(self):
+        cache.clear()
+
+    def next_cursor(self, params):
+        response = self.client.get(reverse('products'), dict(params, cursor=''))
+        return response.context['next_cursor']
+
+    def test_pages_follow_each_other(self):
+        params = {'sort': 'price', 'direction': 'desc'}
+        seen = []
+        cursor = ''
+        while cursor is not None:
+            response = self.client.get(reverse('products'), dict(params, cursor=cursor))
+            seen += [product.pk for product in response.context['products']]
+            cursor = response.context['next_cursor']
+        expected = list(Product.objects.order_by('-price', 'id').values_list('pk', flat=True))
+        self.assertEqual(seen, expected)
+
+    def test_cursor_of_another_sorting_gives_the_first_page(self):
+        cursor = self.next_cursor({'sort': 'rating', 'direction': 'desc'})
+        first_page = self.client.get(reverse('products'), {'q': 'shirt', 'cursor': ''})
+        response = self.client.get(reverse('products'), {'q': 'shirt', 'cursor': cursor})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.context['products']), list(first_page.context['products']))
+
+    def test_cursor_of_another_direction_gives_the_first_page(self):
+        cursor = self.next_cursor({'sort': 'price', 'direction': 'desc'})
+        first_page = self.client.get(reverse('products'), {'sort': 'price', 'direction': 'asc', 'cursor': ''})
+        response = self.client.get(reverse('products'), {'sort': 'price', 'direction': 'asc', 'cursor': cursor})
+        self.assertEqual(list(response.context['products']), list(first_page.context['products']))
+
+    def test_tampered_cursor_gives_the_first_page(self):
+        response = self.client.get(reverse('products'), {'sort': 'price', 'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['products'][0], Product.objects.order_by('price', 'id').first())
+
+
+@override_settings(PRODUCTS_PER_PAGE=5)
+class SearchPaginationTests(TestCase):
+    """
+    A search pages through all of its matches and counts every one of them
+    """
+    fixtures = ['categories', 'products']
+
+    def setUp(self):
+        cache.clear()
+
+    def listing(self, params):
+        seen = []
+        page = 1
+        while True:
+            response = self.client.get(reverse('products'), dict(params, page=page))
+            seen += [product.pk for product in response.context['products']]
+            if not response.context['page_obj'].has_next():
+                return response.context['total_products'], seen
+            page += 1
+
+    def test_best_matches_first_across_the_pages(self):
+        total, seen = self.listing({'q': 'shirt'})
+        self.assertEqual(seen, search_products('shirt'))
+        self.assertEqual(total, len(seen))
+        self.assertGreater(total, 5)
+
+    def test_only_the_products_of_the_page_are_loaded(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('products'), {'q': 'shirt', 'page': 2})
+        page_queries = [query['sql'] for query in queries if 'CASE' in query['sql']]
+        self.assertEqual(len(page_queries), 1)
+        self.assertEqual(page_queries[0].count('WHEN'), 5)
+
+    def test_search_in_categories(self):
+        category = Category.objects.get(name='shirts')
+        total, seen = self.listing({'q': 'shirt', 'category': category.name})
+        in_category = set(Product.objects.filter(category=category).values_list('id', flat=True))
+        self.assertEqual(seen, [pk for pk in search_products('shirt') if pk in in_category])
+        self.assertEqual(total, len(seen))
+
+    def test_sorted_search_has_the_same_matches(self):
+        total, seen = self.listing({'q': 'shirt', 'sort': 'price', 'direction': 'asc'})
+        self.assertEqual(sorted(seen), sorted(search_products('shirt')))
+        self.assertEqual(total, len(seen))
+
+
+class PythonSearchBackendTests(TestCase):
+    """
+    The in-memory index is built again once the catalog version changes
+    """
+    fixtures = ['categories', 'products']
+
+    def setUp(self):
+        cache.clear()
+
+    def test_change_from_another_process_is_found(self):
+        backend = PythonSearchBackend()
+        self.assertEqual(backend.search('zebra'), [])
+        # another process renames the product: its signals only change the shared catalog version
+        Product.objects.filter(pk=1).update(name='Zebra shirt')
+        bump_catalog_version()
+        self.assertEqual(backend.search('zebra'), [1])
+
+    def test_index_is_kept_while_the_catalog_is_unchanged(self):
+        backend = PythonSearchBackend()
+        backend.search('shirt')
+        with self.assertNumQueries(0):
+            backend.search('shirt')
+
+
+class ProductSnapshotCacheTests(TestCase):
+    """
+    The snapshot cache keeps the most recently used products for PRODUCT_SNAPSHOT_CACHE_TIMEOUT seconds,
+    and forgets the ones which were changed. Every test gets a new cache by overriding its settings
+    """
+    fixtures = ['categories', 'products']
+
+    def setUp(self):
+        cache.clear()
+
+    def test_hits_and_misses(self):
+        with self.settings(PRODUCT_SNAPSHOT_CACHE_SIZE=10):
+            with self.assertNumQueries(1):
+                snapshots = get_product_snapshots(['1', 2, 99999])
+            self.assertEqual(sorted(snapshots), [1, 2])
+            self.assertEqual(snapshots[1].price, Product.objects.get(pk=1).price)
+            with self.assertNumQueries(0):
+                get_product_snapshots([1, 2])
+            self.assertEqual(product_snapshot_stats(),
+                             {'hits': 2, 'misses': 3, 'evictions': 0, 'invalidations': 0, 'size': 2})
+
+    def test_least_recently_used_is_evicted(self):
+        with self.settings(PRODUCT_SNAPSHOT_CACHE_SIZE=3):
+            get_product_snapshots([1, 2, 3])
+            # 1 is used again, so 2 is now the least recently used
+            get_product_snapshots([1])
+            get_product_snapshots([4])
+            self.assertEqual(product_snapshot_stats()['evictions'], 1)
+            self.assertEqual(product_snapshot_stats()['size'], 3)
+            with self.assertNumQueries(0):
+                get_product_snapshots([1, 3, 4])
+            with self.assertNumQueries(1):
+                get_product_snapshots([2])
+
+    def test_expired_products_are_loaded_again(self):
+        with self.settings(PRODUCT_SNAPSHOT_CACHE_TIMEOUT=0):
+            get_product_snapshots([1])
+            with self.assertNumQueries(1):
+                get_product_snapshots([1])
+            self.assertEqual(product_snapshot_stats()['misses'], 2)
+
+    def test_saved_product_is_invalidated(self):
+        with self.settings(PRODUCT_SNAPSHOT_CACHE_SIZE=10):
+            get_product_snapshots([1, 2])
+            product = Product.objects.get(pk=1)
+            product.price += 1
+            product.save()
+            self.assertGreaterEqual(product_snapshot_stats()['invalidations'], 1)
+            self.assertEqual(get_product_snapshot(1).price, product.price)
+
+    def test_deleted_product_is_invalidated(self):
+        with self.settings(PRODUCT_SNAPSHOT_CACHE_SIZE=10):
+            get_product_snapshots([1, 2])
+            Product.objects.get(pk=1).delete()
+            self.assertIsNone(get_product_snapshot(1))
+            self.assertEqual(sorted(get_product_snapshots([1, 2])), [2])
+
+    def test_price_version_bump_clears_the_cache(self):
+        # like a product changed by another process
+        with self.settings(PRODUCT_SNAPSHOT_CACHE_SIZE=10):
+            get_product_snapshots([1, 2])
+            Product.objects.filter(pk=1).update(price=1)
+            bump_price_version()
+            with self.assertNumQueries(1):
+                self.assertEqual(get_product_snapshot(1).price, 1)
+            self.assertEqual(product_snapshot_stats()['invalidations'], 2)
+            self.assertEqual(product_snapshot_stats()['size'], 1)
@@ -1,19 +1,39 @@
-from django.shortcuts import render, redirect, reverse, get_object_or_404
+import hashlib
+
+from django.shortcuts import render, redirect, reverse
 from django.contrib import messages
-# a special object from Jango.db.models called Q to generate a more complex search query:
-from django.db.models import Q
+from django.contrib.messages.storage.session import SessionStorage
+from django.conf import settings
+from django.http import Http404
+from django.views.decorators.http import condition
+from django.db.models import F
 from django.db.models.functions import Lower
-from .models import Product, Category
+from django.utils.functional import SimpleLazyObject
+from .caching import listing_cache_key
+from .categories import get_category_map
+from .models import Product
+from .pagination import CachedCountPaginator, KEYSET_SORT_KEYS, RankedPaginator, cached_count, keyset_page
+from .search import filter_products, search_products
+from bag.contexts import bag_summary
+from bag.stores import get_cart
 
 # define an all_products view which will render the products template
 def all_products(request):
     """ A view to show all products, including sorting and search queries """
 
     # return all products from the database
-    products = Product.objects.all()
+    # only load the columns the card uses so the long description isn't fetched for every product.
+    # the card shows the category from the category map, so it isn't joined (see products/categories.py)
+    products = Product.objects.only(
+        'name', 'price', 'rating', 'image', 'category_id',
+    ).order_by('id')
+    # the category map of this request, loaded at most once however many cards the template shows
+    category_map = SimpleLazyObject(get_category_map)
 
     # ensure we don't get an error when loading the products page without a search term
     query = None
+    # the ids of the search matches, best first, when the listing is showing the best matches first
+    ranked_ids = None
 
     # to capture a category parameter we'll start with it as none
     categories = None
@@ -22,6 +42,10 @@ def all_products(request):
     sort = None
     direction = None
 
+    # the field the products are ordered by and whether it's descending, for the pagination below
+    ordering_field = 'id'
+    descending = False
+
     # when a search query is submited it end up in the url as a GET parameter.
     # We can access those url parameter in the all_products view by checking whether request.get exists:
     if request.GET:
@@ -38,28 +62,32 @@ def all_products(request):
 
             # force categories to be sorted by name instead of their ids
             if sortkey == 'category':
-                # double underscore syntax allows us to drill into a related model
-                sortkey = 'category__name'
+                # double underscore syntax allows us to drill into a related model,
+                # annotated so the pagination reads it from the product like the other sort keys
+                sortkey = 'category_name'
+                products = products.annotate(category_name=F('category__name'))
 
+            ordering_field = sortkey
             if 'direction' in request.GET:
                 direction = request.GET['direction']
                 if direction == 'desc':
+                    descending = True
                     # if the direction is descending reverse the order
                     sortkey = f'-{sortkey}'
-            # use the order_by model method to actually sort the products 
-            products = products.order_by(sortkey)
+            # use the order_by model method to actually sort the products
+            # with the id as a tie breaker so products with the same value keep their place across the pages
+            products = products.order_by(sortkey, 'id')
 
 
         # check whether category exists in requests.GET
         if 'category' in request.GET:
             # split category into a list
             categories = request.GET['category'].split(',')
-            # filter the current query set of all products down to only products whose category name is in the list
-            # look for the name field of the related category model using the double underscore syntax
-            products = products.filter(category__name__in=categories)
-            # filter all category objects down to the ones whose name is in the list from the URL
-            # and get a list of actual category objects (so that we can access all their fields in the template)
-            categories = Category.objects.filter(name__in=categories)
+            # find the categories whose name is in the list from the URL in the category map rather than the database,
+            # and get a list of them (so that we can access their name and friendly_name in the template)
+            categories = category_map.with_names(categories)
+            # filter the current query set of all products down to only products in those categories
+            products = products.filter(category_id__in=[category.id for category in categories])
 
         # Since we named the text input in the form in base.html 'q', we can check if 'q' is in request.GET
         if 'q' in request.GET:
@@ -71,25 +99,86 @@ def all_products(request):
                 messages.error(request, "You didn't enter any search criteria")
                 # and redirect back to the products url
                 return redirect(reverse('products'))
-            # construct queries:
-            # set a variable named queries equal to a Q object,where the name contains the query or the description contains the query
-            # case-insensitive containment test uses icontains statement
-            queries = Q(name__icontains=query) | Q(description__icontains=query)
-            # pass queries to the filter method in order to actually filter the products
-            products = products.filter(queries)
+            # ask the search index for the products whose name, description or sku match the query
+            # instead of scanning every description in the table, see products/search.py.
+            # show the best matches first unless the user picked another sorting
+            if sort is None:
+                ordering_field = 'search_rank'
+                ranked_ids = search_products(query)
+                if categories is not None:
+                    # keep the matches in the categories, reading the ids of their products with a single query
+                    in_categories = set(products.values_list('id', flat=True))
+                    ranked_ids = [pk for pk in ranked_ids if pk in in_categories]
+            else:
+                products = filter_products(products, query)
 
     current_sorting = f'{sort}_{direction}'
-    
+
+    # the total count only depends on the filters, not on the sorting or the page.
+    # sort the category names so the same categories in another order share the cached count
+    count_params = {
+        'category': tuple(sorted(request.GET['category'].split(','))) if 'category' in request.GET else None,
+        'q': query,
+    }
+    if ranked_ids is not None:
+        # page through the ids of the matches, best first, so only the products of the current page are loaded
+        # and the count is the number of matches, see products/pagination.py
+        paginator = RankedPaginator(products, ranked_ids, settings.PRODUCTS_PER_PAGE)
+        total_products = paginator.count
+        page_obj = paginator.get_page(request.GET.get('page'))
+        page_products = page_obj.object_list
+        next_cursor = None
+    # a cursor in the url switches to keyset pagination, as long as the sort key supports it
+    elif 'cursor' in request.GET and ordering_field in KEYSET_SORT_KEYS:
+        total_products = cached_count(products, count_params)
+        page_obj = None
+        page_products, next_cursor = keyset_page(
+            products, ordering_field, descending,
+            request.GET['cursor'], settings.PRODUCTS_PER_PAGE,
+        )
+    else:
+        # otherwise split the products into numbered pages; get_page falls back to the first
+        # or the last page when the page number in the url is invalid or out of range
+        paginator = CachedCountPaginator(products, settings.PRODUCTS_PER_PAGE, count_params)
+        total_products = paginator.count
+        page_obj = paginator.get_page(request.GET.get('page'))
+        page_products = page_obj.object_list
+        next_cursor = None
+
+    # the current url parameters without the page position so the page links keep the sorting and filters
+    page_params = request.GET.copy()
+    page_params.pop('page', None)
+    page_params.pop('cursor', None)
+
+    # the rendered products grid is cached by the listing it shows, so any url giving the same
+    # products on the same page shares it. The key changes with the catalog version
+    # so the product and category signals invalidate it, see products/signals.py
+    grid_params = dict(
+        count_params,
+        sort=ordering_field,
+        descending=descending,
+        page=page_obj.number if page_obj else None,
+        cursor=request.GET['cursor'] if page_obj is None else None,
+    )
+
     # template variables to be returned from all_products view to the template:
     context = {
-        # add all products to the context so products will be available in the template
-        'products': products,
+        # add the products of the current page to the context so they will be available in the template
+        'products': page_products,
+        'total_products': total_products,
+        'page_obj': page_obj,
+        'next_cursor': next_cursor,
+        'page_query': page_params.urlencode(),
+        'grid_cache_key': listing_cache_key(grid_params),
+        'grid_cache_timeout': settings.PRODUCTS_GRID_CACHE_TIMEOUT,
 
         # add the query to the context
         'search_term': query,
 
         # return the list of category objects to the context as a current_category
         'current_categories': categories,
+        # passed to the category filter of every card, see products/templatetags/product_tools.py
+        'category_map': category_map,
 
         # return the current sorting methodology to the template
         'current_sorting': current_sorting,
@@ -97,16 +186,69 @@ def all_products(request):
 
     return render(request, 'products/products.html', context)
 
+def _get_product(request, product_id):
+    """
+    Return the product for the detail page, loading it only once per request
+    since the conditional GET checks below need it before the view runs
+    """
+    if not hasattr(request, '_detail_product'):
+        request._detail_product = Product.objects.filter(pk=product_id).first()
+    return request._detail_product
+
+
+def _has_personal_content(request):
+    """
+    Whether the page shows anything specific to this shopper: their bag, their account or messages
+    """
+    return (
+        request.user.is_authenticated
+        or bool(get_cart(request).get('bag'))
+        or bool(request.session.get(SessionStorage.session_key))
+    )
+
+
+def product_etag(request, product_id):
+    """
+    The ETag of the product detail page: the product and when it was last changed,
+    along with the bag summary and the user shown in the header
+    """
+    product = _get_product(request, product_id)
+    # pending messages are shown only once so that page must never come from the browser cache
+    if product is None or request.session.get(SessionStorage.session_key):
+        return None
+    summary = bag_summary(request)
+    state = f'{product.pk}:{product.updated_at.isoformat()}:{request.user.pk}:{summary["product_count"]}:{summary["grand_total"]}'
+    return hashlib.md5(state.encode()).hexdigest()
+
+
+def product_last_modified(request, product_id):
+    """
+    The Last-Modified date of the product detail page,
+    only when the page shows nothing but the product
+    """
+    product = _get_product(request, product_id)
+    if product is None or _has_personal_content(request):
+        return None
+    return product.updated_at
+
+
 # the view which take an individual product_id as a parameter and returns the template including the product
+# the condition decorator answers requests with an If-None-Match or If-Modified-Since header
+# with a 304 Not Modified response when the page hasn't changed, without rendering it at all
+@condition(etag_func=product_etag, last_modified_func=product_last_modified)
 def product_detail(request, product_id):
     """ A view to show individual product details """
 
     # return only one product from the database
-    product = get_object_or_404(Product, pk=product_id)
+    product = _get_product(request, product_id)
+    if product is None:
+        raise Http404('No Product matches the given query.')
 
     # add product to the context so 'product' will be available in the template
     context = {
         'product': product,
+        'category_map': SimpleLazyObject(get_category_map),
+        'detail_cache_timeout': settings.PRODUCTS_DETAIL_CACHE_TIMEOUT,
     }
 
     return render(request, 'products/product_detail.html', context)